@@ -0,0 +1,466 @@
+#!/usr/bin/env python
+"""A local, in-memory stand-in for the Kubernetes API server.
+
+It serves just enough of the API (discovery, the JupyterNotebook CRD
+and the core/apps/networking objects the operator manages) to run the
+real operator against it, with configurable injected latency and errors: -
+
+-   Each (non-watch) request is delayed by around 'latency' milliseconds
+-   A 'conflict rate' fraction of object creations (other than notebooks)
+    fail with a 409 (Conflict), as if the object was created concurrently
+    (the object is stored)
+-   An 'error rate' fraction of object creations, patches and replacements
+    (other than notebooks) fail with a 500 (Internal Error)
+
+There are no controllers (Deployments do not create Pods, for example).
+The number of requests made, by verb and resource, is available from '/_calls'.
+Run it directly, or use the 'FakeApiServer' class (as the benchmark does).
+"""
+
+import argparse
+import asyncio
+import copy
+import datetime
+import json
+import random
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+from aiohttp import web
+
+# The notebook CRD (the minimum the operator needs)
+_CRD: Dict[str, Any] = {
+    "apiVersion": "apiextensions.k8s.io/v1",
+    "kind": "CustomResourceDefinition",
+    "metadata": {"name": "jupyternotebooks.squonk.it"},
+    "spec": {
+        "group": "squonk.it",
+        "scope": "Namespaced",
+        "names": {
+            "kind": "JupyterNotebook",
+            "plural": "jupyternotebooks",
+            "singular": "jupyternotebook",
+        },
+        "versions": [{"name": "v2", "served": True, "storage": True}],
+    },
+}
+
+# The resources we serve, keyed by (group, version).
+# Each entry maps the plural to its (kind, namespaced) definition.
+_RESOURCES: Dict[Tuple[str, str], Dict[str, Tuple[str, bool]]] = {
+    ("", "v1"): {
+        "configmaps": ("ConfigMap", True),
+        "services": ("Service", True),
+        "pods": ("Pod", True),
+        "events": ("Event", True),
+        "namespaces": ("Namespace", False),
+        "nodes": ("Node", False),
+    },
+    ("apps", "v1"): {
+        "deployments": ("Deployment", True),
+        "daemonsets": ("DaemonSet", True),
+        "replicasets": ("ReplicaSet", True),
+    },
+    ("networking.k8s.io", "v1"): {"ingresses": ("Ingress", True)},
+    ("squonk.it", "v2"): {"jupyternotebooks": ("JupyterNotebook", True)},
+    ("coordination.k8s.io", "v1"): {"leases": ("Lease", True)},
+    ("apiextensions.k8s.io", "v1"): {
+        "customresourcedefinitions": ("CustomResourceDefinition", False)
+    },
+    ("metrics.k8s.io", "v1beta1"): {"pods": ("PodMetrics", True)},
+}
+
+
+def _merge(target: Dict[str, Any], patch: Dict[str, Any]) -> Dict[str, Any]:
+    """An RFC 7386 JSON merge-patch."""
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        elif isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], value)
+        else:
+            target[key] = copy.deepcopy(value)
+    return target
+
+
+def _matches(labels: Dict[str, str], selector: str) -> bool:
+    """Returns True if the labels match a (simple) label selector."""
+    for term in filter(None, selector.split(",")):
+        if "!=" in term:
+            key, value = term.split("!=", 1)
+            if labels.get(key) == value:
+                return False
+        elif "=" in term:
+            key, value = term.split("=", 1)
+            if labels.get(key.rstrip("=")) != value:
+                return False
+        elif term.startswith("!"):
+            if term[1:] in labels:
+                return False
+        elif term not in labels:
+            return False
+    return True
+
+
+class FakeApiServer:
+    """The in-memory API server."""
+
+    def __init__(
+        self,
+        latency_ms: float = 0.0,
+        conflict_rate: float = 0.0,
+        error_rate: float = 0.0,
+    ) -> None:
+        self.latency_ms = latency_ms
+        self.conflict_rate = conflict_rate
+        self.error_rate = error_rate
+        self.resource_version = 0
+        # Objects keyed by (group, version, plural) then (namespace, name)
+        self.objects: Dict[
+            Tuple[str, str, str], Dict[Tuple[str, str], Dict[str, Any]]
+        ] = {}
+        # The watches (resource, namespace, label selector and event queue)
+        self.watchers: List[
+            Tuple[
+                Tuple[str, str, str],
+                str,
+                str,
+                "asyncio.Queue[Optional[Dict[str, Any]]]",
+            ]
+        ] = []
+        # Request counts, keyed by "VERB plural"
+        self.calls: Dict[str, int] = {}
+        self.put(
+            ("apiextensions.k8s.io", "v1", "customresourcedefinitions"),
+            copy.deepcopy(_CRD),
+        )
+
+    def _next_rv(self) -> str:
+        self.resource_version += 1
+        return str(self.resource_version)
+
+    def _notify(
+        self, key: Tuple[str, str, str], event: str, obj: Dict[str, Any]
+    ) -> None:
+        namespace = obj["metadata"].get("namespace", "")
+        labels = obj["metadata"].get("labels", {})
+        for w_key, w_ns, w_selector, queue in self.watchers:
+            if (
+                w_key == key
+                and w_ns in ("", namespace)
+                and _matches(labels, w_selector)
+            ):
+                queue.put_nowait({"type": event, "object": copy.deepcopy(obj)})
+
+    def put(
+        self, key: Tuple[str, str, str], obj: Dict[str, Any], event: str = "ADDED"
+    ) -> Dict[str, Any]:
+        """Stores (creates or replaces) an object, notifying watchers."""
+        metadata = obj.setdefault("metadata", {})
+        metadata["resourceVersion"] = self._next_rv()
+        metadata.setdefault("uid", str(uuid.uuid4()))
+        metadata.setdefault(
+            "creationTimestamp",
+            datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        )
+        metadata.setdefault("generation", 1)
+        self.objects.setdefault(key, {})[
+            (metadata.get("namespace", ""), metadata["name"])
+        ] = obj
+        self._notify(key, event, obj)
+        return obj
+
+    def delete(
+        self, key: Tuple[str, str, str], namespace: str, name: str
+    ) -> Optional[Dict[str, Any]]:
+        """Deletes an object (and any objects it owns)."""
+        obj = self.objects.get(key, {}).pop((namespace, name), None)
+        if obj is None:
+            return None
+        obj["metadata"]["resourceVersion"] = self._next_rv()
+        self._notify(key, "DELETED", obj)
+        # Garbage collect owned objects
+        uid = obj["metadata"]["uid"]
+        for o_key, store in list(self.objects.items()):
+            for (o_ns, o_name), o_obj in list(store.items()):
+                owners = o_obj["metadata"].get("ownerReferences", [])
+                if any(owner.get("uid") == uid for owner in owners):
+                    self.delete(o_key, o_ns, o_name)
+        return obj
+
+    def _parse(
+        self, request: web.Request
+    ) -> Tuple[Tuple[str, str, str], str, Optional[str], Optional[str]]:
+        parts = [p for p in request.path.split("/") if p]
+        if parts[0] == "api":
+            group, version, rest = "", parts[1], parts[2:]
+        else:
+            group, version, rest = parts[1], parts[2], parts[3:]
+        namespace = ""
+        if len(rest) >= 2 and rest[0] == "namespaces" and len(rest) > 2:
+            namespace, rest = rest[1], rest[2:]
+        plural = rest[0]
+        name = rest[1] if len(rest) > 1 else None
+        sub = rest[2] if len(rest) > 2 else None
+        if (group, version) not in _RESOURCES or plural not in _RESOURCES[
+            (group, version)
+        ]:
+            raise web.HTTPNotFound()
+        return (group, version, plural), namespace, name, sub
+
+    @staticmethod
+    def _status(code: int, reason: str, message: str = "") -> web.Response:
+        return web.json_response(
+            {
+                "kind": "Status",
+                "apiVersion": "v1",
+                "status": "Failure",
+                "reason": reason,
+                "message": message or reason,
+                "code": code,
+            },
+            status=code,
+            reason=reason,
+        )
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        """Handles all object requests."""
+        key, namespace, name, sub = self._parse(request)
+        watching = request.query.get("watch", "").lower() in ("true", "1", "t")
+        verb = request.method if not watching else "WATCH"
+        if verb == "GET" and name is None:
+            verb = "LIST"
+        self.calls[f"{verb} {key[2]}"] = self.calls.get(f"{verb} {key[2]}", 0) + 1
+
+        if not watching and self.latency_ms:
+            await asyncio.sleep(random.uniform(0.5, 1.5) * self.latency_ms / 1000.0)
+        if (
+            key[0] != "squonk.it"
+            and verb in ("POST", "PATCH", "PUT")
+            and random.random() < self.error_rate
+        ):
+            return self._status(500, "InternalError", "Injected error")
+
+        store = self.objects.setdefault(key, {})
+        selector = request.query.get("labelSelector", "")
+
+        if watching:
+            return await self._watch(request, key, namespace, selector)
+        if verb == "LIST":
+            items = [
+                copy.deepcopy(obj)
+                for (o_ns, _), obj in sorted(store.items())
+                if namespace in ("", o_ns)
+                and _matches(obj["metadata"].get("labels", {}), selector)
+            ]
+            kind = _RESOURCES[key[:2]][key[2]][0]
+            return web.json_response(
+                {
+                    "kind": f"{kind}List",
+                    "apiVersion": f"{key[0]}/{key[1]}".lstrip("/"),
+                    "metadata": {"resourceVersion": str(self.resource_version)},
+                    "items": items,
+                }
+            )
+
+        assert name or verb == "POST"
+        if verb == "GET":
+            obj = store.get((namespace, name or ""))
+            if obj is None:
+                return self._status(404, "NotFound", f"{key[2]} {name} not found")
+            return web.json_response(obj)
+
+        if verb == "DELETE":
+            obj = self.delete(key, namespace, name or "")
+            if obj is None:
+                return self._status(404, "NotFound", f"{key[2]} {name} not found")
+            return web.json_response(obj)
+
+        body = await request.json()
+        if verb == "POST":
+            name = body["metadata"].get("name")
+            if name is None and "generateName" in body["metadata"]:
+                name = body["metadata"]["generateName"] + uuid.uuid4().hex[:5]
+                body["metadata"]["name"] = name
+            if (namespace, name) in store:
+                return self._status(409, "Conflict", f"{key[2]} {name} already exists")
+            if namespace:
+                body["metadata"]["namespace"] = namespace
+            obj = self.put(key, body)
+            if key[0] != "squonk.it" and random.random() < self.conflict_rate:
+                return self._status(409, "Conflict", f"{key[2]} {name} already exists")
+            return web.json_response(obj, status=201)
+
+        obj = store.get((namespace, name or ""))
+        content_type = request.headers.get("Content-Type", "")
+        if verb == "PATCH" and "apply-patch" in content_type:
+            # Server-side apply (a simplified merge without field ownership)
+            if obj is None:
+                body["metadata"]["namespace"] = namespace
+                return web.json_response(self.put(key, body), status=201)
+            new = _merge(copy.deepcopy(obj), body)
+        elif obj is None:
+            return self._status(404, "NotFound", f"{key[2]} {name} not found")
+        elif body.get("metadata", {}).get("resourceVersion") not in (
+            None,
+            obj["metadata"]["resourceVersion"],
+        ):
+            # Optimistic concurrency (as used by Lease holders)
+            return self._status(409, "Conflict", f"{key[2]} {name} has changed")
+        elif verb == "PATCH" and "json-patch" in content_type:
+            return self._status(415, "UnsupportedMediaType")
+        elif verb == "PATCH":
+            new = _merge(copy.deepcopy(obj), body)
+        else:
+            new = body
+            new["metadata"]["namespace"] = namespace
+        if sub == "scale" and "spec" in body:
+            new = _merge(copy.deepcopy(obj), {"spec": body["spec"]})
+        return web.json_response(self.put(key, new, event="MODIFIED"))
+
+    async def _watch(
+        self,
+        request: web.Request,
+        key: Tuple[str, str, str],
+        namespace: str,
+        selector: str,
+    ) -> web.StreamResponse:
+        timeout = float(request.query.get("timeoutSeconds", "60"))
+        response = web.StreamResponse(headers={"Content-Type": "application/json"})
+        await response.prepare(request)
+        queue: "asyncio.Queue[Optional[Dict[str, Any]]]" = asyncio.Queue()
+        watcher = (key, namespace, selector, queue)
+        self.watchers.append(watcher)
+        # Replay anything newer than the requested resource version
+        since = int(request.query.get("resourceVersion", "0") or "0")
+        for (o_ns, _), obj in sorted(self.objects.get(key, {}).items()):
+            if (
+                namespace in ("", o_ns)
+                and int(obj["metadata"]["resourceVersion"]) > since
+                and _matches(obj["metadata"].get("labels", {}), selector)
+            ):
+                queue.put_nowait({"type": "ADDED", "object": copy.deepcopy(obj)})
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        try:
+            while True:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    event = await asyncio.wait_for(queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                if event is None:
+                    # The server's closing
+                    break
+                await response.write(json.dumps(event).encode() + b"\n")
+        except (ConnectionResetError, asyncio.CancelledError):
+            pass
+        finally:
+            self.watchers.remove(watcher)
+        return response
+
+    def close(self) -> None:
+        """Ends all the watches (so the server can stop promptly)."""
+        for _, _, _, queue in self.watchers:
+            queue.put_nowait(None)
+
+    async def api_versions(self, _: web.Request) -> web.Response:
+        """The core API versions."""
+        return web.json_response({"kind": "APIVersions", "versions": ["v1"]})
+
+    async def api_groups(self, _: web.Request) -> web.Response:
+        """The API groups."""
+        groups = [
+            {
+                "name": group,
+                "versions": [
+                    {"groupVersion": f"{group}/{version}", "version": version}
+                ],
+                "preferredVersion": {
+                    "groupVersion": f"{group}/{version}",
+                    "version": version,
+                },
+            }
+            for group, version in _RESOURCES
+            if group
+        ]
+        return web.json_response({"kind": "APIGroupList", "groups": groups})
+
+    async def api_resources(self, request: web.Request) -> web.Response:
+        """The resources of an API group (version)."""
+        group = request.match_info.get("group", "")
+        version = request.match_info["version"]
+        resources = _RESOURCES.get((group, version))
+        if resources is None:
+            raise web.HTTPNotFound()
+        return web.json_response(
+            {
+                "kind": "APIResourceList",
+                "groupVersion": f"{group}/{version}".lstrip("/"),
+                "resources": [
+                    {
+                        "name": plural,
+                        "singularName": plural[:-1],
+                        "namespaced": namespaced,
+                        "kind": kind,
+                        "verbs": [
+                            "create",
+                            "delete",
+                            "get",
+                            "list",
+                            "patch",
+                            "update",
+                            "watch",
+                        ],
+                    }
+                    for plural, (kind, namespaced) in resources.items()
+                ]
+                + [
+                    {
+                        "name": f"{plural}/status",
+                        "singularName": "",
+                        "namespaced": namespaced,
+                        "kind": kind,
+                        "verbs": ["get", "patch", "update"],
+                    }
+                    for plural, (kind, namespaced) in resources.items()
+                    if plural in ("pods", "deployments")
+                ],
+            }
+        )
+
+    async def call_counts(self, _: web.Request) -> web.Response:
+        """Returns the number of requests made, by verb and resource."""
+        return web.json_response(self.calls)
+
+    def app(self) -> web.Application:
+        """Returns the aiohttp application."""
+        application = web.Application(client_max_size=16 * 1024 * 1024)
+        application.router.add_get("/_calls", self.call_counts)
+        application.router.add_get("/api", self.api_versions)
+        application.router.add_get("/apis", self.api_groups)
+        application.router.add_get("/api/{version}", self.api_resources)
+        application.router.add_get("/apis/{group}/{version}", self.api_resources)
+        application.router.add_route("*", "/api/{version}/{tail:.+}", self.handle)
+        application.router.add_route(
+            "*", "/apis/{group}/{version}/{tail:.+}", self.handle
+        )
+        return application
+
+
+def main() -> None:
+    """Runs the server."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--conflict-rate", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    server = FakeApiServer(args.latency_ms, args.conflict_rate, args.error_rate)
+    web.run_app(server.app(), port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+"""Benchmarks the operator's notebook launches against the fake API server.
+
+For each burst size the real operator (kopf, running 'operator/handlers.py')
+is started against a new fake API server (see 'fake_api.py'). The burst
+of JupyterNotebooks is created (at once) and the time until the operator writes
+each notebook's status (the result of its create handler) is measured.
+For each burst we report: -
+
+-   The notebooks created per second (by the operator)
+-   The 50th and 99th percentile times from creation to status
+-   The number of API calls made (by the operator) per notebook
+-   The operators' (total and peak) resident set size
+
+Operator settings are passed as environment variables ('--env'),
+so the effect of, for example, shared static ConfigMaps can be compared: -
+
+    ./run.py --bursts 10,100 --latency-ms 20
+    ./run.py --bursts 10,100 --latency-ms 20 --env JO_SHARED_STATIC_CONFIG=yes
+
+With '--replicas' several operators are run, sharing the notebooks
+(using 'JO_SHARDS' shards, four for each replica unless set with '--env'),
+and the (total) throughput for each replica count can be compared: -
+
+    ./run.py --bursts 1000 --latency-ms 20 --replicas 1
+    ./run.py --bursts 1000 --latency-ms 20 --replicas 3
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import signal
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import aiohttp
+from aiohttp import web
+
+from fake_api import FakeApiServer
+
+# The operator's directory (where kopf is run)
+_OPERATOR_DIR: str = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "operator"
+)
+# The namespace of the notebooks
+_NAMESPACE: str = "benchmark"
+# The maximum number of concurrent notebook creation requests
+_CREATE_CONCURRENCY: int = 50
+
+_KUBECONFIG: str = """apiVersion: v1
+kind: Config
+clusters:
+- cluster: {server: "http://127.0.0.1:%(port)s"}
+  name: fake
+contexts:
+- context: {cluster: fake, user: fake}
+  name: fake
+current-context: fake
+users:
+- name: fake
+  user: {token: fake}
+"""
+
+
+def _notebook(index: int) -> Dict[str, Any]:
+    """A notebook (of one of a few owners and images)."""
+    return {
+        "apiVersion": "squonk.it/v2",
+        "kind": "JupyterNotebook",
+        "metadata": {"name": f"nb-{index}", "namespace": _NAMESPACE},
+        "spec": {
+            "imDataManager": {
+                "image": f"jupyter/minimal-notebook:{index % 3}",
+                "labels": [
+                    f"data-manager.informaticsmatters.com/owner=user-{index % 10}",
+                    f"data-manager.informaticsmatters.com/instance-id=i-{index}",
+                ],
+                "project": {"id": "project-1", "claimName": "project-pvc"},
+            }
+        },
+    }
+
+
+def _percentile(values: List[float], percent: float) -> float:
+    """The (nearest-rank) percentile of a list of values."""
+    if not values:
+        return math.nan
+    ordered = sorted(values)
+    rank = max(1, math.ceil(percent / 100.0 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def _rss_mb(pid: int) -> Tuple[float, float]:
+    """The current and peak resident set size (MiB) of a process (Linux only)."""
+    sizes = {"VmRSS": math.nan, "VmHWM": math.nan}
+    try:
+        with open(f"/proc/{pid}/status", encoding="utf-8") as status:
+            for line in status:
+                field, _, value = line.partition(":")
+                if field in sizes:
+                    sizes[field] = int(value.split()[0]) / 1024.0
+    except OSError:
+        pass
+    return sizes["VmRSS"], sizes["VmHWM"]
+
+
+class _Burst:
+    """A single burst: a fake API server, the operator and the notebooks."""
+
+    def __init__(self, args: argparse.Namespace, size: int) -> None:
+        self._args = args
+        self.size = size
+        self._server = FakeApiServer(
+            args.latency_ms, args.conflict_rate, args.error_rate
+        )
+        self._runner: Optional[web.AppRunner] = None
+        self._operators: List[asyncio.subprocess.Process] = []
+        self._shards = 4 * args.replicas
+        for setting in args.env:
+            key, _, value = setting.partition("=")
+            if key == "JO_SHARDS":
+                self._shards = int(value)
+        self._base_url = f"http://127.0.0.1:{args.port}"
+        # When each notebook was created, and when it got its status
+        self.created: Dict[str, float] = {}
+        self.ready: Dict[str, float] = {}
+
+    async def run(self, work_dir: str) -> Dict[str, Any]:
+        """Runs the burst, returning its results."""
+        self._runner = web.AppRunner(self._server.app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, "127.0.0.1", self._args.port).start()
+        try:
+            for replica in range(self._args.replicas):
+                await self._start_operator(work_dir, replica)
+            async with aiohttp.ClientSession() as session:
+                await self._wait_for_operators()
+                calls_before = dict(self._server.calls)
+                watcher = asyncio.create_task(self._watch(session))
+                start = time.monotonic()
+                await self._create_notebooks(session)
+                try:
+                    await asyncio.wait_for(watcher, self._args.timeout)
+                except asyncio.TimeoutError:
+                    pass
+                duration = (max(self.ready.values()) if self.ready else start) - start
+            sizes = [_rss_mb(operator.pid) for operator in self._operators]
+            rss, peak_rss = (sum(size) for size in zip(*sizes))
+        finally:
+            await self._stop_operators()
+            self._server.close()
+            await self._runner.cleanup()
+
+        calls = {
+            call: count - calls_before.get(call, 0)
+            for call, count in self._server.calls.items()
+            if not call.startswith("WATCH")
+        }
+        # Discount our own notebook creations
+        calls["POST jupyternotebooks"] -= self.size
+        times = [ready - self.created[name] for name, ready in self.ready.items()]
+        return {
+            "replicas": self._args.replicas,
+            "notebooks": self.size,
+            "completed": len(self.ready),
+            "durationSeconds": round(duration, 3),
+            "createsPerSecond": (
+                round(len(self.ready) / duration, 2) if duration > 0 else math.nan
+            ),
+            "p50Seconds": round(_percentile(times, 50), 3),
+            "p99Seconds": round(_percentile(times, 99), 3),
+            "apiCallsPerNotebook": round(sum(calls.values()) / self.size, 2),
+            "apiCalls": {call: count for call, count in sorted(calls.items()) if count},
+            "rssMiB": round(rss, 1),
+            "peakRssMiB": round(peak_rss, 1),
+        }
+
+    async def _start_operator(self, work_dir: str, replica: int) -> None:
+        kubeconfig = os.path.join(work_dir, "kubeconfig")
+        with open(kubeconfig, "w", encoding="utf-8") as config_file:
+            config_file.write(_KUBECONFIG % {"port": self._args.port})
+        env = dict(os.environ)
+        env.update(
+            {
+                "KUBECONFIG": kubeconfig,
+                "INGRESS_DOMAIN": "example.com",
+                "JO_METRICS_PORT": "0",
+            }
+        )
+        if self._args.replicas > 1:
+            env.update(
+                {
+                    "JO_SHARDS": str(self._shards),
+                    "JO_SHARD_IDENTITY": f"replica-{replica}",
+                    "JO_SHARD_LEASE_NAMESPACE": _NAMESPACE,
+                }
+            )
+        for setting in self._args.env:
+            key, _, value = setting.partition("=")
+            env[key] = value
+        # pylint: disable=consider-using-with
+        log = open(os.path.join(work_dir, f"operator-{self.size}-{replica}.log"), "wb")
+        operator = await asyncio.create_subprocess_exec(
+            sys.executable,
+            "-m",
+            "kopf",
+            "run",
+            "handlers.py",
+            "--standalone",
+            "--all-namespaces",
+            cwd=_OPERATOR_DIR,
+            env=env,
+            stdout=log,
+            stderr=asyncio.subprocess.STDOUT,
+        )
+        log.close()
+        self._operators.append(operator)
+
+    def _operators_ready(self) -> bool:
+        """True if the operators are watching notebooks
+        and (if there are several) share all the shards.
+        """
+        if self._server.calls.get("WATCH jupyternotebooks", 0) < len(self._operators):
+            return False
+        if len(self._operators) == 1:
+            return True
+        leases = self._server.objects.get(("coordination.k8s.io", "v1", "leases"), {})
+        holders = [
+            lease["spec"].get("holderIdentity")
+            for (_, name), lease in leases.items()
+            if name.startswith("jupyter-operator-shard-")
+        ]
+        # Every shard is held and they are evenly shared
+        shares = [holders.count(holder) for holder in set(holders)]
+        return (
+            len(holders) == self._shards
+            and all(holders)
+            and len(shares) == len(self._operators)
+            and max(shares) - min(shares) <= 1
+        )
+
+    async def _wait_for_operators(self) -> None:
+        """Waits for the operators to watch notebooks (and share the shards)."""
+        deadline = time.monotonic() + 60
+        while not self._operators_ready():
+            if (
+                any(operator.returncode is not None for operator in self._operators)
+                or time.monotonic() > deadline
+            ):
+                raise RuntimeError("The operator failed to start")
+            await asyncio.sleep(0.1)
+        # Give any other (cache) watches a moment to start
+        await asyncio.sleep(1.0)
+
+    async def _stop_operators(self) -> None:
+        for operator in self._operators:
+            if operator.returncode is None:
+                operator.send_signal(signal.SIGINT)
+        for operator in self._operators:
+            try:
+                await asyncio.wait_for(operator.wait(), 30)
+            except asyncio.TimeoutError:
+                operator.kill()
+                await operator.wait()
+
+    async def _create_notebooks(self, session: aiohttp.ClientSession) -> None:
+        url = f"{self._base_url}/apis/squonk.it/v2/namespaces/{_NAMESPACE}/jupyternotebooks"
+        semaphore = asyncio.Semaphore(_CREATE_CONCURRENCY)
+
+        async def create(index: int) -> None:
+            async with semaphore:
+                body = _notebook(index)
+                self.created[body["metadata"]["name"]] = time.monotonic()
+                async with session.post(url, json=body) as response:
+                    response.raise_for_status()
+
+        await asyncio.gather(*(create(index) for index in range(self.size)))
+
+    async def _watch(self, session: aiohttp.ClientSession) -> None:
+        """Watches notebooks until they all have their status."""
+        url = f"{self._base_url}/apis/squonk.it/v2/jupyternotebooks"
+        params = {"watch": "true", "timeoutSeconds": str(self._args.timeout)}
+        async with session.get(url, params=params, timeout=None) as response:
+            async for line in response.content:
+                event = json.loads(line)
+                obj = event["object"]
+                name = obj["metadata"]["name"]
+                if name not in self.ready and (obj.get("status") or {}).get("jupyter"):
+                    self.ready[name] = time.monotonic()
+                    if len(self.ready) == self.size:
+                        return
+
+
+def _report(results: List[Dict[str, Any]]) -> None:
+    """Prints a table of the results."""
+    print(
+        f"{'Replicas':>8} {'Notebooks':>9} {'Done':>5} {'Creates/s':>9} {'p50 (s)':>8}"
+        f" {'p99 (s)':>8} {'Calls/NB':>8} {'RSS (MiB)':>9} {'Peak':>6}"
+    )
+    for result in results:
+        print(
+            f"{result['replicas']:>8} {result['notebooks']:>9}"
+            f" {result['completed']:>5}"
+            f" {result['createsPerSecond']:>9} {result['p50Seconds']:>8}"
+            f" {result['p99Seconds']:>8} {result['apiCallsPerNotebook']:>8}"
+            f" {result['rssMiB']:>9} {result['peakRssMiB']:>6}"
+        )
+
+
+async def _main(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    results: List[Dict[str, Any]] = []
+    with tempfile.TemporaryDirectory(prefix="jo-benchmark-") as work_dir:
+        if args.log_dir:
+            os.makedirs(args.log_dir, exist_ok=True)
+        for size in args.bursts:
+            results.append(await _Burst(args, size).run(args.log_dir or work_dir))
+    return results
+
+
+def main() -> None:
+    """Runs the benchmark."""
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--bursts",
+        type=lambda value: [int(size) for size in value.split(",")],
+        default=[10, 100, 1000],
+        help="The burst sizes (comma-separated)",
+    )
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument(
+        "--replicas",
+        type=int,
+        default=1,
+        help="The number of operators (sharing the notebooks)",
+    )
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--conflict-rate", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--timeout",
+        type=int,
+        default=600,
+        help="The time (seconds) allowed for each burst",
+    )
+    parser.add_argument(
+        "--env",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="An operator environment variable (repeatable)",
+    )
+    parser.add_argument("--log-dir", help="Where to keep the operator logs")
+    parser.add_argument("--json", action="store_true", help="Print JSON results")
+    args = parser.parse_args()
+    # Requests cut short by the operator stopping are expected
+    logging.getLogger("aiohttp.server").setLevel(logging.CRITICAL)
+
+    results = asyncio.run(_main(args))
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        _report(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,449 @@
+"""An admission queue for notebook launches.
+
+A burst of notebook creations (a class of students starting at once, say)
+can overwhelm the notebook nodes: every notebook Pod is created immediately,
+some cannot be scheduled and the rest compete for image pulls and CPU,
+so all of them are slow to become ready. With admission control
+the create handler waits for each notebook to be 'admitted' before creating it.
+
+A notebook is admitted when: -
+
+-   Fewer than the maximum number of notebooks are launching
+    (admitted but not yet ready)
+-   Optionally, a notebook node (one with the notebook node selector label)
+    has the unreserved capacity (its allocatable CPU and memory,
+    less the requests of the Pods on it) for the notebook's requests
+
+Waiting notebooks are admitted fairly between owners (the value of
+a notebook's '/owner' label). The owner with the fewest launching notebooks
+goes first and each owner's notebooks are admitted in the order they arrived.
+A notebook that has waited for the 'maximum wait' is admitted without regard
+to capacity (so, for example, a cluster autoscaler can add a node for its Pod).
+
+A launch ends when the notebook is ready (if readiness is tracked),
+when its objects have been created (if not) or after the launch timeout.
+"""
+
+import asyncio
+import collections
+import contextlib
+import datetime
+import json
+import logging
+import os
+import time
+from typing import Any, AsyncIterator, Deque, Dict, List, Optional, Set, Tuple
+
+import kubernetes
+from kubernetes.utils import parse_quantity
+
+import kube
+import metrics
+from readiness import ReadinessTracker
+
+# Control the admission (launch) of notebooks?
+# The maximum number of notebooks launching (created but not yet ready)
+# at any one time. Zero admits every notebook immediately.
+# A launch is no longer counted after the launch timeout (seconds).
+# Any 'check capacity' value also results in notebooks being admitted only
+# when a notebook node has the capacity for their requests (checked every
+# 'capacity interval'), or when they have waited for the maximum wait (seconds).
+MAX_LAUNCHES: int = int(os.environ.get("JO_MAX_CONCURRENT_LAUNCHES", "0"))
+_LAUNCH_TIMEOUT: int = int(os.environ.get("JO_ADMISSION_LAUNCH_TIMEOUT", "300"))
+_CHECK_CAPACITY: Optional[str] = os.environ.get("JO_ADMISSION_CHECK_CAPACITY")
+_CAPACITY_INTERVAL: int = int(os.environ.get("JO_ADMISSION_CAPACITY_INTERVAL", "15"))
+_MAX_WAIT: int = int(os.environ.get("JO_ADMISSION_MAX_WAIT", "600"))
+
+
+def _now() -> str:
+    """The current time, as a Kubernetes (RFC 3339) timestamp."""
+    return datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def _requests(containers: List[Dict[str, Any]]) -> Tuple[float, float]:
+    """The total CPU (cores) and memory (bytes) requests of a list of containers."""
+    cpu = 0.0
+    memory = 0.0
+    for container in containers:
+        requests = (container.get("resources") or {}).get("requests") or {}
+        cpu += float(parse_quantity(requests.get("cpu", "0")))
+        memory += float(parse_quantity(requests.get("memory", "0")))
+    return cpu, memory
+
+
+def _pod_requests(pod: Dict[str, Any]) -> Tuple[float, float]:
+    """The CPU and memory requests of a Pod. As the scheduler does,
+    we take the larger of the container total and each init container.
+    """
+    cpu, memory = _requests(pod["spec"].get("containers") or [])
+    for init_container in pod["spec"].get("initContainers") or []:
+        init_cpu, init_memory = _requests([init_container])
+        cpu = max(cpu, init_cpu)
+        memory = max(memory, init_memory)
+    return cpu, memory
+
+
+class _Waiter:
+    """A notebook waiting to be admitted."""
+
+    def __init__(
+        self, namespace: str, name: str, owner_name: str, cpu: float, memory: float
+    ) -> None:
+        self.namespace = namespace
+        self.name = name
+        self.owner = owner_name
+        self.cpu = cpu
+        self.memory = memory
+        self.queued: float = time.monotonic()
+        self.admitted: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+
+
+class _Launch:
+    """An admitted (launching) notebook."""
+
+    def __init__(self, owner_name: str, expiry: asyncio.TimerHandle) -> None:
+        self.owner = owner_name
+        self.expiry = expiry
+
+
+class _NodeCapacity:
+    """The unreserved capacity of the notebook nodes."""
+
+    def __init__(
+        self, api_client: kubernetes.client.ApiClient, node_selector: str
+    ) -> None:
+        self._core_api = kubernetes.client.CoreV1Api(api_client)
+        self._node_selector = node_selector
+        # The free CPU (cores) and memory (bytes) of each (ready) notebook node
+        self.free: Dict[str, Tuple[float, float]] = {}
+        # True once the capacity has been obtained
+        self.synced: bool = False
+        # The capacity reserved for admitted notebooks (by namespace and name)
+        # whose Pods are not yet on a node: the node, CPU, memory
+        # and when the reservation expires.
+        self._reservations: Dict[Tuple[str, str], Tuple[str, float, float, float]] = {}
+
+    async def refresh(self) -> None:
+        """Obtains the capacity of the notebook nodes, less the requests
+        of the Pods on them and the capacity reserved for admitted notebooks
+        whose Pods are not yet on a node.
+        """
+        response = await kube.call(
+            "list",
+            "Node",
+            self._core_api.list_node,
+            label_selector=self._node_selector,
+            _preload_content=False,
+        )
+        free: Dict[str, Tuple[float, float]] = {}
+        for node in json.loads(response.data)["items"]:
+            ready = any(
+                condition["type"] == "Ready" and condition["status"] == "True"
+                for condition in node["status"].get("conditions") or []
+            )
+            if not ready or node["spec"].get("unschedulable"):
+                continue
+            allocatable = node["status"]["allocatable"]
+            free[node["metadata"]["name"]] = (
+                float(parse_quantity(allocatable["cpu"])),
+                float(parse_quantity(allocatable["memory"])),
+            )
+
+        response = await kube.call(
+            "list",
+            "Pod",
+            self._core_api.list_pod_for_all_namespaces,
+            field_selector="status.phase!=Succeeded,status.phase!=Failed",
+            _preload_content=False,
+        )
+        # The notebooks (namespace and name) whose Pods are on a node
+        placed: Set[Tuple[str, str]] = set()
+        for pod in json.loads(response.data)["items"]:
+            node_name = pod["spec"].get("nodeName")
+            if node_name not in free:
+                continue
+            cpu, memory = _pod_requests(pod)
+            free_cpu, free_memory = free[node_name]
+            free[node_name] = (free_cpu - cpu, free_memory - memory)
+            notebook = (pod["metadata"].get("labels") or {}).get("deployment")
+            if notebook:
+                placed.add((pod["metadata"]["namespace"], notebook))
+
+        now = time.monotonic()
+        self._reservations = {
+            key: reservation
+            for key, reservation in self._reservations.items()
+            if key not in placed and reservation[3] > now
+        }
+        for node, cpu, memory, _ in self._reservations.values():
+            if node in free:
+                free_cpu, free_memory = free[node]
+                free[node] = (free_cpu - cpu, free_memory - memory)
+        self.free = free
+        self.synced = True
+
+    def fits(self, cpu: float, memory: float) -> Optional[str]:
+        """Returns the node with the most free memory that has the capacity
+        for the given requests (or None if there isn't one).
+        """
+        nodes = [
+            (free_memory, node)
+            for node, (free_cpu, free_memory) in self.free.items()
+            if free_cpu >= cpu and free_memory >= memory
+        ]
+        return max(nodes)[1] if nodes else None
+
+    def reserve(
+        self, key: Tuple[str, str], node: str, cpu: float, memory: float
+    ) -> None:
+        """Reserves node capacity for an admitted notebook,
+        until its Pod is on a node (or the launch timeout).
+        """
+        free_cpu, free_memory = self.free[node]
+        self.free[node] = (free_cpu - cpu, free_memory - memory)
+        self._reservations[key] = (
+            node,
+            cpu,
+            memory,
+            time.monotonic() + _LAUNCH_TIMEOUT,
+        )
+
+
+class AdmissionQueue:
+    """Admits notebook launches, limiting the number of concurrent launches
+    (and, optionally, checking node capacity).
+
+    All admission takes place in the event loop.
+    """
+
+    def __init__(
+        self,
+        api_client: kubernetes.client.ApiClient,
+        node_selector: str,
+        readiness: Optional[ReadinessTracker],
+    ) -> None:
+        """Creates the queue. The node selector identifies the notebook nodes
+        (whose capacity is checked, if required). If a readiness tracker
+        is provided, launches end when notebooks are ready.
+        """
+        self._api_client = api_client
+        self._capacity: Optional[_NodeCapacity] = (
+            _NodeCapacity(api_client, node_selector) if _CHECK_CAPACITY else None
+        )
+        self._release_on_ready = readiness is not None
+        if readiness:
+            readiness.on_ready(self.release)
+        self._loop = asyncio.get_running_loop()
+        # The waiting notebooks (by owner, in the order they arrived)
+        # and the launching notebooks (by namespace and name)
+        self._waiting: Dict[str, Deque[_Waiter]] = {}
+        self._launching: Dict[Tuple[str, str], _Launch] = {}
+        self._capacity_checker: Optional[asyncio.Task[None]] = None
+
+    def start(self) -> None:
+        """Starts checking node capacity (if required)."""
+        logging.info(
+            "Started admission queue (max_launches=%s check_capacity=%s)",
+            MAX_LAUNCHES,
+            self._capacity is not None,
+        )
+        if self._capacity:
+            self._capacity_checker = asyncio.create_task(
+                self._check_capacity(self._capacity)
+            )
+
+    def stop(self) -> None:
+        """Stops checking node capacity."""
+        if self._capacity_checker:
+            self._capacity_checker.cancel()
+
+    @contextlib.asynccontextmanager
+    async def launch(
+        self, namespace: str, name: str, owner_name: str, cpu: str, memory: str
+    ) -> AsyncIterator[None]:
+        """A context manager that waits for a notebook (with the given owner
+        and CPU and memory requests) to be admitted. The launch ends
+        when the context exits if the notebook is not tracked to readiness
+        (or if its creation fails).
+        """
+        await self._admit(
+            namespace,
+            name,
+            owner_name,
+            float(parse_quantity(cpu)),
+            float(parse_quantity(memory)),
+        )
+        try:
+            yield
+        except BaseException:
+            self.release(namespace, name)
+            raise
+        if not self._release_on_ready:
+            self.release(namespace, name)
+
+    def release(self, namespace: str, name: str) -> None:
+        """Ends a notebook's launch (if it's launching),
+        admitting waiting notebooks.
+        """
+        launch = self._launching.pop((namespace, name), None)
+        if launch is None:
+            return
+        launch.expiry.cancel()
+        metrics.ADMISSION_LAUNCHING.set(len(self._launching))
+        self._admit_waiting()
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns a summary of the queue (for the operator's probes)."""
+        stats: Dict[str, Any] = {
+            "launching": len(self._launching),
+            "waiting": {
+                owner_name: len(waiters)
+                for owner_name, waiters in self._waiting.items()
+            },
+        }
+        if self._capacity:
+            stats["capacitySynced"] = self._capacity.synced
+            stats["freeCapacity"] = {
+                node: {"cpu": round(cpu, 3), "memory": int(memory)}
+                for node, (cpu, memory) in self._capacity.free.items()
+            }
+        return stats
+
+    def _depth(self) -> int:
+        return sum(len(waiters) for waiters in self._waiting.values())
+
+    async def _admit(
+        self, namespace: str, name: str, owner_name: str, cpu: float, memory: float
+    ) -> None:
+        """Waits for a notebook to be admitted. A notebook that has to wait
+        has its queue depth, and then its wait, written to its status.
+        """
+        if (namespace, name) in self._launching:
+            # A retry (of the create handler) for an admitted notebook
+            return
+        waiter = _Waiter(namespace, name, owner_name, cpu, memory)
+        self._waiting.setdefault(owner_name, collections.deque()).append(waiter)
+        self._admit_waiting()
+        if waiter.admitted.done():
+            return
+
+        depth = self._depth()
+        logging.info(
+            "Queued %s (namespace=%s owner=%s depth=%s)",
+            name,
+            namespace,
+            owner_name,
+            depth,
+        )
+        try:
+            await self._patch_status(
+                namespace,
+                name,
+                {"state": "Queued", "queuedAt": _now(), "queueDepth": depth},
+            )
+            await waiter.admitted
+        except asyncio.CancelledError:
+            waiters = self._waiting.get(owner_name)
+            if waiters and waiter in waiters:
+                waiters.remove(waiter)
+                if not waiters:
+                    del self._waiting[owner_name]
+                metrics.ADMISSION_QUEUE_DEPTH.set(self._depth())
+            else:
+                self.release(namespace, name)
+            raise
+        wait = time.monotonic() - waiter.queued
+        logging.info("Admitted %s (namespace=%s wait=%.1f)", name, namespace, wait)
+        await self._patch_status(
+            namespace,
+            name,
+            {"state": "Admitted", "admittedAt": _now(), "waitSeconds": round(wait, 1)},
+        )
+
+    def _next(self) -> Optional[Tuple[_Waiter, Optional[str]]]:
+        """Returns the next notebook to admit (and the node whose capacity
+        it's reserving), or None if none can be admitted.
+        """
+        launching: Dict[str, int] = {}
+        for launch in self._launching.values():
+            launching[launch.owner] = launching.get(launch.owner, 0) + 1
+        heads = sorted(
+            (launching.get(owner_name, 0), waiters[0].queued, owner_name)
+            for owner_name, waiters in self._waiting.items()
+        )
+        for _, _, owner_name in heads:
+            waiter = self._waiting[owner_name][0]
+            if self._capacity is None or not self._capacity.synced:
+                return waiter, None
+            node = self._capacity.fits(waiter.cpu, waiter.memory)
+            if node or time.monotonic() - waiter.queued >= _MAX_WAIT:
+                return waiter, node
+        return None
+
+    def _admit_waiting(self) -> None:
+        """Admits waiting notebooks (while there's room to do so)."""
+        while len(self._launching) < MAX_LAUNCHES:
+            admission = self._next()
+            if admission is None:
+                break
+            waiter, node = admission
+            waiters = self._waiting[waiter.owner]
+            waiters.popleft()
+            if not waiters:
+                del self._waiting[waiter.owner]
+            key = (waiter.namespace, waiter.name)
+            if node and self._capacity:
+                self._capacity.reserve(key, node, waiter.cpu, waiter.memory)
+            self._launching[key] = _Launch(
+                waiter.owner,
+                self._loop.call_later(_LAUNCH_TIMEOUT, self._expire, key),
+            )
+            waiter.admitted.set_result(None)
+            metrics.ADMISSION_WAIT.observe(time.monotonic() - waiter.queued)
+        metrics.ADMISSION_QUEUE_DEPTH.set(self._depth())
+        metrics.ADMISSION_LAUNCHING.set(len(self._launching))
+
+    def _expire(self, key: Tuple[str, str]) -> None:
+        """Ends a launch that's taken longer than the launch timeout."""
+        if key in self._launching:
+            logging.warning(
+                "Launch of %s (namespace=%s) timed out (after %s seconds)",
+                key[1],
+                key[0],
+                _LAUNCH_TIMEOUT,
+            )
+            self.release(*key)
+
+    async def _patch_status(
+        self, namespace: str, name: str, admission: Dict[str, Any]
+    ) -> None:
+        """Writes a notebook's admission state to its status.
+        Failures are logged (they do not prevent the notebook's launch).
+        """
+        try:
+            await kube.patch_notebook_status(
+                self._api_client, namespace, name, {"admission": admission}
+            )
+        except kubernetes.client.exceptions.ApiException as ex:
+            logging.warning(
+                "Got ApiException [%s/%s] patching %s admission status",
+                ex.status,
+                ex.reason,
+                name,
+            )
+
+    async def _check_capacity(self, capacity: _NodeCapacity) -> None:
+        """A background task that periodically obtains the node capacity,
+        admitting any waiting notebooks that now fit (or have waited too long).
+        """
+        while True:
+            try:
+                await capacity.refresh()
+            except kubernetes.client.exceptions.ApiException as ex:
+                logging.warning(
+                    "Got ApiException [%s/%s] obtaining node capacity",
+                    ex.status,
+                    ex.reason,
+                )
+            self._admit_waiting()
+            await asyncio.sleep(_CAPACITY_INTERVAL)
@@ -0,0 +1,163 @@
+"""An in-memory cache of the (operator-owned) notebook child objects.
+
+The cache holds the ConfigMaps, Deployments, Services and Ingresses
+that belong to a JupyterNotebook, indexed by kind, namespace and name.
+It's kept up to date by an informer (a list-then-watch loop) for each kind
+(and, if the operator watches specific namespaces, each namespace).
+It only feeds the reconciler, which uses it to find missing objects
+(rather than listing them).
+"""
+
+import functools
+import logging
+import threading
+from typing import Any, Dict, List, Tuple
+
+import kubernetes
+
+from informer import Informer
+import kube
+
+# The kinds of object we cache
+KINDS: Tuple[str, ...] = ("ConfigMap", "Deployment", "Service", "Ingress")
+
+# The label selector used to watch the objects.
+# All objects created for a notebook have the operator's notebook label
+# (whose value is the notebook name). The objects' 'app' label is not used
+# as it's common to many other objects in a cluster.
+_LABEL_SELECTOR: str = kube.NOTEBOOK_LABEL
+# The kind of object that owns the objects we cache
+_OWNER_KIND: str = "JupyterNotebook"
+
+
+class ObjectCache:
+    """A cache of operator-owned objects, fed by label-selected watches.
+
+    Objects are held as dictionaries (the raw API response).
+    The cache can only be relied upon to say an object is absent once
+    the kind has been 'synced' (its initial listing has completed).
+    """
+
+    def __init__(
+        self,
+        api_client: kubernetes.client.ApiClient,
+        request_timeout: Tuple[int, int],
+    ) -> None:
+        core_api = kubernetes.client.CoreV1Api(api_client)
+        apps_api = kubernetes.client.AppsV1Api(api_client)
+        networking_api = kubernetes.client.NetworkingV1Api(api_client)
+        list_functions = {
+            "ConfigMap": kube.scoped(
+                core_api.list_config_map_for_all_namespaces,
+                core_api.list_namespaced_config_map,
+            ),
+            "Deployment": kube.scoped(
+                apps_api.list_deployment_for_all_namespaces,
+                apps_api.list_namespaced_deployment,
+            ),
+            "Service": kube.scoped(
+                core_api.list_service_for_all_namespaces,
+                core_api.list_namespaced_service,
+            ),
+            "Ingress": kube.scoped(
+                networking_api.list_ingress_for_all_namespaces,
+                networking_api.list_namespaced_ingress,
+            ),
+        }
+
+        self._lock = threading.Lock()
+        self._objects: Dict[str, Dict[Tuple[str, str], Dict[str, Any]]] = {
+            kind: {} for kind in KINDS
+        }
+        # The informers, by kind and namespace
+        self._informers: Dict[Tuple[str, str], Informer] = {
+            (kind, namespace): Informer(
+                kind,
+                list_function,
+                _LABEL_SELECTOR,
+                request_timeout,
+                on_list=functools.partial(self._replace, kind, namespace),
+                on_event=functools.partial(self._store, kind),
+            )
+            for kind in KINDS
+            for namespace, list_function in list_functions[kind].items()
+        }
+
+    def start(self) -> None:
+        """Starts the watches."""
+        for informer in self._informers.values():
+            informer.start()
+
+    def stop(self) -> None:
+        """Stops the watches."""
+        for informer in self._informers.values():
+            informer.stop()
+
+    def synced(self, kind: str) -> bool:
+        """True if the initial listing of the kind has completed,
+        i.e. the cache knows about all the existing objects.
+        """
+        return all(
+            informer.synced
+            for (informer_kind, _), informer in self._informers.items()
+            if informer_kind == kind
+        )
+
+    def items(self, kind: str) -> List[Dict[str, Any]]:
+        """Returns all the cached objects of a kind."""
+        with self._lock:
+            return list(self._objects[kind].values())
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns a summary of the cache (for the operator's probes)."""
+        with self._lock:
+            sizes = {kind: len(objects) for kind, objects in self._objects.items()}
+        return {
+            "synced": {kind: self.synced(kind) for kind in KINDS},
+            "objects": sizes,
+            "watchRestarts": {
+                kind: sum(
+                    informer.restarts
+                    for (informer_kind, _), informer in self._informers.items()
+                    if informer_kind == kind
+                )
+                for kind in KINDS
+            },
+        }
+
+    @staticmethod
+    def _owned(obj: Dict[str, Any]) -> bool:
+        owners = obj["metadata"].get("ownerReferences") or []
+        return any(owner.get("kind") == _OWNER_KIND for owner in owners)
+
+    def _replace(self, kind: str, namespace: str, items: List[Dict[str, Any]]) -> None:
+        """Replaces the cached objects of a kind in a namespace
+        (or all namespaces if it's '') after a listing.
+        """
+        objects = {
+            (obj["metadata"]["namespace"], obj["metadata"]["name"]): obj
+            for obj in items
+            if self._owned(obj)
+        }
+        with self._lock:
+            if namespace:
+                objects.update(
+                    (key, obj)
+                    for key, obj in self._objects[kind].items()
+                    if key[0] != namespace
+                )
+            self._objects[kind] = objects
+        logging.info(
+            "Cached %s objects (%s) namespace=%s", kind, len(objects), namespace or "*"
+        )
+
+    def _store(self, kind: str, event_type: str, obj: Dict[str, Any]) -> None:
+        if not self._owned(obj):
+            return
+        metadata = obj["metadata"]
+        key = (metadata["namespace"], metadata["name"])
+        with self._lock:
+            if event_type == "DELETED":
+                self._objects[kind].pop(key, None)
+            else:
+                self._objects[kind][key] = obj
@@ -0,0 +1,165 @@
+"""Idle notebook culling (scaling to zero) and resumption.
+
+A notebook's activity is obtained from its Jupyter server's status API
+(using the notebook's token), which reports the time of its last activity
+(API requests and kernel activity). A timer checks each notebook and
+scales the Deployment of an idle one to zero. Changing a notebook's
+resume annotation scales it back to one.
+
+The handlers here are registered by importing this module
+(as the operator's 'handlers' module does).
+"""
+
+import datetime
+import logging
+import os
+from typing import Any, Optional
+
+import aiohttp
+import kopf
+import kubernetes
+
+import kube
+import metrics
+import sharding
+
+# Cull (scale to zero) idle notebooks?
+# Notebooks whose Jupyter server has not been active for the idle timeout
+# (seconds) have their Deployment scaled to zero. Zero disables culling.
+# The activity of each notebook is checked every 'check interval' (seconds).
+# A culled notebook is resumed (with the same token) by setting (or changing)
+# its resume annotation.
+IDLE_TIMEOUT: int = int(os.environ.get("JO_IDLE_TIMEOUT", "0"))
+_IDLE_CHECK_INTERVAL: int = int(os.environ.get("JO_IDLE_CHECK_INTERVAL", "300"))
+_RESUME_ANNOTATION: str = "squonk.it/jupyter-resume"
+
+# The Jupyter status API of a notebook (through its Service)
+_STATUS_URL: str = "http://{name}.{namespace}.svc:8888/{name}/api/status"
+
+
+async def idle_seconds(
+    session: aiohttp.ClientSession, name: str, namespace: str, token: str
+) -> Optional[float]:
+    """Returns the time (seconds) since the notebook was last active,
+    or None if its activity cannot be obtained (it may not be running).
+    """
+    url = _STATUS_URL.format(name=name, namespace=namespace)
+    try:
+        async with session.get(
+            url, headers={"Authorization": f"token {token}"}
+        ) as response:
+            response.raise_for_status()
+            status = await response.json()
+    except (aiohttp.ClientError, TimeoutError, ValueError) as ex:
+        logging.debug("Failed to get status of %s (%s)", name, ex)
+        return None
+    last_activity = datetime.datetime.fromisoformat(
+        status["last_activity"].replace("Z", "+00:00")
+    )
+    idle = datetime.datetime.now(datetime.timezone.utc) - last_activity
+    return max(0.0, idle.total_seconds())
+
+
+def _now() -> str:
+    """The current time, as a Kubernetes (RFC 3339) timestamp."""
+    return datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+async def _scale(memo: kopf.Memo, name: str, namespace: str, replicas: int) -> None:
+    """Scales a notebook's Deployment."""
+    apps_api = kubernetes.client.AppsV1Api(memo.api_client)
+    await kube.call(
+        "patch",
+        "Deployment",
+        apps_api.patch_namespaced_deployment,
+        name,
+        namespace,
+        {"spec": {"replicas": replicas}},
+    )
+
+
+def _culling_enabled(**_: Any) -> bool:
+    return IDLE_TIMEOUT > 0
+
+
+@kopf.timer(
+    "squonk.it",
+    "v2",
+    "jupyternotebooks",
+    id="culler",
+    interval=_IDLE_CHECK_INTERVAL,
+    when=kopf.all_([_culling_enabled, sharding.owned]),
+)
+async def cull(
+    name: str,
+    namespace: str,
+    status: kopf.Status,
+    memo: kopf.Memo,
+    patch: kopf.Patch,
+    **_: Any,
+) -> None:
+    """Timer for notebooks (if culling is enabled).
+    Here we scale the Deployment of an idle notebook to zero,
+    recording that in its status.
+    """
+    culling = status.get("culling", {})
+    if culling.get("state") == "Culled":
+        return
+    # A resumed notebook has (at least) the idle timeout before it's culled again
+    resumed_at = culling.get("resumedAt")
+    if resumed_at:
+        resumed = datetime.datetime.fromisoformat(resumed_at.replace("Z", "+00:00"))
+        since_resumed = datetime.datetime.now(datetime.timezone.utc) - resumed
+        if since_resumed.total_seconds() < IDLE_TIMEOUT:
+            return
+    token = status.get("jupyter", {}).get("notebook", {}).get("token")
+    if not token:
+        return
+    idle = await idle_seconds(memo.culler_session, name, namespace, token)
+    if idle is None or idle < IDLE_TIMEOUT:
+        return
+
+    logging.info("Culling %s (namespace=%s idle=%.0f)", name, namespace, idle)
+    await _scale(memo, name, namespace, 0)
+    patch.status["culling"] = {
+        "state": "Culled",
+        "culledAt": _now(),
+        "idleSeconds": round(idle),
+        "resumedAt": None,
+    }
+    metrics.NOTEBOOKS_CULLED.inc()
+
+
+@kopf.on.field(
+    "squonk.it",
+    "v2",
+    "jupyternotebooks",
+    id="resume",
+    field=("metadata", "annotations", _RESUME_ANNOTATION),
+    when=sharding.owned,
+)
+async def resume_culled(
+    name: str,
+    namespace: str,
+    new: Optional[str],
+    status: kopf.Status,
+    memo: kopf.Memo,
+    patch: kopf.Patch,
+    **_: Any,
+) -> None:
+    """Handler for changes to the resume annotation.
+    Here we scale the Deployment of a culled notebook back to one.
+    Its ConfigMaps (and token) are unchanged.
+    """
+    if not new or status.get("culling", {}).get("state") != "Culled":
+        return
+
+    logging.info("Resuming %s (namespace=%s)", name, namespace)
+    await _scale(memo, name, namespace, 1)
+    patch.status["culling"] = {
+        "state": "Running",
+        "culledAt": None,
+        "idleSeconds": None,
+        "resumedAt": _now(),
+    }
+    metrics.NOTEBOOKS_RESUMED.inc()
@@ -1,2 +1,12 @@
 #!/usr/bin/env bash
-kopf run ./handlers.py --standalone --all-namespaces --log-format full ${KOPF_EXTRA_OPTIONS}
+
+# Watch the (colon-separated) JO_NAMESPACES, or all namespaces
+NAMESPACE_OPTIONS="--all-namespaces"
+if [ -n "${JO_NAMESPACES}" ]; then
+  NAMESPACE_OPTIONS=""
+  for NAMESPACE in ${JO_NAMESPACES//:/ }; do
+    NAMESPACE_OPTIONS="${NAMESPACE_OPTIONS} --namespace ${NAMESPACE}"
+  done
+fi
+
+kopf run ./handlers.py --standalone ${NAMESPACE_OPTIONS} --log-format full ${KOPF_EXTRA_OPTIONS}
@@ -1,124 +1,88 @@
 """A kopf handler for the Jupyter CRD."""
 
+import asyncio
+import contextlib
 import json
 import logging
 import random
 import os
 import string
-from typing import Any, Dict, Optional
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterator, List, Optional
 
+import aiohttp
 import kubernetes
 import kopf
 
-# Configuration of underlying API requests.
-#
-# Request timeout (from Python Kubernetes API)
-#   If one number provided, it will be total request
-#   timeout. It can also be a pair (tuple) of
-#   (connection, read) timeouts.
-_REQUEST_TIMEOUT = (30, 20)
-
-# Some (key) default deployment variables...
-_DEFAULT_IMAGE: str = "jupyter/minimal-notebook:notebook-6.3.0"
-_DEFAULT_SA: str = "default"
-_DEFAULT_CPU_LIMIT: str = "1"
-_DEFAULT_CPU_REQUEST: str = "10m"
-_DEFAULT_MEM_LIMIT: str = "1Gi"
-_DEFAULT_MEM_REQUEST: str = "256Mi"
-_DEFAULT_USER_ID: int = 1000
-_DEFAULT_GROUP_ID: int = 100
-_DEFAULT_INGRESS_PROXY_BODY_SIZE: str = "500m"
-# The default ingress domain (must be provided).
-# The user can provide an alternative via the CR.
-_DEFAULT_INGRESS_DOMAIN: str = os.environ["INGRESS_DOMAIN"]
-# The ingress TLS secret.
-# If provided it is used as the Ingress secret
-# and cert-manager is avoided.
-# The uer can provide their own via the CR.
-_DEFAULT_INGRESS_TLS_SECRET: Optional[str] = os.environ.get("INGRESS_TLS_SECRET")
-# The ingress class
-_DEFAULT_INGRESS_CLASS: str = "nginx"
-
-# Apply Pod Priority class?
-# Any value results in setting the Pod's Priority Class
-_APPLY_POD_PRIORITY_CLASS: Optional[str] = os.environ.get("JO_APPLY_POD_PRIORITY_CLASS")
-# If set and JO_APPLY_POD_PRIORITY_CLASS is set
-# this value will be used if now alternative is available.
-_DEFAULT_POD_PRIORITY_CLASS: str = os.environ.get(
-    "JO_DEFAULT_POD_PRIORITY_CLASS", "im-application-low"
+import admission
+from admission import AdmissionQueue
+from cache import ObjectCache
+import culler
+import kube
+import manifests
+import metrics
+import notebook_spec
+from notebook_spec import NotebookSpec
+import package_cache
+import pod_events
+from pod_events import PodEventReporter
+import prepull
+from prepull import ImagePrePuller
+import readiness
+from readiness import ReadinessTracker
+import reconcile
+from reconcile import Reconciler
+import resize  # pylint: disable=unused-import
+import rightsizing
+from rightsizing import Recommender
+import routing
+from routing import IngressRouter
+import sharding
+from sharding import OwnedDiffBaseStorage, ShardLeases
+import static_config
+from warm_pool import WarmPool
+
+# The port of the (Prometheus) metrics endpoint.
+# Zero disables the endpoint.
+_METRICS_PORT: int = int(os.environ.get("JO_METRICS_PORT", "8080"))
+
+# Use a (watch-fed) cache of the objects we create?
+# Any value results in the operator caching the notebook ConfigMaps,
+# Deployments, Services and Ingresses so that the reconciler can find
+# missing objects without listing them.
+_OBJECT_CACHE: Optional[str] = os.environ.get("JO_OBJECT_CACHE")
+
+# A warm pool of standby Pods?
+# A JSON list of the pool classes, each an 'image', and optional 'cpu'
+# and 'memory' requests (defaulting to the notebook defaults) and 'size'.
+# e.g. '[{"image": "jupyter/minimal-notebook:notebook-6.3.0", "size": 2}]'.
+# Standby Pods run in the given namespace and, at most, 'refill rate'
+# are created (for each class) every 'refill interval' (seconds).
+# Classes without demand for the 'idle expiry' period (seconds) are emptied.
+_WARM_POOL: List[Dict[str, Any]] = json.loads(os.environ.get("JO_WARM_POOL", "[]"))
+_WARM_POOL_NAMESPACE: str = os.environ.get("JO_WARM_POOL_NAMESPACE", "jupyter")
+_WARM_POOL_REFILL_INTERVAL: int = int(
+    os.environ.get("JO_WARM_POOL_REFILL_INTERVAL", "30")
 )
+_WARM_POOL_REFILL_RATE: int = int(os.environ.get("JO_WARM_POOL_REFILL_RATE", "2"))
+_WARM_POOL_IDLE_EXPIRY: int = int(os.environ.get("JO_WARM_POOL_IDLE_EXPIRY", "3600"))
 
 
-# The cert-manager issuer,
-# expected if a INGRESS_TLS_SECRET is not defined.
-ingress_cert_issuer: Optional[str] = os.environ.get("INGRESS_CERT_ISSUER")
-
-# Application node selection
-_POD_NODE_SELECTOR_KEY: str = os.environ.get(
-    "JO_POD_NODE_SELECTOR_KEY", "informaticsmatters.com/purpose-application"
-)
-_POD_NODE_SELECTOR_VALUE: str = os.environ.get("JO_POD_NODE_SELECTOR_VALUE", "yes")
-
-# A custom startup script, executed as the container "command".
-#
-# It writes a new a .bashrc, copies the .bash_profile and jupyter_notebook_config.json
-# files into place and then copies the file tree from /home/code/copy-to-home
-# to the user's home directory before running 'jupyter lab'.
-#
-# Working directory is the Project directory,
-# and HOME is the project instance directory
-# (where the bash and bash_profile files are written)
-#
-# As part of the startup we erase the existing '~/.bashrc' and,
-# as a minimum, set a more suitable PS1 (see ch2385).
-# 'conda init' then puts its stuff into the same file.
-_NOTEBOOK_STARTUP: str = r"""#!/bin/bash
-echo "PS1='\$(pwd) \$UID$ '" > ~/.bashrc
-echo "umask 0002" >> ~/.bashrc
-conda init
-source ~/.bashrc
-
-if [ ! -f ~/.bash_profile ]; then
-    echo "Copying bash_profile into place"
-    cp /etc/.bash_profile ~
-fi
-
-if [ ! -f ~/jupyter_notebook_config.json ]; then
-    echo "Copying config into place"
-    cp /etc/jupyter_notebook_config.json ~
-fi
-
-if [ -d /home/code/copy-to-startup ]; then
-    echo "Copying copy-to-startup content"
-    cp -r -u /home/code/copy-to-startup/* ~/..
-fi
-
-jupyter lab --config=~/jupyter_notebook_config.json
-"""
-
-# The bash-profile
-# which simply launches the .bashrc
-_BASH_PROFILE: str = """if [ -f ~/.bashrc ]; then
-    source ~/.bashrc
-fi
-"""
-
-# The Jupyter jupyter_notebook_config.json file.
-# A ConfigMap whose content is written into '/etc'
-# and copied to the $HOME/.jupyter by the notebook_startup
-# script (above).
-_NOTEBOOK_CONFIG: str = """{
-  "ServerApp": {
-    "token": "%(token)s",
-    "base_url": "%(base_url)s",
-    "ip": "0.0.0.0"
-  }
-}
-"""
+@contextlib.contextmanager
+def _phase_timer(name: str, phase: str) -> Iterator[None]:
+    """A context manager used to measure (and log) the time taken
+    by each phase of the create handler.
+    """
+    start = time.monotonic()
+    yield
+    duration = time.monotonic() - start
+    metrics.CREATE_PHASE_DURATION.labels(phase).observe(duration)
+    logging.info("Phase %s for %s took %.3f seconds", phase, name, duration)
 
 
 @kopf.on.startup()
-def configure(settings: kopf.OperatorSettings, **_: Any) -> None:
+async def configure(settings: kopf.OperatorSettings, memo: kopf.Memo, **_: Any) -> None:
     """The operator startup handler."""
     # Here we adjust the logging level
     settings.posting.level = logging.INFO
@@ -126,446 +90,548 @@ def configure(settings: kopf.OperatorSettings, **_: Any) -> None:
     # Attempt to protect ourselves from missing watch events.
     # See https://github.com/nolar/kopf/issues/698
     # Added in an attempt to prevent the operator "falling silent"
-    settings.watching.server_timeout = 120
-    settings.watching.client_timeout = 150
-
-
-@kopf.on.create("squonk.it", "v1alpha3", "jupyternotebooks", id="jupyter")
-def create_v1alpha3(
-    spec: Dict[str, Any], name: str, namespace: str, **_: Any
-) -> Dict[str, Any]:
-    """Handler for legacy CRD create events."""
-    raise kopf.PermanentError("No longer supported")
-
-
-# For TEMPORARY errors (i.e. those that are not kopf.PermanentError)
-# we retry after 20 seconds and only retry 6 times
-@kopf.on.create(
-    "squonk.it", "v2", "jupyternotebooks", id="jupyter", backoff=20, retries=6
-)
-def create(spec: Dict[str, Any], name: str, namespace: str, **_: Any) -> Dict[str, Any]:
-    """Handler for CRD create events.
-    Here we construct the required Kubernetes objects,
-    adopting them in kopf before using the corresponding Kubernetes API
-    to create them.
-
-    We handle errors typically raising 'kopf.PermanentError' to prevent
-    Kubernetes constantly calling back for a given create.
-    """
-
-    logging.info("Creating %s (namespace=%s)...", name, namespace)
-    logging.info("Incoming %s spec=%s", name, spec)
-
-    # All Data-Manager provided material
-    # will be namespaced under the 'imDataManager' property
-    material: Dict[str, Any] = spec.get("imDataManager", {})
-
-    notebook_interface = material.get("notebook", {}).get("interface", "lab")
-
-    image = material.get("image", _DEFAULT_IMAGE)
-    image_parts = image.split(":")
-    image_tag = "latest" if len(image_parts) == 1 else image_parts[1]
-    image_pull_policy = (
-        "Always" if image_tag.lower() in ["latest", "stable"] else "IfNotPresent"
-    )
-
-    service_account = material.get("serviceAccountName", _DEFAULT_SA)
-
-    resources = material.get("resources", {})
-    cpu_limit = resources.get("limits", {}).get("cpu", _DEFAULT_CPU_LIMIT)
-    cpu_request = resources.get("requests", {}).get("cpu", _DEFAULT_CPU_REQUEST)
-    memory_limit = resources.get("limits", {}).get("memory", _DEFAULT_MEM_LIMIT)
-    memory_request = resources.get("requests", {}).get("memory", _DEFAULT_MEM_REQUEST)
-
-    # Data Manager API compliance.
-    #
-    # The user and group IDs we're asked to run as.
-    # The files in the container project volume will be owned
-    # by this user and group. We must run as group 100.
-    # We use the supplied group ID and pass that into the container
-    # as the Kubernetes 'File System Group' (fsGroup).
-    # This should allow us to run and manipulate the files.
-    sc_run_as_user = material.get("securityContext", {}).get(
-        "runAsUser", _DEFAULT_USER_ID
+    # (the time since the last notebook event and the event lag
+    # are recorded as metrics by our 'watch' event handler).
+    settings.watching.server_timeout = kube.WATCH_SERVER_TIMEOUT
+    settings.watching.client_timeout = kube.WATCH_CLIENT_TIMEOUT
+
+    # Create the shared Kubernetes API client
+    # (closed in our cleanup handler).
+    # API calls are run in threads from the event loop's default executor,
+    # which we size to match the client's connection pool.
+    memo.api_client = kube.new_api_client()
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=kube.API_POOL_MAXSIZE)
     )
-    sc_run_as_group = material.get("securityContext", {}).get(
-        "runAsGroup", _DEFAULT_GROUP_ID
+    logging.info(
+        "Created API client (pool_maxsize=%s keepalive=%s request_timeout=%s)",
+        kube.API_POOL_MAXSIZE,
+        kube.API_KEEPALIVE_SECONDS,
+        kube.REQUEST_TIMEOUT,
     )
 
-    # Project storage
-    project_claim_name = material.get("project", {}).get("claimName")
-    project_id = material.get("project", {}).get("id")
+    if _METRICS_PORT:
+        metrics.serve(_METRICS_PORT)
+        logging.info("Serving metrics (port=%s)", _METRICS_PORT)
 
-    ingress_proxy_body_size = material.get(
-        "ingressProxyBodySize", _DEFAULT_INGRESS_PROXY_BODY_SIZE
-    )
+    # The HTTP session used to check notebook activity
+    if culler.IDLE_TIMEOUT:
+        memo.culler_session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=kube.REQUEST_TIMEOUT[1])
+        )
+        metrics.IDLE_TIMEOUT.set(culler.IDLE_TIMEOUT)
+        logging.info("Culling notebooks idle for %s seconds", culler.IDLE_TIMEOUT)
+
+    # The notebook shards we hold (if we're sharing notebooks with other replicas).
+    # Only the leader maintains the operator-wide objects (the warm pool etc.).
+    leader: Optional[Callable[[], bool]] = None
+    if sharding.SHARDS:
+        memo.shards = ShardLeases(memo.api_client)
+        memo.shards.start()
+        leader = memo.shards.leader
+        settings.persistence.diffbase_storage = OwnedDiffBaseStorage(memo.shards.owns)
+
+    # The cache of the objects we create
+    if _OBJECT_CACHE:
+        memo.object_cache = ObjectCache(memo.api_client, kube.REQUEST_TIMEOUT)
+        memo.object_cache.start()
+
+    # The tracker of notebook readiness
+    if readiness.TRACK_READINESS:
+        memo.readiness = ReadinessTracker(
+            memo.api_client,
+            kube.REQUEST_TIMEOUT,
+            readiness.TIMEOUT,
+            startup_steps=bool(static_config.INCREMENTAL_STARTUP),
+        )
+        memo.readiness.start()
+
+    # The reporter of notebook Pod state (and problems),
+    # which shares the readiness tracker's Pod watch (if there is one).
+    if pod_events.POD_EVENTS:
+        readiness_tracker: Optional[ReadinessTracker] = memo.get("readiness")
+        memo.pod_events = PodEventReporter(
+            memo.api_client,
+            kube.REQUEST_TIMEOUT,
+            pod_events.PATCH_RATE,
+            pod_events.WINDOW,
+            watch=readiness_tracker is None,
+            owns=memo.shards.owns if sharding.SHARDS else None,
+        )
+        if readiness_tracker:
+            readiness_tracker.add_pod_listener(
+                memo.pod_events.observe_all, memo.pod_events.observe
+            )
+        memo.pod_events.start()
+        logging.info(
+            "Reporting notebook Pod state (patch_rate=%s window=%s)",
+            pod_events.PATCH_RATE,
+            pod_events.WINDOW,
+        )
 
-    ingress_class = material.get("ingressClass", _DEFAULT_INGRESS_CLASS)
-    ingress_domain = material.get("ingressDomain", _DEFAULT_INGRESS_DOMAIN)
-    ingress_tls_secret = material.get("ingressTlsSecret", _DEFAULT_INGRESS_TLS_SECRET)
-    ingress_path = f"/{name}"
-
-    # ConfigMaps
-    # ----------
-
-    core_api = kubernetes.client.CoreV1Api()
-
-    # We might be here as another attempt to create the same application
-    # (an exception may have caused a prior execution to fail).
-    # The operator is configured to re-try on such occasions
-    # (with a period based on out 'backoff' value set in our decorator).
-    # Here, we need to check for the existence of the 'config' ConfigMap.
-    # If it exists, we read it and get the token we had previously set.
-    # If there is no ConfigMap (404) we are free to set a new token.
-    cm_name = f"config-{name}"
-    json_data_key = "jupyter_notebook_config.json"
-    token = ""
-    config_cm = None
-    try:
-        config_cm = core_api.read_namespaced_config_map(cm_name, namespace)
-    except kubernetes.client.exceptions.ApiException as ex:
-        # We 'expect' 404, anything else is an error
-        if ex.status != 404:
-            logging.error(
-                "Got ApiException [%s/%s] getting existing CONFIG ConfigMap %s",
-                ex.status,
-                ex.reason,
-                cm_name,
+    # The warm pool (of standby Pods).
+    # Standby Pods are placed (and prioritised) like notebook Pods.
+    if _WARM_POOL:
+        standby_pod_template: Dict[str, Any] = {
+            "nodeSelector": {
+                manifests.POD_NODE_SELECTOR_KEY: manifests.POD_NODE_SELECTOR_VALUE
+            }
+        }
+        if manifests.APPLY_POD_PRIORITY_CLASS:
+            standby_pod_template["priorityClassName"] = (
+                manifests.DEFAULT_POD_PRIORITY_CLASS
             )
-            raise ex
-    if config_cm:
-        # We retrieved an existing CONFIG - extract the token from it
-        json_data = json.loads(config_cm.data[json_data_key])
-        token = json_data["ServerApp"]["token"]
-        logging.debug(
-            "Retrieved prior token from CONFIG ConfigMap %s (%s)",
-            cm_name,
-            token,
+        memo.warm_pool = WarmPool(
+            memo.api_client,
+            kube.REQUEST_TIMEOUT,
+            _WARM_POOL_NAMESPACE,
+            [
+                {
+                    "image": pool_class["image"],
+                    "cpu": pool_class.get("cpu", notebook_spec.DEFAULT_CPU_REQUEST),
+                    "memory": pool_class.get(
+                        "memory", notebook_spec.DEFAULT_MEM_REQUEST
+                    ),
+                    "size": pool_class.get("size", 1),
+                }
+                for pool_class in _WARM_POOL
+            ],
+            standby_pod_template,
         )
-    else:
-        # No prior config - we're free to allocate a new token
-        characters = string.ascii_letters + string.digits
-        token = "".join(random.sample(characters, 16))
-        logging.debug(
-            "No prior CONFIG ConfigMap exists for %s, assigning new token (%s)",
-            cm_name,
-            token,
+        memo.warm_pool.start(
+            _WARM_POOL_REFILL_INTERVAL,
+            _WARM_POOL_REFILL_RATE,
+            _WARM_POOL_IDLE_EXPIRY,
+            leader,
         )
-    assert token
-
-    logging.info("Creating ConfigMaps %s...", name)
-
-    # We must handle (and ignore) 409 exceptions with the objects we create
-    # (with the reason 'Conflict'). This is interpreted as 'the object already exists'.
-    # At this point we do know whether the 'config' ConfigMap exists,
-    # so we don't need to create that again...
-
-    config_vars = {"token": token, "base_url": name}
-    config_cm_body = {
-        "apiVersion": "v1",
-        "kind": "ConfigMap",
-        "metadata": {"name": cm_name, "labels": {"app": name}},
-        "data": {json_data_key: _NOTEBOOK_CONFIG % config_vars},
-    }
-    kopf.adopt(config_cm_body)
-    if not config_cm:
-        # We create it because we know it does not exists.
-        # No exception handling - any exceptions just get passed up to kopf...
-        core_api.create_namespaced_config_map(
-            namespace, config_cm_body, _request_timeout=_REQUEST_TIMEOUT
+        logging.info("Started warm pool (namespace=%s)", _WARM_POOL_NAMESPACE)
+
+    # The image pre-puller.
+    # Its DaemonSet Pods run on the notebook nodes.
+    if prepull.PREPULL:
+        memo.prepuller = ImagePrePuller(
+            memo.api_client,
+            prepull.NAMESPACE,
+            prepull.MAX_IMAGES,
+            prepull.HALF_LIFE,
+            {
+                "nodeSelector": {
+                    manifests.POD_NODE_SELECTOR_KEY: manifests.POD_NODE_SELECTOR_VALUE
+                }
+            },
+            prepull.PAUSE_IMAGE,
         )
-        logging.debug("Created CONFIG ConfigMap %s", cm_name)
-
-    cm_name = f"bp-{name}"
-    bp_cm_body = {
-        "apiVersion": "v1",
-        "kind": "ConfigMap",
-        "metadata": {"name": cm_name, "labels": {"app": name}},
-        "data": {".bash_profile": _BASH_PROFILE},
-    }
-    kopf.adopt(bp_cm_body)
-    try:
-        core_api.create_namespaced_config_map(
-            namespace, bp_cm_body, _request_timeout=_REQUEST_TIMEOUT
+        memo.prepuller.start(prepull.INTERVAL, prepull.REFRESH_INTERVAL, leader)
+        logging.info("Started image pre-puller (namespace=%s)", prepull.NAMESPACE)
+
+    # The janitor (DaemonSet) of the node-local package cache.
+    # Its Pods run on the notebook nodes.
+    if package_cache.PACKAGE_CACHE and not package_cache.CLAIM:
+        memo.package_cache_janitor = asyncio.create_task(
+            package_cache.maintain(
+                memo.api_client,
+                {
+                    "nodeSelector": {
+                        manifests.POD_NODE_SELECTOR_KEY: manifests.POD_NODE_SELECTOR_VALUE
+                    }
+                },
+                leader,
+            )
         )
-        logging.debug("Created BP ConfigMap %s", cm_name)
-    except kubernetes.client.exceptions.ApiException as ex:
-        if ex.status != 409 or ex.reason != "Conflict":
-            raise ex
-        # Warn, but ignore and return a valid 'create' response now.
-        logging.debug(
-            "Got 409/Conflict creating BP ConfigMap %s. Ignoring - object already present",
-            cm_name,
+        logging.info(
+            "Using node-local package cache %s (size=%sMiB)",
+            package_cache.HOST_PATH,
+            package_cache.SIZE,
         )
 
-    cm_name = f"startup-{name}"
-    startup_cm_body = {
-        "apiVersion": "v1",
-        "kind": "ConfigMap",
-        "metadata": {"name": cm_name, "labels": {"app": name}},
-        "data": {"start.sh": _NOTEBOOK_STARTUP},
-    }
-    kopf.adopt(startup_cm_body)
-    try:
-        core_api.create_namespaced_config_map(
-            namespace, startup_cm_body, _request_timeout=_REQUEST_TIMEOUT
+    # The admission queue (for notebook launches).
+    # Launches end when notebooks are ready (if we're tracking readiness).
+    if admission.MAX_LAUNCHES:
+        memo.admission = AdmissionQueue(
+            memo.api_client,
+            f"{manifests.POD_NODE_SELECTOR_KEY}={manifests.POD_NODE_SELECTOR_VALUE}",
+            memo.get("readiness"),
         )
-        logging.debug("Created STARTUP ConfigMap %s", cm_name)
-    except kubernetes.client.exceptions.ApiException as ex:
-        if ex.status != 409 or ex.reason != "Conflict":
-            raise ex
-        # Warn, but ignore and return a valid 'create' response now.
-        logging.debug(
-            "Got 409/Conflict creating STARTUP ConfigMap %s. Ignoring - object already present",
-            cm_name,
+        memo.admission.start()
+
+    # The namespaces we know to have the shared static ConfigMap
+    # and the task that deletes old ones.
+    memo.static_config_namespaces = set()
+    if static_config.SHARED:
+        logging.info("Using shared static ConfigMap %s", static_config.NAME)
+        memo.static_config_collector = asyncio.create_task(
+            static_config.collect(
+                memo.api_client,
+                static_config.NAME,
+                static_config.LABEL,
+                static_config.GC_INTERVAL,
+                leader,
+            )
         )
 
-    # Deployment
-    # ----------
-
-    logging.info("Creating Deployment %s...", name)
-
-    # Command is simply our custom start script,
-    # which is mounted at /usr/local/bin
-    command_items = ["bash", "/usr/local/bin/start.sh"]
-
-    deployment_body: Dict[Any, Any] = {
-        "apiVersion": "apps/v1",
-        "kind": "Deployment",
-        "metadata": {"name": name, "labels": {"app": name}},
-        "spec": {
-            "replicas": 1,
-            "selector": {"matchLabels": {"deployment": name}},
-            "strategy": {"type": "Recreate"},
-            "template": {
-                "metadata": {"labels": {"deployment": name}},
-                "spec": {
-                    "serviceAccountName": service_account,
-                    "nodeSelector": {_POD_NODE_SELECTOR_KEY: _POD_NODE_SELECTOR_VALUE},
-                    "containers": [
-                        {
-                            "name": "notebook",
-                            "image": image,
-                            "command": command_items,
-                            "imagePullPolicy": image_pull_policy,
-                            "resources": {
-                                "requests": {
-                                    "memory": memory_request,
-                                    "cpu": cpu_request,
-                                },
-                                "limits": {"memory": memory_limit, "cpu": cpu_limit},
-                            },
-                            "ports": [
-                                {
-                                    "name": "8888-tcp",
-                                    "containerPort": 8888,
-                                    "protocol": "TCP",
-                                }
-                            ],
-                            "env": [{"name": "HOME", "value": "/home/jovyan/." + name}],
-                            "volumeMounts": [
-                                {"name": "startup", "mountPath": "/usr/local/bin"},
-                                {
-                                    "name": "config",
-                                    "mountPath": "/etc/jupyter_notebook_config.json",
-                                    "subPath": "jupyter_notebook_config.json",
-                                },
-                                {
-                                    "name": "bp",
-                                    "mountPath": "/etc/.bash_profile",
-                                    "subPath": ".bash_profile",
-                                },
-                                {
-                                    "name": "project",
-                                    "mountPath": "/home/jovyan",
-                                    "subPath": project_id,
-                                },
-                            ],
-                        }
-                    ],
-                    "securityContext": {
-                        "runAsUser": sc_run_as_user,
-                        "runAsGroup": sc_run_as_group,
-                        "fsGroup": 100,
-                    },
-                    "volumes": [
-                        {"name": "startup", "configMap": {"name": f"startup-{name}"}},
-                        {"name": "bp", "configMap": {"name": f"bp-{name}"}},
-                        {"name": "config", "configMap": {"name": f"config-{name}"}},
-                        {
-                            "name": "project",
-                            "persistentVolumeClaim": {"claimName": project_claim_name},
-                        },
-                    ],
-                },
-            },
-        },
-    }
-
-    # Insert a pod priority class?
-    if _APPLY_POD_PRIORITY_CLASS:
-        deployment_body["spec"]["template"]["spec"][
-            "priorityClassName"
-        ] = _DEFAULT_POD_PRIORITY_CLASS
-
-    # Additional labels?
-    #
-    # If we find a key ending with '/owner', keep it
-    # (for use as an environment variable later)
-    instance_owner = "Unknown"
-    instance_id = "Unknown"
-    for label in material.get("labels", []):
-        key, value = label.split("=")
-        deployment_body["spec"]["template"]["metadata"]["labels"][key] = value
-        if key.endswith("/owner"):
-            instance_owner = value
-        elif key.endswith("/instance-id"):
-            instance_id = value
-
-    # To simplify the dynamic ENV adjustments we're about to make...
-    c_env = deployment_body["spec"]["template"]["spec"]["containers"][0]["env"]
-
-    if notebook_interface != "classic":
-        c_env.append({"name": "JUPYTER_ENABLE_LAB", "value": "true"})
-
-    # Add a Project and Instance UUID environment variables
-    # The project comes from the 'material->project' structure
-    # the instance comes from the provided "material->label''
-    c_env.append({"name": "DM_PROJECT_ID", "value": str(project_id)})
-    c_env.append({"name": "DM_INSTANCE_ID", "value": str(instance_id)})
-    # Add the instance owner (expected to have been extracted from a label)
-    c_env.append({"name": "DM_INSTANCE_OWNER", "value": str(instance_owner)})
-
-    apps_api = kubernetes.client.AppsV1Api()
-
-    kopf.adopt(deployment_body)
-    try:
-        apps_api.create_namespaced_deployment(
-            namespace, deployment_body, _request_timeout=_REQUEST_TIMEOUT
+    # The recommender (of notebook resources)
+    if rightsizing.RIGHTSIZING:
+        memo.recommender = Recommender(
+            memo.api_client,
+            rightsizing.WINDOW,
+            rightsizing.MIN_SAMPLES,
+            memo.shards.owns if sharding.SHARDS else None,
         )
-        logging.debug("Created Deployment %s", name)
-    except kubernetes.client.exceptions.ApiException as ex:
-        if ex.status != 409 or ex.reason != "Conflict":
-            raise ex
-        # Warn, but ignore and return a valid 'create' response now.
-        logging.debug(
-            "Got 409/Conflict creating Deployment %s. Ignoring - object already present",
-            name,
+        memo.recommender.start(rightsizing.INTERVAL)
+        logging.info(
+            "Recommending notebook resources (sampling every %s seconds apply=%s)",
+            rightsizing.INTERVAL,
+            bool(rightsizing.APPLY),
         )
 
-    # Service
-    # -------
+    # The router (of notebooks through shared Ingresses)
+    if routing.SHARED_INGRESS:
+        memo.router = IngressRouter(
+            memo.api_client, routing.SHARDS, routing.BATCH_DELAY
+        )
+        logging.info(
+            "Routing notebooks through shared Ingresses (shards=%s)", routing.SHARDS
+        )
 
-    logging.info("Creating Service %s...", name)
+    # The reconciler (of notebooks whose objects have gone missing)
+    if reconcile.INTERVAL:
+        memo.reconciler = Reconciler(
+            memo.api_client,
+            memo.get("object_cache"),
+            memo.shards.owns if sharding.SHARDS else None,
+            memo.get("router"),
+        )
+        memo.reconciler.start(reconcile.INTERVAL)
+        logging.info("Reconciling notebooks every %s seconds", reconcile.INTERVAL)
+
+
+@kopf.on.cleanup()
+async def shutdown(memo: kopf.Memo, **_: Any) -> None:
+    """The operator cleanup handler."""
+    shards: Optional[ShardLeases] = memo.get("shards")
+    if shards:
+        await shards.stop()
+    static_config_collector: Optional[asyncio.Task[None]] = memo.get(
+        "static_config_collector"
+    )
+    if static_config_collector:
+        static_config_collector.cancel()
+    package_cache_janitor: Optional[asyncio.Task[None]] = memo.get(
+        "package_cache_janitor"
+    )
+    if package_cache_janitor:
+        package_cache_janitor.cancel()
+    reconciler: Optional[Reconciler] = memo.get("reconciler")
+    if reconciler:
+        reconciler.stop()
+    router: Optional[IngressRouter] = memo.get("router")
+    if router:
+        router.stop()
+    recommender: Optional[Recommender] = memo.get("recommender")
+    if recommender:
+        recommender.stop()
+    object_cache: Optional[ObjectCache] = memo.get("object_cache")
+    if object_cache:
+        object_cache.stop()
+    readiness_tracker: Optional[ReadinessTracker] = memo.get("readiness")
+    if readiness_tracker:
+        readiness_tracker.stop()
+    reporter: Optional[PodEventReporter] = memo.get("pod_events")
+    if reporter:
+        reporter.stop()
+    warm_pool: Optional[WarmPool] = memo.get("warm_pool")
+    if warm_pool:
+        warm_pool.stop()
+    prepuller: Optional[ImagePrePuller] = memo.get("prepuller")
+    if prepuller:
+        prepuller.stop()
+    admission_queue: Optional[AdmissionQueue] = memo.get("admission")
+    if admission_queue:
+        admission_queue.stop()
+    culler_session: Optional[aiohttp.ClientSession] = memo.get("culler_session")
+    if culler_session:
+        await culler_session.close()
+
+    # Close the shared Kubernetes API client
+    # (and the connections in its pool).
+    api_client: Optional[kubernetes.client.ApiClient] = memo.get("api_client")
+    if api_client:
+        api_client.close()
+        api_client.rest_client.pool_manager.clear()
+        logging.info("Closed API client")
+
+
+@kopf.on.probe(id="objectCache")
+def object_cache_probe(memo: kopf.Memo, **_: Any) -> Dict[str, Any]:
+    """Exposes the object cache statistics (sizes, watch restarts etc.)
+    through the operator's health endpoint (if enabled).
+    """
+    object_cache: Optional[ObjectCache] = memo.get("object_cache")
+    return object_cache.stats() if object_cache else {}
 
-    service_body = {
-        "apiVersion": "v1",
-        "kind": "Service",
-        "metadata": {"name": name, "labels": {"app": name}},
-        "spec": {
-            "type": "ClusterIP",
-            "ports": [
-                {
-                    "name": "8888-tcp",
-                    "port": 8888,
-                    "protocol": "TCP",
-                    "targetPort": 8888,
-                }
-            ],
-            "selector": {"deployment": name},
-        },
-    }
 
-    kopf.adopt(service_body)
-    try:
-        core_api.create_namespaced_service(
-            namespace, service_body, _request_timeout=_REQUEST_TIMEOUT
-        )
-        logging.debug("Created Service %s", name)
-    except kubernetes.client.exceptions.ApiException as ex:
-        if ex.status != 409 or ex.reason != "Conflict":
-            raise ex
-        # Warn, but ignore and return a valid 'create' response now.
-        logging.debug(
-            "Got 409/Conflict creating Service %s. Ignoring - object already present",
-            name,
-        )
+@kopf.on.probe(id="readiness")
+def readiness_probe(memo: kopf.Memo, **_: Any) -> Dict[str, Any]:
+    """Exposes the readiness tracker statistics
+    through the operator's health endpoint (if enabled).
+    """
+    readiness_tracker: Optional[ReadinessTracker] = memo.get("readiness")
+    return readiness_tracker.stats() if readiness_tracker else {}
 
-    # Ingress
-    # -------
 
-    logging.info("Creating Ingress %s...", name)
+@kopf.on.probe(id="warmPool")
+def warm_pool_probe(memo: kopf.Memo, **_: Any) -> Dict[str, Any]:
+    """Exposes the warm pool statistics
+    through the operator's health endpoint (if enabled).
+    """
+    warm_pool: Optional[WarmPool] = memo.get("warm_pool")
+    return warm_pool.stats() if warm_pool else {}
 
-    ingress_body: Dict[Any, Any] = {
-        "kind": "Ingress",
-        "apiVersion": "networking.k8s.io/v1",
-        "metadata": {
-            "name": name,
-            "labels": {"app": name},
-            "annotations": {
-                "kubernetes.io/ingress.class": ingress_class,
-                "nginx.ingress.kubernetes.io/proxy-body-size": f"{ingress_proxy_body_size}",
-            },
-        },
-        "spec": {
-            "tls": [{"hosts": [ingress_domain], "secretName": ingress_tls_secret}],
-            "rules": [
-                {
-                    "host": ingress_domain,
-                    "http": {
-                        "paths": [
-                            {
-                                "path": ingress_path,
-                                "pathType": "Prefix",
-                                "backend": {
-                                    "service": {"name": name, "port": {"number": 8888}}
-                                },
-                            }
-                        ]
-                    },
-                }
-            ],
-        },
-    }
 
-    # Inject the cert-manager annotation if a TLS secret is not defined
-    # and a cert issuer is...
-    if not ingress_tls_secret and ingress_cert_issuer:
-        annotations = ingress_body["metadata"]["annotations"]
-        annotations["cert-manager.io/cluster-issuer"] = ingress_cert_issuer
+@kopf.on.probe(id="imagePrePuller")
+def prepuller_probe(memo: kopf.Memo, **_: Any) -> Dict[str, Any]:
+    """Exposes the image pre-puller statistics (image scores etc.)
+    through the operator's health endpoint (if enabled).
+    """
+    prepuller: Optional[ImagePrePuller] = memo.get("prepuller")
+    return prepuller.stats() if prepuller else {}
+
 
-    ext_api = kubernetes.client.NetworkingV1Api()
+@kopf.on.probe(id="admission")
+def admission_probe(memo: kopf.Memo, **_: Any) -> Dict[str, Any]:
+    """Exposes the admission queue statistics (launching and waiting notebooks)
+    through the operator's health endpoint (if enabled).
+    """
+    admission_queue: Optional[AdmissionQueue] = memo.get("admission")
+    return admission_queue.stats() if admission_queue else {}
+
+
+@kopf.on.resume(
+    "squonk.it", "v2", "jupyternotebooks", id="readiness", when=sharding.owned
+)
+def resume(
+    name: str,
+    namespace: str,
+    meta: kopf.Meta,
+    status: kopf.Status,
+    memo: kopf.Memo,
+    **_: Any,
+) -> None:
+    """Handler for existing notebooks (when the operator starts).
+    Notebooks that were not ready are tracked again.
+    """
+    readiness_tracker: Optional[ReadinessTracker] = memo.get("readiness")
+    if readiness_tracker:
+        conditions = status.get("conditions") or []
+        if not any(c.get("type") == "JupyterResponding" for c in conditions):
+            readiness_tracker.track(
+                namespace, name, meta["creationTimestamp"], conditions
+            )
+
+
+@kopf.on.event("squonk.it", "v2", "jupyternotebooks", id="watch")
+def watch_event(event: kopf.RawEvent, **_: Any) -> None:
+    """Handler for all notebook (watch) events.
+    Here we record the event (and its lag), excluding those of the initial listing.
+    """
+    if event["type"]:
+        metrics.observe_watch_event("JupyterNotebook", event["type"], event["object"])
+
+
+@kopf.on.create("squonk.it", "v1alpha3", "jupyternotebooks", id="jupyter")
+def create_v1alpha3(**_: Any) -> Dict[str, Any]:
+    """Handler for legacy CRD create events."""
+    metrics.PERMANENT_ERRORS.labels("v1alpha3").inc()
+    raise kopf.PermanentError("No longer supported")
 
-    kopf.adopt(ingress_body)
+
+# For TEMPORARY errors (i.e. those that are not kopf.PermanentError)
+# we retry after 20 seconds and only retry 6 times
+@kopf.on.create(
+    "squonk.it",
+    "v2",
+    "jupyternotebooks",
+    id="jupyter",
+    backoff=20,
+    retries=6,
+    when=sharding.owned,
+)
+async def create(
+    spec: Dict[str, Any],
+    name: str,
+    namespace: str,
+    meta: kopf.Meta,
+    status: kopf.Status,
+    patch: kopf.Patch,
+    memo: kopf.Memo,
+    retry: int,
+    **_: Any,
+) -> Dict[str, Any]:
+    """Handler for CRD create events.
+    Here we record the handler's metrics, creating the notebook
+    using '_create()' (once it's been admitted, if we're controlling admission).
+    An invalid spec is rejected (permanently) before anything is created.
+    """
+    if retry:
+        metrics.CREATE_RETRIES.inc()
+    logging.info("Incoming %s spec=%s", name, spec)
     try:
-        ext_api.create_namespaced_ingress(
-            namespace, ingress_body, _request_timeout=_REQUEST_TIMEOUT
-        )
-        logging.debug("Created Ingress %s", name)
-    except kubernetes.client.exceptions.ApiException as ex:
-        if ex.status != 409 or ex.reason != "Conflict":
-            raise ex
-        # Warn, but ignore and return a valid 'create' response now.
-        logging.debug(
-            "Got 409/Conflict creating Ingress %s. Ignoring - object already present",
-            name,
-        )
+        parsed_spec = notebook_spec.parse(name, spec)
+    except notebook_spec.SpecError as ex:
+        metrics.PERMANENT_ERRORS.labels("v2").inc()
+        raise kopf.PermanentError(f"Invalid spec: {ex}") from ex
+    # Track the notebook's readiness (before creating its Pod)
+    readiness_tracker: Optional[ReadinessTracker] = memo.get("readiness")
+    if readiness_tracker:
+        readiness_tracker.track(namespace, name, meta["creationTimestamp"])
+    async with contextlib.AsyncExitStack() as stack:
+        admission_queue: Optional[AdmissionQueue] = memo.get("admission")
+        if admission_queue:
+            await stack.enter_async_context(
+                admission_queue.launch(
+                    namespace,
+                    name,
+                    parsed_spec.owner,
+                    parsed_spec.cpu_request,
+                    parsed_spec.memory_request,
+                )
+            )
+        with (
+            metrics.CREATE_DURATION.time(),
+            metrics.CREATES_IN_PROGRESS.track_inprogress(),
+        ):
+            return await _create(parsed_spec, name, namespace, status, patch, memo)
+
+
+async def _create(
+    spec: NotebookSpec,
+    name: str,
+    namespace: str,
+    status: kopf.Status,
+    patch: kopf.Patch,
+    memo: kopf.Memo,
+) -> Dict[str, Any]:
+    """Creates a notebook (for the CRD create handler).
+    Here we render the required Kubernetes objects,
+    adopting them in kopf before applying them (server-side),
+    which creates them or, on a retry, converges them on what's rendered.
+
+    Objects that do not depend on each other (the ConfigMaps, Service and Ingress)
+    are applied concurrently. Only the Deployment waits, for the ConfigMaps
+    it mounts. With shared Ingresses the notebook's path is added to one
+    (rather than the notebook having its own Ingress).
+
+    We handle errors typically raising 'kopf.PermanentError' to prevent
+    Kubernetes constantly calling back for a given create.
+    """
+
+    logging.info("Creating %s (namespace=%s)...", name, namespace)
+
+    notebook = manifests.render(spec, readiness_probe=bool(readiness.TRACK_READINESS))
+
+    # We might be here as another attempt to create the same notebook
+    # (an exception may have caused a prior attempt to fail).
+    # The notebook's token (and any recommended resources applied to it
+    # and the node of any standby Pod claimed for it) are recorded
+    # in its status (as 'launch'), so every attempt applies the same objects.
+    # They're recorded by kopf's patch (with the handler's progress),
+    # rather than by patching the notebook here, which would be a change
+    # kopf sees (and handles again) before it has stored the progress.
+    launch: Dict[str, Any] = dict(status.get("launch") or {})
+    new_launch = not launch.get("token")
+    if new_launch:
+        characters = string.ascii_letters + string.digits
+        launch["token"] = "".join(random.sample(characters, 16))
+        # Apply the recommended resources (for the notebook's image and owner)?
+        recommender: Optional[Recommender] = memo.get("recommender")
+        if recommender and rightsizing.APPLY:
+            recommendation = recommender.recommendation(notebook.image, notebook.owner)
+            if recommendation:
+                launch["resources"] = rightsizing.apply(
+                    notebook.resources(), recommendation
+                )
+    if launch.get("resources"):
+        notebook.set_resources(launch["resources"])
+    if new_launch:
+        # Claim a standby Pod (from the warm pool)?
+        # If we get one, we prefer its node, which has the image
+        # and (now the standby Pod's gone) the capacity for the notebook.
+        warm_pool: Optional[WarmPool] = memo.get("warm_pool")
+        if warm_pool:
+            with _phase_timer(name, "WarmPool"):
+                standby_node = await warm_pool.claim(
+                    notebook.image, notebook.cpu_request, notebook.memory_request
+                )
+            if standby_node:
+                launch["standbyNode"] = standby_node
+        patch.status["launch"] = launch
+        if launch.get("resources"):
+            logging.info("Applied resources %s to %s", launch["resources"], name)
+            metrics.RIGHTSIZING_APPLIED.inc()
+    token: str = launch["token"]
+    if launch.get("standbyNode"):
+        notebook.prefer_node(launch["standbyNode"])
+
+    # The shared static ConfigMap is not adopted (it's used by all notebooks)
+    # and only needs to be applied once per namespace.
+    config_maps: List[Dict[str, Any]] = [manifests.config_map(name, token)]
+    if not static_config.SHARED:
+        config_maps.extend(notebook.static_config_maps)
+    kopf.adopt(config_maps)
+    if static_config.SHARED and namespace not in memo.static_config_namespaces:
+        config_maps.extend(notebook.static_config_maps)
+    kopf.adopt(notebook.deployment)
+    kopf.adopt(notebook.service)
+    # With shared Ingresses the notebook's path is added to one
+    router: Optional[IngressRouter] = memo.get("router")
+    if not router:
+        kopf.adopt(notebook.ingress)
+
+    # Object application
+    # ------------------
+
+    async def apply_config_maps_and_deployment() -> None:
+        """Applies the ConfigMaps and then (because it mounts them)
+        the Deployment.
+        """
+        logging.info("Applying ConfigMaps %s...", name)
+        with _phase_timer(name, "ConfigMaps"):
+            await asyncio.gather(
+                *[
+                    kube.apply(memo.api_client, "ConfigMap", namespace, cm_body)
+                    for cm_body in config_maps
+                ]
+            )
+            if static_config.SHARED:
+                memo.static_config_namespaces.add(namespace)
+
+        logging.info("Applying Deployment %s...", name)
+        with _phase_timer(name, "Deployment"):
+            await kube.apply(
+                memo.api_client, "Deployment", namespace, notebook.deployment
+            )
+
+    async def apply_service() -> None:
+        logging.info("Applying Service %s...", name)
+        with _phase_timer(name, "Service"):
+            await kube.apply(memo.api_client, "Service", namespace, notebook.service)
+
+    async def apply_ingress() -> None:
+        if router:
+            logging.info("Routing %s...", name)
+            with _phase_timer(name, "Ingress"):
+                await router.route(namespace, notebook.ingress)
+            return
+        logging.info("Applying Ingress %s...", name)
+        with _phase_timer(name, "Ingress"):
+            await kube.apply(memo.api_client, "Ingress", namespace, notebook.ingress)
+
+    await asyncio.gather(
+        apply_config_maps_and_deployment(), apply_service(), apply_ingress()
+    )
 
     # Done
     # ----
     logging.info("Done %s (namespace=%s token=%s)", name, namespace, token)
 
-    return {
-        "notebook": {
-            "url": f"http://{ingress_domain}{ingress_path}?token={token}",
-            "token": token,
-            "interface": notebook_interface,
-        },
-        "image": image,
-        "serviceAccountName": service_account,
-        "resources": {
-            "requests": {"memory": memory_request},
-            "limits": {"memory": memory_limit},
-        },
-        "project": {"claimName": project_claim_name, "id": project_id},
-    }
+    return notebook.status(token)
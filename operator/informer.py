@@ -0,0 +1,162 @@
+"""A label-selected list-then-watch loop (an 'informer').
+
+Each informer runs in its own (daemon) thread, using the operator's shared
+API client, and passes the objects it lists and the events it watches
+to its callbacks (as dictionaries, the raw API response).
+Watch timeouts, bookmarks and periodic re-listing (resync) follow the
+operator's watch settings (see 'kube.py'), and watch reconnects
+and event lag are recorded as metrics.
+"""
+
+import json
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import kubernetes
+import urllib3
+
+import kube
+import metrics
+
+# The delay (seconds) before re-listing after an error
+_ERROR_DELAY: float = 5.0
+
+
+class _WatchExpired(Exception):
+    """The resource version of a watch has expired (a 410/Gone).
+    The objects must be listed again.
+    """
+
+
+class Informer:
+    """Lists, and then watches, the objects returned by a Kubernetes API
+    'list' function (e.g. 'list_pod_for_all_namespaces') using a label selector.
+
+    'on_list' is called with all the objects after each (re-)listing and
+    'on_event' with the type ('ADDED', 'MODIFIED' or 'DELETED') and object
+    of each watch event. Both are called from the informer's thread.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        list_function: Callable[..., Any],
+        label_selector: str,
+        request_timeout: Tuple[int, int],
+        on_list: Callable[[List[Dict[str, Any]]], None],
+        on_event: Callable[[str, Dict[str, Any]], None],
+    ) -> None:
+        self.name = name
+        self._list_function = list_function
+        self._label_selector = label_selector
+        self._request_timeout = request_timeout
+        self._on_list = on_list
+        self._on_event = on_event
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        # True once the objects have been listed
+        # (and the watch has not failed since).
+        self.synced: bool = False
+        # The number of times the watch has been restarted
+        self.restarts: int = 0
+
+    def start(self) -> None:
+        """Starts the informer thread."""
+        self._thread = threading.Thread(
+            target=self._list_and_watch, name=f"informer-{self.name}", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stops the informer. A thread blocked on a watch
+        is a daemon, and will end when the watch times out.
+        """
+        self._stopping.set()
+
+    def _list(self) -> str:
+        """Lists all the objects, returning the list's resource version."""
+        response = self._list_function(
+            label_selector=self._label_selector,
+            _preload_content=False,
+            _request_timeout=self._request_timeout,
+        )
+        listing = json.loads(response.data)
+        self._on_list(listing["items"])
+        self.synced = True
+        resource_version: str = listing["metadata"]["resourceVersion"]
+        return resource_version
+
+    def _watch(self, resource_version: str) -> str:
+        """Watches the objects (from the given resource version)
+        until the watch times out, returning the latest resource version.
+        """
+        response = self._list_function(
+            label_selector=self._label_selector,
+            watch=True,
+            resource_version=resource_version,
+            allow_watch_bookmarks=kube.WATCH_BOOKMARKS,
+            timeout_seconds=kube.WATCH_SERVER_TIMEOUT,
+            _preload_content=False,
+            _request_timeout=(self._request_timeout[0], kube.WATCH_CLIENT_TIMEOUT),
+        )
+        try:
+            for line in kubernetes.watch.watch.iter_resp_lines(response):
+                if not line:
+                    continue
+                event = json.loads(line)
+                obj = event["object"]
+                if event["type"] == "ERROR":
+                    if obj.get("code") == 410:
+                        raise _WatchExpired()
+                    raise kubernetes.client.exceptions.ApiException(
+                        status=obj.get("code"), reason=obj.get("reason")
+                    )
+                resource_version = obj["metadata"]["resourceVersion"]
+                if event["type"] != "BOOKMARK":
+                    metrics.observe_watch_event(self.name, event["type"], obj)
+                    self._on_event(event["type"], obj)
+                if self._stopping.is_set():
+                    break
+        finally:
+            response.release_conn()
+        return resource_version
+
+    def _list_and_watch(self) -> None:
+        """The informer loop. The objects are re-listed after a watch expires
+        or fails, and every resync interval (if set).
+        """
+        while not self._stopping.is_set():
+            reason = "stopped"
+            try:
+                resource_version = self._list()
+                listed = time.monotonic()
+                while not self._stopping.is_set():
+                    resource_version = self._watch(resource_version)
+                    if (
+                        kube.WATCH_RESYNC_INTERVAL
+                        and time.monotonic() - listed > kube.WATCH_RESYNC_INTERVAL
+                    ):
+                        reason = "resync"
+                        break
+                    metrics.WATCH_RECONNECTS.labels(self.name, "timeout").inc()
+            except _WatchExpired:
+                logging.debug("Watch of %s expired", self.name)
+                reason = "expired"
+            except (
+                kubernetes.client.exceptions.ApiException,
+                urllib3.exceptions.HTTPError,
+                ValueError,
+            ) as ex:
+                # We may have missed events,
+                # so our objects can't be relied upon until we've re-listed.
+                logging.warning("Error watching %s (%s)", self.name, ex)
+                self.synced = False
+                reason = "error"
+                time.sleep(_ERROR_DELAY)
+            if self._stopping.is_set():
+                break
+            self.restarts += 1
+            metrics.WATCH_RECONNECTS.labels(self.name, reason).inc()
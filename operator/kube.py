@@ -0,0 +1,243 @@
+"""The operator's (shared) Kubernetes API client and API call utilities."""
+
+import asyncio
+import concurrent.futures
+import functools
+import os
+import socket
+from typing import Any, Callable, Dict, List, Optional
+
+import kubernetes
+import urllib3
+
+import metrics
+
+# Configuration of underlying API requests.
+#
+# Request timeout (from Python Kubernetes API)
+#   If one number provided, it will be total request
+#   timeout. It can also be a pair (tuple) of
+#   (connection, read) timeouts.
+REQUEST_TIMEOUT = (
+    int(os.environ.get("JO_REQUEST_CONNECT_TIMEOUT", "30")),
+    int(os.environ.get("JO_REQUEST_READ_TIMEOUT", "20")),
+)
+
+# The shared Kubernetes API client.
+#
+# The maximum number of (pooled) connections to the API server.
+# This is also the number of threads used to run API requests.
+API_POOL_MAXSIZE: int = int(os.environ.get("JO_API_POOL_MAXSIZE", "32"))
+# The idle time (seconds) before TCP keep-alive probes are sent
+# on pooled connections. Zero disables TCP keep-alive.
+API_KEEPALIVE_SECONDS: int = int(os.environ.get("JO_API_KEEPALIVE_SECONDS", "60"))
+
+# The field manager of the objects we apply (server-side).
+# Applies are forced, so fields changed by others revert to our values.
+FIELD_MANAGER: str = "jupyter-operator"
+# The label (set on every object we create for a notebook)
+# whose value is the notebook name. Unlike the objects' 'app' label
+# it's ours alone, so our watches only see the notebooks' objects.
+NOTEBOOK_LABEL: str = "squonk.it/jupyter-notebook"
+
+# The number of attempts made to apply an object (applies are idempotent,
+# so those failing with a server error can simply be repeated)
+# and the delay (seconds) between them.
+_APPLY_ATTEMPTS: int = 3
+_APPLY_RETRY_DELAY: float = 1.0
+# The resource paths of the (namespaced) objects we apply, by kind
+_APPLY_PATHS: Dict[str, str] = {
+    "ConfigMap": "/api/v1/namespaces/{namespace}/configmaps/{name}",
+    "Deployment": "/apis/apps/v1/namespaces/{namespace}/deployments/{name}",
+    "DaemonSet": "/apis/apps/v1/namespaces/{namespace}/daemonsets/{name}",
+    "Service": "/api/v1/namespaces/{namespace}/services/{name}",
+    "Ingress": "/apis/networking.k8s.io/v1/namespaces/{namespace}/ingresses/{name}",
+}
+
+# The namespaces the operator watches (a colon-separated list,
+# those of the Data Manager). If not set, all namespaces are watched.
+NAMESPACES: List[str] = [
+    namespace
+    for namespace in os.environ.get("JO_NAMESPACES", "").split(":")
+    if namespace
+]
+
+# Watches.
+#
+# The server-side timeout (seconds) of each watch request, after which
+# the watch reconnects, and the additional time the client allows for it.
+# The operator's own watches (its 'informers') also re-list their objects
+# every 'resync interval' (seconds, zero to only re-list when a watch fails)
+# and, unless 'bookmarks' is 'no', ask for bookmark events
+# (which let a quiet watch resume without re-listing).
+WATCH_SERVER_TIMEOUT: int = int(os.environ.get("JO_WATCH_SERVER_TIMEOUT", "120"))
+WATCH_CLIENT_TIMEOUT: int = int(os.environ.get("JO_WATCH_CLIENT_TIMEOUT", "150"))
+WATCH_RESYNC_INTERVAL: int = int(os.environ.get("JO_WATCH_RESYNC_INTERVAL", "0"))
+WATCH_BOOKMARKS: bool = os.environ.get("JO_WATCH_BOOKMARKS", "yes").lower() != "no"
+
+
+def scoped(
+    all_namespaces: Callable[..., Any], namespaced: Callable[..., Any]
+) -> Dict[str, Callable[..., Any]]:
+    """Given a resource's all-namespaces and namespaced list functions
+    (e.g. 'list_pod_for_all_namespaces' and 'list_namespaced_pod') returns
+    the list functions for the namespaces we watch, by namespace
+    ('' if we watch all namespaces).
+    """
+    if not NAMESPACES:
+        return {"": all_namespaces}
+    return {
+        namespace: functools.partial(namespaced, namespace) for namespace in NAMESPACES
+    }
+
+
+def new_api_client() -> kubernetes.client.ApiClient:
+    """Creates the (process-wide) Kubernetes API client,
+    whose connection pool is shared by all our API calls.
+    """
+    # Our startup handler runs before kopf logs in,
+    # so we load the configuration here (as kopf does).
+    try:
+        kubernetes.config.load_incluster_config()
+    except kubernetes.config.ConfigException:
+        kubernetes.config.load_kube_config()
+
+    configuration = kubernetes.client.Configuration.get_default_copy()
+    configuration.connection_pool_maxsize = API_POOL_MAXSIZE
+    api_client = kubernetes.client.ApiClient(configuration)
+
+    if API_KEEPALIVE_SECONDS > 0:
+        # Socket options used for all new pooled connections
+        socket_options = urllib3.connection.HTTPConnection.default_socket_options + [
+            (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        ]
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            socket_options.append(
+                (socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, API_KEEPALIVE_SECONDS)
+            )
+        pool_manager = api_client.rest_client.pool_manager
+        pool_manager.connection_pool_kw["socket_options"] = socket_options
+
+    return api_client
+
+
+async def call(
+    verb: str,
+    kind: str,
+    function: Callable[..., Any],
+    *args: Any,
+    executor: Optional[concurrent.futures.Executor] = None,
+    **kwargs: Any,
+) -> Any:
+    """Calls a (synchronous) Kubernetes API function in a thread,
+    so that we do not block the operator's event loop,
+    recording the duration of the call (by verb and kind).
+    Calls use the event loop's default executor unless another is given
+    (for calls that must not wait behind the notebook's calls).
+    """
+    kwargs.setdefault("_request_timeout", REQUEST_TIMEOUT)
+    with metrics.api_call_timer(verb, kind):
+        if executor:
+            return await asyncio.get_running_loop().run_in_executor(
+                executor, functools.partial(function, *args, **kwargs)
+            )
+        return await asyncio.to_thread(function, *args, **kwargs)
+
+
+def release(response: urllib3.response.BaseHTTPResponse) -> None:
+    """Discards the (unread) body of a response to a request made with
+    '_preload_content=False', returning its connection to the pool.
+    """
+    response.drain_conn()
+    response.release_conn()
+
+
+async def apply(
+    api_client: kubernetes.client.ApiClient,
+    kind: str,
+    namespace: str,
+    body: Dict[str, Any],
+) -> None:
+    """Applies (server-side) a notebook object (a ConfigMap, Deployment,
+    Service or Ingress) or one of the operator's DaemonSets,
+    creating it or updating the fields we manage.
+    The client's (generated) patch functions do not let us choose the patch
+    content type, so the request is made with the client's 'call_api()'.
+    Its response is preloaded (read, but without a response type
+    not deserialized) so its connection is returned to the pool.
+    """
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            await call(
+                "apply",
+                kind,
+                api_client.call_api,
+                _APPLY_PATHS[kind],
+                "PATCH",
+                path_params={"namespace": namespace, "name": body["metadata"]["name"]},
+                query_params=[("fieldManager", FIELD_MANAGER), ("force", True)],
+                header_params={
+                    "Accept": "application/json",
+                    "Content-Type": "application/apply-patch+yaml",
+                },
+                body=body,
+                auth_settings=["BearerToken"],
+            )
+            return
+        except kubernetes.client.exceptions.ApiException as ex:
+            if attempt >= _APPLY_ATTEMPTS or (ex.status < 500 and ex.status != 429):
+                raise ex
+        await asyncio.sleep(_APPLY_RETRY_DELAY)
+
+
+async def patch_notebook_status(
+    api_client: kubernetes.client.ApiClient,
+    namespace: str,
+    name: str,
+    status: Dict[str, Any],
+) -> None:
+    """Patches (merges) the given status into a notebook's status."""
+    custom_api = kubernetes.client.CustomObjectsApi(api_client)
+    await call(
+        "patch",
+        "JupyterNotebook",
+        custom_api.patch_namespaced_custom_object,
+        "squonk.it",
+        "v2",
+        namespace,
+        "jupyternotebooks",
+        name,
+        {"status": status},
+    )
+
+
+async def list_notebooks(
+    api_client: kubernetes.client.ApiClient,
+) -> List[Dict[str, Any]]:
+    """Lists the notebooks (in the namespaces we watch)."""
+    custom_api = kubernetes.client.CustomObjectsApi(api_client)
+    notebooks: List[Dict[str, Any]] = []
+    for namespace in NAMESPACES or [""]:
+        if namespace:
+            response = await call(
+                "list",
+                "JupyterNotebook",
+                custom_api.list_namespaced_custom_object,
+                "squonk.it",
+                "v2",
+                namespace,
+                "jupyternotebooks",
+            )
+        else:
+            response = await call(
+                "list",
+                "JupyterNotebook",
+                custom_api.list_cluster_custom_object,
+                "squonk.it",
+                "v2",
+                "jupyternotebooks",
+            )
+        notebooks.extend(response["items"])
+    return notebooks
@@ -0,0 +1,428 @@
+"""The Kubernetes objects (manifests) of a notebook.
+
+'render()' builds the objects of a notebook (its ConfigMaps, Deployment,
+Service and Ingress) from the notebook's (parsed and validated) spec
+(see 'notebook_spec.py'), without using the Kubernetes API.
+The parts of the objects that only depend on the operator's configuration
+(the static ConfigMaps, node selector etc.) are built once, when the module
+is loaded, rather than for every notebook.
+The objects are not adopted (given an owner), that's left to the caller:
+the create handler, and the reconciler (which repairs notebooks whose objects
+have gone missing).
+"""
+
+import json
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+import kube
+import package_cache
+import static_config
+from notebook_spec import NotebookSpec
+from warm_pool import node_affinity
+
+# Apply Pod Priority class?
+# Any value results in setting the Pod's Priority Class
+APPLY_POD_PRIORITY_CLASS: Optional[str] = os.environ.get("JO_APPLY_POD_PRIORITY_CLASS")
+# If set and JO_APPLY_POD_PRIORITY_CLASS is set
+# this value will be used if now alternative is available.
+DEFAULT_POD_PRIORITY_CLASS: str = os.environ.get(
+    "JO_DEFAULT_POD_PRIORITY_CLASS", "im-application-low"
+)
+
+# The cert-manager issuer,
+# expected if a INGRESS_TLS_SECRET is not defined.
+_INGRESS_CERT_ISSUER: Optional[str] = os.environ.get("INGRESS_CERT_ISSUER")
+
+# Application node selection
+POD_NODE_SELECTOR_KEY: str = os.environ.get(
+    "JO_POD_NODE_SELECTOR_KEY", "informaticsmatters.com/purpose-application"
+)
+POD_NODE_SELECTOR_VALUE: str = os.environ.get("JO_POD_NODE_SELECTOR_VALUE", "yes")
+
+# The Jupyter jupyter_notebook_config.json file.
+# A ConfigMap whose content is written into '/etc'
+# and copied to the $HOME/.jupyter by the notebook_startup
+# script (see 'static_config.py').
+_NOTEBOOK_CONFIG: str = """{
+  "ServerApp": {
+    "token": "%(token)s",
+    "base_url": "%(base_url)s",
+    "ip": "0.0.0.0"
+  }
+}
+"""
+# The key of the Jupyter configuration (in the 'config' ConfigMap)
+_NOTEBOOK_CONFIG_KEY: str = "jupyter_notebook_config.json"
+
+
+def _labels(name: str) -> Dict[str, str]:
+    """The labels of a notebook's (named) objects."""
+    return {"app": name, kube.NOTEBOOK_LABEL: name}
+
+
+class Manifests:
+    """The objects of a notebook (rendered from its spec by 'render()'),
+    and the values of its spec that the operator needs.
+    The 'config' ConfigMap, which holds the notebook's token, is rendered
+    separately (see 'config_map()').
+    """
+
+    def __init__(self, spec: NotebookSpec) -> None:
+        self.spec = spec
+        self.name = spec.name
+        self.image: str = spec.image
+        self.cpu_request: str = spec.cpu_request
+        self.memory_request: str = spec.memory_request
+        # The notebook's owner (from its Data Manager labels)
+        self.owner: str = spec.owner
+        # The startup script and bash profile ConfigMaps
+        # (or the shared static ConfigMap)
+        self.static_config_maps: List[Dict[str, Any]] = []
+        self.deployment: Dict[str, Any] = {}
+        self.service: Dict[str, Any] = {}
+        self.ingress: Dict[str, Any] = {}
+        # The notebook's URL (without the token) and interface
+        # and the rest of its status (the create handler's result).
+        self.url: str = ""
+        self.interface: str = spec.interface
+        self.summary: Dict[str, Any] = {}
+
+    def objects(self, token: str) -> List[Tuple[str, Dict[str, Any]]]:
+        """All the notebook's objects (with their kinds),
+        including the 'config' ConfigMap (with the given token).
+        """
+        return [
+            ("ConfigMap", config_map(self.name, token)),
+            *[("ConfigMap", body) for body in self.static_config_maps],
+            ("Deployment", self.deployment),
+            ("Service", self.service),
+            ("Ingress", self.ingress),
+        ]
+
+    def prefer_node(self, node: str) -> None:
+        """Gives the notebook's Pod an affinity for a node
+        (that of the standby Pod claimed for it).
+        """
+        self.deployment["spec"]["template"]["spec"]["affinity"] = node_affinity(node)
+
+    def resources(self) -> Dict[str, Any]:
+        """The resources (requests and limits) of the notebook's container."""
+        resources: Dict[str, Any] = self.deployment["spec"]["template"]["spec"][
+            "containers"
+        ][0]["resources"]
+        return resources
+
+    def set_resources(self, resources: Dict[str, Any]) -> None:
+        """Replaces the resources (requests and limits)
+        of the notebook's container.
+        """
+        self.deployment["spec"]["template"]["spec"]["containers"][0][
+            "resources"
+        ] = resources
+        self.cpu_request = resources["requests"]["cpu"]
+        self.memory_request = resources["requests"]["memory"]
+        self.summary["resources"] = {
+            "requests": {"memory": resources["requests"]["memory"]},
+            "limits": {"memory": resources["limits"]["memory"]},
+        }
+
+    def status(self, token: str) -> Dict[str, Any]:
+        """The notebook's status, for the given token."""
+        return {
+            "notebook": {
+                "url": f"{self.url}?token={token}",
+                "token": token,
+                "interface": self.interface,
+            },
+            **self.summary,
+        }
+
+
+def config_map(name: str, token: str) -> Dict[str, Any]:
+    """Renders a notebook's 'config' ConfigMap
+    (the Jupyter configuration, which includes the notebook's token).
+    """
+    config_vars = {"token": token, "base_url": name}
+    return {
+        "apiVersion": "v1",
+        "kind": "ConfigMap",
+        "metadata": {"name": f"config-{name}", "labels": _labels(name)},
+        "data": {_NOTEBOOK_CONFIG_KEY: _NOTEBOOK_CONFIG % config_vars},
+    }
+
+
+def config_map_token(data: Dict[str, str]) -> str:
+    """Returns the notebook token held in a 'config' ConfigMap's data."""
+    json_data = json.loads(data[_NOTEBOOK_CONFIG_KEY])
+    token: str = json_data["ServerApp"]["token"]
+    return token
+
+
+# The parts of the notebook objects that only depend on the operator's
+# configuration, built once (and shared by the objects of every notebook,
+# so they must not be modified).
+
+# The shared static ConfigMap (the startup script and bash profile),
+# used by all notebooks (and never adopted), and the volumes that mount it.
+_SHARED_STATIC_CONFIG_MAP: Dict[str, Any] = {
+    "apiVersion": "v1",
+    "kind": "ConfigMap",
+    "metadata": {"name": static_config.NAME, "labels": {static_config.LABEL: "yes"}},
+    "immutable": True,
+    "data": static_config.DATA,
+}
+_SHARED_STARTUP_VOLUME: Dict[str, Any] = {
+    "name": "startup",
+    "configMap": {
+        "name": static_config.NAME,
+        "items": [{"key": "start.sh", "path": "start.sh"}],
+    },
+}
+_SHARED_BP_VOLUME: Dict[str, Any] = {
+    "name": "bp",
+    "configMap": {
+        "name": static_config.NAME,
+        "items": [{"key": ".bash_profile", "path": ".bash_profile"}],
+    },
+}
+# Command is simply our custom start script,
+# which is mounted at /usr/local/bin
+_COMMAND: List[str] = ["bash", "/usr/local/bin/start.sh"]
+_NODE_SELECTOR: Dict[str, str] = {POD_NODE_SELECTOR_KEY: POD_NODE_SELECTOR_VALUE}
+_PORTS: List[Dict[str, Any]] = [
+    {"name": "8888-tcp", "containerPort": 8888, "protocol": "TCP"}
+]
+_SERVICE_PORTS: List[Dict[str, Any]] = [
+    {"name": "8888-tcp", "port": 8888, "protocol": "TCP", "targetPort": 8888}
+]
+_PACKAGE_CACHE_VOLUME: Optional[Dict[str, Any]] = (
+    package_cache.volume() if package_cache.PACKAGE_CACHE else None
+)
+
+
+def render(spec: NotebookSpec, readiness_probe: bool = False) -> Manifests:
+    """Renders the objects of a notebook from its (parsed) spec.
+    With 'readiness_probe' the notebook container has a probe
+    whose success signals that Jupyter is responding.
+    """
+    name = spec.name
+    manifests = Manifests(spec)
+
+    image_parts = spec.image.split(":")
+    image_tag = "latest" if len(image_parts) == 1 else image_parts[1]
+    image_pull_policy = (
+        "Always" if image_tag.lower() in ["latest", "stable"] else "IfNotPresent"
+    )
+    ingress_path = f"/{name}"
+
+    # ConfigMaps
+    # ----------
+
+    # The static ConfigMaps (the startup script and bash profile)
+    # are either shared by all notebooks in the namespace or,
+    # by default, created for each notebook.
+    if static_config.SHARED:
+        startup_volume = _SHARED_STARTUP_VOLUME
+        bp_volume = _SHARED_BP_VOLUME
+        manifests.static_config_maps.append(_SHARED_STATIC_CONFIG_MAP)
+    else:
+        startup_volume = {"name": "startup", "configMap": {"name": f"startup-{name}"}}
+        bp_volume = {"name": "bp", "configMap": {"name": f"bp-{name}"}}
+        manifests.static_config_maps.extend(
+            [
+                {
+                    "apiVersion": "v1",
+                    "kind": "ConfigMap",
+                    "metadata": {"name": f"bp-{name}", "labels": _labels(name)},
+                    "data": {".bash_profile": static_config.BASH_PROFILE},
+                },
+                {
+                    "apiVersion": "v1",
+                    "kind": "ConfigMap",
+                    "metadata": {"name": f"startup-{name}", "labels": _labels(name)},
+                    "data": {"start.sh": static_config.NOTEBOOK_STARTUP},
+                },
+            ]
+        )
+
+    # Deployment
+    # ----------
+
+    # The Pod labels: the Deployment's selector, the operator's notebook label
+    # (which our Pod watches select) and the Data Manager labels
+    pod_labels = {"deployment": name, kube.NOTEBOOK_LABEL: name}
+    pod_labels.update(spec.labels)
+
+    env = [
+        {"name": "HOME", "value": "/home/jovyan/." + name},
+    ]
+    if spec.interface != "classic":
+        env.append({"name": "JUPYTER_ENABLE_LAB", "value": "true"})
+    # Add a Project and Instance UUID environment variables
+    # The project comes from the 'material->project' structure
+    # the instance comes from the provided "material->label''
+    env.append({"name": "DM_PROJECT_ID", "value": spec.project_id})
+    env.append({"name": "DM_INSTANCE_ID", "value": spec.instance_id})
+    # Add the instance owner (extracted from a label)
+    env.append({"name": "DM_INSTANCE_OWNER", "value": spec.owner})
+
+    container: Dict[str, Any] = {
+        "name": "notebook",
+        "image": spec.image,
+        "command": _COMMAND,
+        "imagePullPolicy": image_pull_policy,
+        "resources": {
+            "requests": {"memory": spec.memory_request, "cpu": spec.cpu_request},
+            "limits": {"memory": spec.memory_limit, "cpu": spec.cpu_limit},
+        },
+        "ports": _PORTS,
+        "env": env,
+        "volumeMounts": [
+            {"name": "startup", "mountPath": "/usr/local/bin"},
+            {
+                "name": "config",
+                "mountPath": "/etc/jupyter_notebook_config.json",
+                "subPath": "jupyter_notebook_config.json",
+            },
+            {
+                "name": "bp",
+                "mountPath": "/etc/.bash_profile",
+                "subPath": ".bash_profile",
+            },
+            {
+                "name": "project",
+                "mountPath": "/home/jovyan",
+                "subPath": spec.project_id,
+            },
+        ],
+    }
+    pod_spec: Dict[str, Any] = {
+        "serviceAccountName": spec.service_account,
+        "nodeSelector": _NODE_SELECTOR,
+        "containers": [container],
+        # Data Manager API compliance.
+        #
+        # The user and group IDs we're asked to run as.
+        # The files in the container project volume will be owned
+        # by this user and group. We must run as group 100.
+        # We use the supplied group ID and pass that into the container
+        # as the Kubernetes 'File System Group' (fsGroup).
+        # This should allow us to run and manipulate the files.
+        "securityContext": {
+            "runAsUser": spec.run_as_user,
+            "runAsGroup": spec.run_as_group,
+            "fsGroup": 100,
+        },
+        "volumes": [
+            startup_volume,
+            bp_volume,
+            {"name": "config", "configMap": {"name": f"config-{name}"}},
+            {
+                "name": "project",
+                "persistentVolumeClaim": {"claimName": spec.project_claim_name},
+            },
+        ],
+    }
+
+    # Add a readiness probe?
+    # When tracking readiness the Pod's 'Ready' condition
+    # signals that Jupyter is responding (to an unauthenticated API request).
+    if readiness_probe:
+        container["readinessProbe"] = {
+            "httpGet": {"path": f"/{name}/api", "port": 8888},
+            "periodSeconds": 2,
+            "failureThreshold": 3,
+        }
+
+    # Insert a pod priority class?
+    if APPLY_POD_PRIORITY_CLASS:
+        pod_spec["priorityClassName"] = DEFAULT_POD_PRIORITY_CLASS
+
+    # Mount the package cache?
+    # The notebook's pip, conda and XDG caches are moved into it.
+    if _PACKAGE_CACHE_VOLUME:
+        container["volumeMounts"].append(package_cache.volume_mount(spec.owner))
+        pod_spec["volumes"].append(_PACKAGE_CACHE_VOLUME)
+        env.extend(package_cache.ENV)
+
+    manifests.deployment = {
+        "apiVersion": "apps/v1",
+        "kind": "Deployment",
+        "metadata": {"name": name, "labels": _labels(name)},
+        "spec": {
+            "replicas": 1,
+            "selector": {"matchLabels": {"deployment": name}},
+            "strategy": {"type": "Recreate"},
+            "template": {"metadata": {"labels": pod_labels}, "spec": pod_spec},
+        },
+    }
+
+    # Service
+    # -------
+
+    manifests.service = {
+        "apiVersion": "v1",
+        "kind": "Service",
+        "metadata": {"name": name, "labels": _labels(name)},
+        "spec": {
+            "type": "ClusterIP",
+            "ports": _SERVICE_PORTS,
+            "selector": {"deployment": name},
+        },
+    }
+
+    # Ingress
+    # -------
+
+    annotations = {
+        "kubernetes.io/ingress.class": spec.ingress_class,
+        "nginx.ingress.kubernetes.io/proxy-body-size": spec.ingress_proxy_body_size,
+    }
+    # Inject the cert-manager annotation if a TLS secret is not defined
+    # and a cert issuer is...
+    if not spec.ingress_tls_secret and _INGRESS_CERT_ISSUER:
+        annotations["cert-manager.io/cluster-issuer"] = _INGRESS_CERT_ISSUER
+
+    manifests.ingress = {
+        "kind": "Ingress",
+        "apiVersion": "networking.k8s.io/v1",
+        "metadata": {"name": name, "labels": _labels(name), "annotations": annotations},
+        "spec": {
+            "tls": [
+                {"hosts": [spec.ingress_domain], "secretName": spec.ingress_tls_secret}
+            ],
+            "rules": [
+                {
+                    "host": spec.ingress_domain,
+                    "http": {
+                        "paths": [
+                            {
+                                "path": ingress_path,
+                                "pathType": "Prefix",
+                                "backend": {
+                                    "service": {"name": name, "port": {"number": 8888}}
+                                },
+                            }
+                        ]
+                    },
+                }
+            ],
+        },
+    }
+
+    # Status
+    # ------
+
+    manifests.url = f"http://{spec.ingress_domain}{ingress_path}"
+    manifests.summary = {
+        "image": spec.image,
+        "serviceAccountName": spec.service_account,
+        "resources": {
+            "requests": {"memory": spec.memory_request},
+            "limits": {"memory": spec.memory_limit},
+        },
+        "project": {"claimName": spec.project_claim_name, "id": spec.project_id},
+    }
+
+    return manifests
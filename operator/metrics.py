@@ -0,0 +1,237 @@
+"""The operator's Prometheus metrics.
+
+Metrics are served by the Prometheus client's HTTP server,
+started by the operator's startup handler (see 'serve()').
+"""
+
+import contextlib
+import datetime
+import time
+from typing import Any, Iterator, Mapping
+
+import prometheus_client
+
+# The metric name prefix
+_PREFIX: str = "jupyter_operator"
+
+# Latency buckets (seconds).
+# API calls are typically milliseconds, notebook creation
+# (and each notebook startup step) seconds.
+_API_CALL_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+_CREATE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Notebook (Pod) readiness is typically tens of seconds, or minutes
+# for an image that needs to be pulled.
+_READY_BUCKETS = (5.0, 10.0, 20.0, 30.0, 45.0, 60.0, 90.0, 120.0, 180.0, 300.0, 600.0)
+
+CREATE_DURATION = prometheus_client.Histogram(
+    f"{_PREFIX}_create_duration_seconds",
+    "Duration of the notebook create handler",
+    buckets=_CREATE_BUCKETS,
+)
+CREATE_PHASE_DURATION = prometheus_client.Histogram(
+    f"{_PREFIX}_create_phase_duration_seconds",
+    "Duration of each phase of the notebook create handler",
+    ["phase"],
+    buckets=_CREATE_BUCKETS,
+)
+CREATES_IN_PROGRESS = prometheus_client.Gauge(
+    f"{_PREFIX}_creates_in_progress",
+    "Number of notebook create handlers currently running",
+)
+CREATE_RETRIES = prometheus_client.Counter(
+    f"{_PREFIX}_create_retries",
+    "Number of times the notebook create handler has been retried",
+)
+PERMANENT_ERRORS = prometheus_client.Counter(
+    f"{_PREFIX}_permanent_errors",
+    "Number of permanent errors raised by handlers",
+    ["version"],
+)
+
+API_CALL_DURATION = prometheus_client.Histogram(
+    f"{_PREFIX}_api_call_duration_seconds",
+    "Duration of Kubernetes API calls",
+    ["verb", "kind"],
+    buckets=_API_CALL_BUCKETS,
+)
+
+TIME_TO_READY = prometheus_client.Histogram(
+    f"{_PREFIX}_time_to_ready_seconds",
+    "Time from notebook creation to Jupyter responding",
+    ["image", "node"],
+    buckets=_READY_BUCKETS,
+)
+
+STARTUP_STEP_DURATION = prometheus_client.Histogram(
+    f"{_PREFIX}_startup_step_duration_seconds",
+    "Duration of each step of the (incremental) notebook startup script",
+    ["step"],
+    buckets=_CREATE_BUCKETS,
+)
+
+WARM_POOL_CLAIMS = prometheus_client.Counter(
+    f"{_PREFIX}_warm_pool_claims",
+    "Number of attempts to claim a standby Pod, by image and result (hit or miss)",
+    ["image", "result"],
+)
+WARM_POOL_STANDBY = prometheus_client.Gauge(
+    f"{_PREFIX}_warm_pool_standby_pods",
+    "Number of (running) standby Pods, by image",
+    ["image"],
+)
+
+PREPULL_IMAGES = prometheus_client.Gauge(
+    f"{_PREFIX}_prepull_images",
+    "Number of images pulled by the image pre-pull DaemonSet",
+)
+
+IDLE_TIMEOUT = prometheus_client.Gauge(
+    f"{_PREFIX}_idle_timeout_seconds",
+    "Idle time after which notebooks are culled (scaled to zero)",
+)
+NOTEBOOKS_CULLED = prometheus_client.Counter(
+    f"{_PREFIX}_notebooks_culled",
+    "Number of idle notebooks culled (scaled to zero)",
+)
+NOTEBOOKS_RESUMED = prometheus_client.Counter(
+    f"{_PREFIX}_notebooks_resumed",
+    "Number of culled notebooks resumed",
+)
+NOTEBOOKS_RESIZED = prometheus_client.Counter(
+    f"{_PREFIX}_notebooks_resized",
+    "Number of notebooks resized (or re-imaged),"
+    " by mode (InPlace, Restart or NotRunning)",
+    ["mode"],
+)
+
+ADMISSION_QUEUE_DEPTH = prometheus_client.Gauge(
+    f"{_PREFIX}_admission_queue_depth",
+    "Number of notebooks waiting to be admitted (launched)",
+)
+ADMISSION_LAUNCHING = prometheus_client.Gauge(
+    f"{_PREFIX}_admission_launching",
+    "Number of admitted notebooks that are launching (not yet ready)",
+)
+ADMISSION_WAIT = prometheus_client.Histogram(
+    f"{_PREFIX}_admission_wait_seconds",
+    "Time notebooks waited to be admitted (launched)",
+    buckets=_READY_BUCKETS,
+)
+
+WATCH_RECONNECTS = prometheus_client.Counter(
+    f"{_PREFIX}_watch_reconnects",
+    "Number of reconnections of the operator's own watches,"
+    " by resource and reason (timeout, expired, resync or error)",
+    ["resource", "reason"],
+)
+WATCH_EVENT_LAG = prometheus_client.Histogram(
+    f"{_PREFIX}_watch_event_lag_seconds",
+    "Time from an object's last change to the receipt of its watch event"
+    " (to the nearest second), by resource",
+    ["resource"],
+    buckets=(1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0),
+)
+WATCH_LAST_EVENT = prometheus_client.Gauge(
+    f"{_PREFIX}_watch_last_event_timestamp_seconds",
+    "Time of the last watch event received, by resource",
+    ["resource"],
+)
+
+SHARDS_OWNED = prometheus_client.Gauge(
+    f"{_PREFIX}_shards_owned",
+    "Number of notebook shards held by this operator replica",
+)
+SHARD_REPLICAS = prometheus_client.Gauge(
+    f"{_PREFIX}_shard_replicas",
+    "Number of live operator replicas (sharing the notebook shards)",
+)
+SHARD_ACQUISITIONS = prometheus_client.Counter(
+    f"{_PREFIX}_shard_acquisitions",
+    "Number of notebook shards acquired by this operator replica,"
+    " by reason (free or takeover, of a shard whose holder stopped renewing it)",
+    ["reason"],
+)
+
+RIGHTSIZING_SAMPLES = prometheus_client.Counter(
+    f"{_PREFIX}_rightsizing_samples",
+    "Number of notebook usage samples taken (for resource recommendations)",
+)
+RIGHTSIZING_APPLIED = prometheus_client.Counter(
+    f"{_PREFIX}_rightsizing_applied",
+    "Number of notebooks created with recommended resources",
+)
+
+SHARED_INGRESS_UPDATES = prometheus_client.Counter(
+    f"{_PREFIX}_shared_ingress_updates",
+    "Number of (batched) updates of the shared notebook Ingresses",
+)
+SHARED_INGRESS_COALESCED = prometheus_client.Counter(
+    f"{_PREFIX}_shared_ingress_coalesced_changes",
+    "Number of notebook path changes (additions and removals)"
+    " coalesced into another's shared Ingress update",
+)
+
+POD_PROBLEMS = prometheus_client.Counter(
+    f"{_PREFIX}_pod_problems",
+    "Number of problems (by reason) seen in notebook Pods",
+    ["reason"],
+)
+POD_STATUS_PATCHES = prometheus_client.Counter(
+    f"{_PREFIX}_pod_status_patches",
+    "Number of notebook status patches (of the notebook's Pod state)",
+)
+POD_EVENTS_COALESCED = prometheus_client.Counter(
+    f"{_PREFIX}_pod_events_coalesced",
+    "Number of notebook Pod changes coalesced into another's status patch",
+)
+
+RECONCILE_REPAIRS = prometheus_client.Counter(
+    f"{_PREFIX}_reconcile_repairs",
+    "Number of missing notebook objects (re-)created by the reconciler, by kind",
+    ["kind"],
+)
+RECONCILE_DURATION = prometheus_client.Histogram(
+    f"{_PREFIX}_reconcile_duration_seconds",
+    "Duration of each reconciler pass",
+    buckets=_CREATE_BUCKETS,
+)
+RECONCILE_LAST_PASS = prometheus_client.Gauge(
+    f"{_PREFIX}_reconcile_last_pass_timestamp_seconds",
+    "Time of the reconciler's last (completed) pass",
+)
+
+
+@contextlib.contextmanager
+def api_call_timer(verb: str, kind: str) -> Iterator[None]:
+    """A context manager that records the duration of a Kubernetes API call."""
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        API_CALL_DURATION.labels(verb, kind).observe(time.monotonic() - start)
+
+
+def serve(port: int) -> None:
+    """Starts the metrics HTTP server (in a daemon thread)."""
+    prometheus_client.start_http_server(port)
+
+
+def observe_watch_event(resource: str, event_type: str, obj: Mapping[str, Any]) -> None:
+    """Records the receipt of a watch event, and its lag: the time since
+    the object was last changed (the latest of its managed field times
+    and creation time) or, for deletions, since it was deleted.
+    """
+    WATCH_LAST_EVENT.labels(resource).set_to_current_time()
+    metadata = obj.get("metadata") or {}
+    if event_type == "DELETED":
+        changed = metadata.get("deletionTimestamp")
+    else:
+        changed = max(
+            [field.get("time") or "" for field in metadata.get("managedFields") or []]
+            + [metadata.get("creationTimestamp") or ""]
+        )
+    if changed:
+        changed_time = datetime.datetime.fromisoformat(changed.replace("Z", "+00:00"))
+        WATCH_EVENT_LAG.labels(resource).observe(
+            max(0.0, time.time() - changed_time.timestamp())
+        )
@@ -0,0 +1,216 @@
+"""The (typed and validated) spec of a notebook.
+
+'parse()' reads a notebook's spec (the Data Manager material, held in its
+'imDataManager' property) into a 'NotebookSpec', applying the defaults
+and checking every value the operator uses. A bad spec (a label without
+an '=', a malformed resource quantity, a missing project claim etc.)
+is rejected (with a 'SpecError') before any object is rendered or applied,
+rather than failing part way through creating the notebook's objects.
+"""
+
+import functools
+import os
+import re
+from decimal import Decimal
+from typing import Any, Mapping, NamedTuple, Optional, Tuple
+
+from kubernetes.utils import parse_quantity
+
+# Some (key) default deployment variables...
+DEFAULT_IMAGE: str = "jupyter/minimal-notebook:notebook-6.3.0"
+DEFAULT_SA: str = "default"
+DEFAULT_CPU_LIMIT: str = "1"
+DEFAULT_CPU_REQUEST: str = "10m"
+DEFAULT_MEM_LIMIT: str = "1Gi"
+DEFAULT_MEM_REQUEST: str = "256Mi"
+DEFAULT_USER_ID: int = 1000
+DEFAULT_GROUP_ID: int = 100
+DEFAULT_INGRESS_PROXY_BODY_SIZE: str = "500m"
+# The default ingress domain (must be provided).
+# The user can provide an alternative via the CR.
+DEFAULT_INGRESS_DOMAIN: str = os.environ["INGRESS_DOMAIN"]
+# The ingress TLS secret.
+# If provided it is used as the Ingress secret
+# and cert-manager is avoided.
+# The uer can provide their own via the CR.
+DEFAULT_INGRESS_TLS_SECRET: Optional[str] = os.environ.get("INGRESS_TLS_SECRET")
+# The ingress class
+DEFAULT_INGRESS_CLASS: str = "nginx"
+
+# A notebook's name is also the name of its Service (a DNS-1035 label)
+_NAME: re.Pattern[str] = re.compile(r"[a-z]([-a-z0-9]{0,61}[a-z0-9])?")
+# A label key (an optional DNS subdomain prefix and a name) and value
+_LABEL_KEY: re.Pattern[str] = re.compile(
+    r"([a-z0-9]([-a-z0-9]*[a-z0-9])?(\.[a-z0-9]([-a-z0-9]*[a-z0-9])?)*/)?"
+    r"[A-Za-z0-9]([-A-Za-z0-9_.]{0,61}[A-Za-z0-9])?"
+)
+_LABEL_VALUE: re.Pattern[str] = re.compile(
+    r"([A-Za-z0-9]([-A-Za-z0-9_.]{0,61}[A-Za-z0-9])?)?"
+)
+_LABEL_KEY_PREFIX_LENGTH: int = 253
+
+
+# Specs use a handful of distinct quantities, so their values are cached
+@functools.lru_cache(maxsize=256)
+def _quantity_value(quantity: Any) -> Decimal:
+    value: Decimal = parse_quantity(quantity)
+    return value
+
+
+class SpecError(ValueError):
+    """A notebook spec is invalid."""
+
+
+class NotebookSpec(NamedTuple):
+    """A notebook's (validated) spec, with defaults applied."""
+
+    name: str
+    image: str
+    interface: str
+    service_account: str
+    cpu_request: str
+    cpu_limit: str
+    memory_request: str
+    memory_limit: str
+    run_as_user: int
+    run_as_group: int
+    project_id: str
+    project_claim_name: str
+    ingress_class: str
+    ingress_domain: str
+    ingress_tls_secret: Optional[str]
+    ingress_proxy_body_size: str
+    # The Data Manager labels (key and value)
+    labels: Tuple[Tuple[str, str], ...]
+    # The owner and instance ID (from the labels)
+    owner: str
+    instance_id: str
+
+
+# The functions that read (and check) a value from an object of the spec.
+# Each is given the value's (dotted) path, for its error message.
+
+
+def _object(values: Mapping[str, Any], path: str) -> Mapping[str, Any]:
+    value = values.get(path.rpartition(".")[2], {})
+    if not isinstance(value, Mapping):
+        raise SpecError(f"'{path}' must be an object")
+    return value
+
+
+def _string(values: Mapping[str, Any], path: str, default: Optional[str]) -> str:
+    value = values.get(path.rpartition(".")[2], default)
+    if not isinstance(value, str) or not value:
+        raise SpecError(f"'{path}' must be a (non-empty) string")
+    return value
+
+
+def _integer(values: Mapping[str, Any], path: str, default: int) -> int:
+    value = values.get(path.rpartition(".")[2], default)
+    if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+        raise SpecError(f"'{path}' must be a (non-negative) integer")
+    return int(value)
+
+
+def _quantity(values: Mapping[str, Any], path: str, default: str) -> str:
+    value = values.get(path.rpartition(".")[2], default)
+    try:
+        _quantity_value(value)
+    except (TypeError, ValueError) as ex:
+        raise SpecError(f"'{path}' ({value!r}) is not a valid quantity") from ex
+    return str(value)
+
+
+def _label(label: Any) -> Tuple[str, str]:
+    if not isinstance(label, str) or label.count("=") != 1:
+        raise SpecError(f"Label {label!r} is not of the form 'key=value'")
+    key, value = label.split("=")
+    prefix = key.rpartition("/")[0]
+    if (
+        not _LABEL_KEY.fullmatch(key)
+        or len(prefix) > _LABEL_KEY_PREFIX_LENGTH
+        or not _LABEL_VALUE.fullmatch(value)
+    ):
+        raise SpecError(f"Label {label!r} is not a valid Kubernetes label")
+    return key, value
+
+
+def parse(name: str, spec: Mapping[str, Any]) -> NotebookSpec:
+    """Parses (and validates) the spec of the named notebook,
+    raising a SpecError if it is invalid.
+    """
+    if not isinstance(name, str) or not _NAME.fullmatch(name):
+        raise SpecError(f"Name {name!r} is not a valid (DNS-1035) Service name")
+    if not isinstance(spec, Mapping):
+        raise SpecError("The spec must be an object")
+    # All Data-Manager provided material
+    # will be namespaced under the 'imDataManager' property
+    material = _object(spec, "imDataManager")
+
+    resources = _object(material, "resources")
+    requests = _object(resources, "resources.requests")
+    limits = _object(resources, "resources.limits")
+    cpu_request = _quantity(requests, "resources.requests.cpu", DEFAULT_CPU_REQUEST)
+    cpu_limit = _quantity(limits, "resources.limits.cpu", DEFAULT_CPU_LIMIT)
+    memory_request = _quantity(
+        requests, "resources.requests.memory", DEFAULT_MEM_REQUEST
+    )
+    memory_limit = _quantity(limits, "resources.limits.memory", DEFAULT_MEM_LIMIT)
+    if _quantity_value(cpu_request) > _quantity_value(cpu_limit):
+        raise SpecError(f"The CPU request ({cpu_request}) exceeds its limit")
+    if _quantity_value(memory_request) > _quantity_value(memory_limit):
+        raise SpecError(f"The memory request ({memory_request}) exceeds its limit")
+
+    security_context = _object(material, "securityContext")
+    project = _object(material, "project")
+
+    labels = material.get("labels", [])
+    if not isinstance(labels, list):
+        raise SpecError("'labels' must be a list")
+    parsed_labels = tuple(_label(label) for label in labels)
+    # The owner and instance ID come from the keys ending
+    # '/owner' and '/instance-id'
+    owner = "Unknown"
+    instance_id = "Unknown"
+    for key, value in parsed_labels:
+        if key.endswith("/owner"):
+            owner = value
+        elif key.endswith("/instance-id"):
+            instance_id = value
+
+    ingress_tls_secret = material.get("ingressTlsSecret", DEFAULT_INGRESS_TLS_SECRET)
+    if ingress_tls_secret is not None and not isinstance(ingress_tls_secret, str):
+        raise SpecError("'ingressTlsSecret' must be a string")
+    ingress_proxy_body_size = material.get(
+        "ingressProxyBodySize", DEFAULT_INGRESS_PROXY_BODY_SIZE
+    )
+    if isinstance(ingress_proxy_body_size, bool) or not isinstance(
+        ingress_proxy_body_size, (str, int)
+    ):
+        raise SpecError("'ingressProxyBodySize' must be a string")
+
+    return NotebookSpec(
+        name=name,
+        image=_string(material, "image", DEFAULT_IMAGE),
+        interface=_string(_object(material, "notebook"), "notebook.interface", "lab"),
+        service_account=_string(material, "serviceAccountName", DEFAULT_SA),
+        cpu_request=cpu_request,
+        cpu_limit=cpu_limit,
+        memory_request=memory_request,
+        memory_limit=memory_limit,
+        run_as_user=_integer(
+            security_context, "securityContext.runAsUser", DEFAULT_USER_ID
+        ),
+        run_as_group=_integer(
+            security_context, "securityContext.runAsGroup", DEFAULT_GROUP_ID
+        ),
+        project_id=_string(project, "project.id", None),
+        project_claim_name=_string(project, "project.claimName", None),
+        ingress_class=_string(material, "ingressClass", DEFAULT_INGRESS_CLASS),
+        ingress_domain=_string(material, "ingressDomain", DEFAULT_INGRESS_DOMAIN),
+        ingress_tls_secret=ingress_tls_secret,
+        ingress_proxy_body_size=str(ingress_proxy_body_size),
+        labels=parsed_labels,
+        owner=owner,
+        instance_id=instance_id,
+    )
@@ -0,0 +1,190 @@
+"""A package (and environment) cache shared by the notebooks on each node.
+
+A notebook's HOME is on its project volume (typically network storage),
+so every pip or conda download (and anything else cached in '~/.cache')
+goes to slow storage and is repeated by every notebook instance.
+With a package cache (see JO_PACKAGE_CACHE) notebook Pods mount a cache
+directory, node-local (a host path) or a (ReadWriteMany) PVC, and their
+pip, conda package and XDG caches are moved into it.
+
+The cache is divided by notebook owner (the instance owner label).
+A notebook Pod only mounts its owner's directory of the cache (a 'subPath'
+of the cache volume), so one user's notebooks cannot place packages
+in (or create) another's cache.
+
+A node-local cache is maintained by a (managed) 'janitor' DaemonSet,
+whose Pods run on the notebook nodes. Each makes the cache directory
+writable (by all notebook users) and, every 'eviction interval',
+if the cache exceeds its size cap, deletes the least recently used files
+until it's below 90% of the cap.
+"""
+
+import asyncio
+import logging
+import os
+import re
+from typing import Any, Callable, Dict, List, Optional
+
+import kubernetes
+
+import kube
+
+# Use a package cache?
+# Any value results in notebook Pods mounting a package cache, node-local
+# (the host path) or, if a claim is named, the (ReadWriteMany) PVC of that name
+# (which must exist in each notebook namespace).
+# A node-local cache is capped at 'size' (MiB) by a DaemonSet
+# (in the given namespace) that evicts files every 'eviction interval' (seconds).
+PACKAGE_CACHE: Optional[str] = os.environ.get("JO_PACKAGE_CACHE")
+CLAIM: Optional[str] = os.environ.get("JO_PACKAGE_CACHE_CLAIM")
+HOST_PATH: str = os.environ.get("JO_PACKAGE_CACHE_HOST_PATH", "/var/cache/notebooks")
+SIZE: int = int(os.environ.get("JO_PACKAGE_CACHE_SIZE", "20480"))
+EVICTION_INTERVAL: int = int(
+    os.environ.get("JO_PACKAGE_CACHE_EVICTION_INTERVAL", "600")
+)
+NAMESPACE: str = os.environ.get("JO_PACKAGE_CACHE_NAMESPACE", "jupyter")
+JANITOR_IMAGE: str = os.environ.get("JO_PACKAGE_CACHE_JANITOR_IMAGE", "busybox:1.36")
+
+# Where the (owner's directory of the) cache is mounted (in notebook containers)
+MOUNT_PATH: str = "/var/cache/notebooks"
+
+# The name of the janitor DaemonSet (and its label)
+_DAEMON_SET_NAME: str = "jupyter-package-cache"
+_JANITOR_LABEL: str = "squonk.it/jupyter-package-cache"
+# The period (seconds) between checks of the janitor DaemonSet
+_JANITOR_CHECK_INTERVAL: int = 600
+
+# The janitor script, run (as root) on each node with the cache at '/cache'.
+# Files are evicted least recently used (accessed) first.
+_JANITOR: str = r"""chmod 1777 /cache
+size=$(( CACHE_SIZE * 1024 ))
+target=$(( size * 9 / 10 ))
+while true; do
+    used=$(du -sk /cache | cut -f1)
+    if [ "$used" -gt "$size" ]; then
+        echo "Cache is ${used}KiB, evicting to ${target}KiB"
+        find /cache -type f -exec stat -c '%X %s %n' {} + | sort -n | \
+        while read -r accessed bytes path; do
+            [ "$used" -le "$target" ] && break
+            rm -f "$path" && used=$(( used - bytes / 1024 ))
+        done
+        find /cache -mindepth 2 -type d -empty -delete
+    fi
+    sleep "$EVICTION_INTERVAL"
+done
+"""
+
+
+def _owner_directory(owner: str) -> str:
+    """The cache directory (relative to the root of the cache)
+    of a notebook owner.
+    """
+    return re.sub(r"[^A-Za-z0-9._-]", "_", owner) or "_"
+
+
+def volume() -> Dict[str, Any]:
+    """The package cache volume (of notebook Pods)."""
+    if CLAIM:
+        return {"name": "package-cache", "persistentVolumeClaim": {"claimName": CLAIM}}
+    return {
+        "name": "package-cache",
+        "hostPath": {"path": HOST_PATH, "type": "DirectoryOrCreate"},
+    }
+
+
+def volume_mount(owner: str) -> Dict[str, Any]:
+    """The package cache volume mount (of notebook containers),
+    the directory of the notebook's owner. The kubelet creates the directory
+    (with the mode of the cache's root) if it does not exist.
+    """
+    return {
+        "name": "package-cache",
+        "mountPath": MOUNT_PATH,
+        "subPath": _owner_directory(owner),
+    }
+
+
+# The environment variables that move a notebook's pip, conda (package)
+# and XDG caches into the (owner's directory of the) package cache.
+# Conda falls back to the notebook's own package directory
+# if the cache is not writable.
+ENV: List[Dict[str, str]] = [
+    {"name": "PIP_CACHE_DIR", "value": f"{MOUNT_PATH}/pip"},
+    {"name": "CONDA_PKGS_DIRS", "value": f"{MOUNT_PATH}/conda,~/.conda/pkgs"},
+    {"name": "XDG_CACHE_HOME", "value": f"{MOUNT_PATH}/xdg"},
+]
+
+
+def _janitor_body(pod_template: Dict[str, Any]) -> Dict[str, Any]:
+    """The janitor DaemonSet."""
+    pod_spec: Dict[str, Any] = dict(pod_template)
+    pod_spec.update(
+        {
+            "terminationGracePeriodSeconds": 0,
+            "automountServiceAccountToken": False,
+            "containers": [
+                {
+                    "name": "janitor",
+                    "image": JANITOR_IMAGE,
+                    "command": ["sh", "-c", _JANITOR],
+                    "env": [
+                        {"name": "CACHE_SIZE", "value": str(SIZE)},
+                        {"name": "EVICTION_INTERVAL", "value": str(EVICTION_INTERVAL)},
+                    ],
+                    "volumeMounts": [{"name": "cache", "mountPath": "/cache"}],
+                    "resources": {
+                        "requests": {"cpu": "1m", "memory": "8Mi"},
+                        "limits": {"cpu": "100m", "memory": "64Mi"},
+                    },
+                }
+            ],
+            "volumes": [
+                {
+                    "name": "cache",
+                    "hostPath": {"path": HOST_PATH, "type": "DirectoryOrCreate"},
+                }
+            ],
+        }
+    )
+    return {
+        "apiVersion": "apps/v1",
+        "kind": "DaemonSet",
+        "metadata": {
+            "name": _DAEMON_SET_NAME,
+            "namespace": NAMESPACE,
+            "labels": {_JANITOR_LABEL: "yes"},
+        },
+        "spec": {
+            "selector": {"matchLabels": {_JANITOR_LABEL: "yes"}},
+            "template": {
+                "metadata": {"labels": {_JANITOR_LABEL: "yes"}},
+                "spec": pod_spec,
+            },
+        },
+    }
+
+
+async def maintain(
+    api_client: kubernetes.client.ApiClient,
+    pod_template: Dict[str, Any],
+    leader: Optional[Callable[[], bool]] = None,
+) -> None:
+    """A background task that periodically applies the janitor DaemonSet
+    (if there's a 'leader' function, only while it returns True).
+    The Pod template provides the spec (node selector etc.)
+    of the DaemonSet Pods.
+    """
+    body = _janitor_body(pod_template)
+    while True:
+        if leader and not leader():
+            await asyncio.sleep(_JANITOR_CHECK_INTERVAL)
+            continue
+        try:
+            await kube.apply(api_client, "DaemonSet", NAMESPACE, body)
+        except kubernetes.client.exceptions.ApiException as ex:
+            logging.warning(
+                "Got ApiException [%s/%s] applying the package cache DaemonSet",
+                ex.status,
+                ex.reason,
+            )
+        await asyncio.sleep(_JANITOR_CHECK_INTERVAL)
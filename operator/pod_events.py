@@ -0,0 +1,399 @@
+"""Reports the state (and problems) of each notebook's Pod in its status.
+
+Rather than clients polling each notebook (or its URL) to learn its state,
+the operator watches the notebook Pods (those with the operator's notebook
+label, sharing the readiness tracker's watch if readiness is tracked)
+and writes the state of each notebook's Pod to its 'status.pod', so a single watch
+(of the notebooks) is enough: -
+
+-   name, node, phase, ready and (container) restarts
+-   problems    A list of the Pod's current problems, each with a 'reason'
+                (Unschedulable, ErrImagePull, ImagePullBackOff, InvalidImageName,
+                CreateContainerConfigError, CrashLoopBackOff, OOMKilled
+                or Evicted), a 'message' and the time it was first seen ('since')
+
+'status.pod' is removed when the notebook's Pod is deleted (e.g. culled).
+Pod events are coalesced: a notebook's status is patched (with its latest
+state) 'window' seconds after its first change, and only if the state differs
+from that last written. Patches (across all notebooks) are limited to 'rate'
+each second.
+The probe here is registered by importing this module
+(as the operator's 'handlers' module does).
+"""
+
+import asyncio
+import datetime
+import functools
+import logging
+import os
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+import kopf
+import kubernetes
+
+from informer import Informer
+import kube
+import metrics
+
+# Report notebook Pod state (and problems)?
+# Any value results in the operator writing the state of each notebook's Pod
+# to its status. Changes are coalesced for 'window' seconds and at most
+# 'patch rate' status patches are made each second.
+POD_EVENTS: Optional[str] = os.environ.get("JO_POD_EVENTS")
+PATCH_RATE: float = float(os.environ.get("JO_POD_EVENTS_PATCH_RATE", "5"))
+WINDOW: float = float(os.environ.get("JO_POD_EVENTS_WINDOW", "2"))
+
+# The label (set on every notebook Pod) whose value is the notebook name.
+# It's the operator's own, so other Pods (with a 'deployment' label,
+# which would only cost failing status patches) are not seen.
+_POD_LABEL: str = kube.NOTEBOOK_LABEL
+# The name of the notebook container
+_CONTAINER_NAME: str = "notebook"
+# The key (in a notebook's status) of its Pod state
+_STATUS_KEY: str = "pod"
+# The (waiting) reasons of the notebook container that are problems
+_WAITING_PROBLEMS: Set[str] = {
+    "ErrImagePull",
+    "ImagePullBackOff",
+    "InvalidImageName",
+    "CreateContainerConfigError",
+    "CrashLoopBackOff",
+}
+
+# The number of attempts made to patch a notebook's status
+_PATCH_ATTEMPTS: int = 3
+
+
+def _now() -> str:
+    """The current time, as a Kubernetes (RFC 3339) timestamp."""
+    return datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def pod_state(
+    pod: Dict[str, Any], previous: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    """Folds a notebook Pod into its state (for the notebook's status).
+    Problems already in the 'previous' state keep the time they were first seen.
+    """
+    status = pod.get("status") or {}
+    conditions = {
+        condition["type"]: condition for condition in status.get("conditions") or []
+    }
+    container: Dict[str, Any] = next(
+        (
+            container
+            for container in status.get("containerStatuses") or []
+            if container["name"] == _CONTAINER_NAME
+        ),
+        {},
+    )
+    now = _now()
+
+    # The problems (reason, message and since)
+    problems: List[Tuple[str, str, str]] = []
+    scheduled = conditions.get("PodScheduled", {})
+    if (
+        scheduled.get("status") == "False"
+        and scheduled.get("reason") == "Unschedulable"
+    ):
+        problems.append(
+            (
+                "Unschedulable",
+                scheduled.get("message", ""),
+                scheduled.get("lastTransitionTime") or now,
+            )
+        )
+    if status.get("reason") == "Evicted":
+        problems.append(("Evicted", status.get("message", ""), now))
+    waiting = (container.get("state") or {}).get("waiting") or {}
+    if waiting.get("reason") in _WAITING_PROBLEMS:
+        problems.append((waiting["reason"], waiting.get("message", ""), now))
+    for state in (container.get("state"), container.get("lastState")):
+        terminated = (state or {}).get("terminated") or {}
+        if terminated.get("reason") == "OOMKilled":
+            problems.append(
+                (
+                    "OOMKilled",
+                    f"The notebook container ran out of memory"
+                    f" (exit code {terminated.get('exitCode')})",
+                    terminated.get("finishedAt") or now,
+                )
+            )
+            break
+
+    seen = {
+        problem["reason"]: problem["since"]
+        for problem in (previous or {}).get("problems") or []
+    }
+    return {
+        "name": pod["metadata"]["name"],
+        "node": (pod.get("spec") or {}).get("nodeName", ""),
+        "phase": status.get("phase", "Unknown"),
+        "ready": conditions.get("Ready", {}).get("status") == "True",
+        "restarts": container.get("restartCount", 0),
+        "problems": [
+            {"reason": reason, "message": message, "since": seen.get(reason, since)}
+            for reason, message, since in problems
+        ],
+    }
+
+
+class _Notebook:
+    """The Pod state of a notebook (that we've seen a Pod for)."""
+
+    def __init__(self, namespace: str, name: str) -> None:
+        self.namespace = namespace
+        self.name = name
+        # The (UID of the) notebook's current Pod
+        self.pod_uid: Optional[str] = None
+        # The notebook's current Pod state (None if it has no Pod)
+        # and that last written to its status.
+        self.state: Optional[Dict[str, Any]] = None
+        self.patched: Optional[Dict[str, Any]] = None
+        # Is a patch (of the notebook's status) scheduled?
+        self.pending: bool = False
+        self.attempts: int = 0
+
+
+class PodEventReporter:
+    """Folds notebook Pod events into (coalesced and rate-limited)
+    patches of the notebooks' status.
+
+    Pod events are received in the informer's thread (or from the readiness
+    tracker's) and handled in the event loop.
+    """
+
+    def __init__(
+        self,
+        api_client: kubernetes.client.ApiClient,
+        request_timeout: Tuple[int, int],
+        patch_rate: float,
+        window: float,
+        watch: bool = True,
+        owns: Optional[Callable[[str, str], bool]] = None,
+    ) -> None:
+        """Each notebook's status is patched 'window' seconds after its Pod
+        first changes, with at most 'patch_rate' patches (of all notebooks)
+        each second. With 'watch' we watch notebook Pods, otherwise Pod events
+        are passed to 'observe_all()' and 'observe()' (e.g. by the readiness
+        tracker). If there's an 'owns' function only the
+        notebooks it returns True for have their status patched.
+        """
+        self._api_client = api_client
+        self._patch_interval = 1 / patch_rate
+        self._window = window
+        self._owns = owns
+        self._loop = asyncio.get_running_loop()
+        self._notebooks: Dict[Tuple[str, str], _Notebook] = {}
+        # The notebooks whose status is due to be patched (in order)
+        self._due: asyncio.Queue[_Notebook] = asyncio.Queue()
+        self._patcher: Optional[asyncio.Task[None]] = None
+        self._patches: Set[asyncio.Task[None]] = set()
+        self._events: int = 0
+        self._coalesced: int = 0
+        self._informers: List[Informer] = []
+        if watch:
+            core_api = kubernetes.client.CoreV1Api(api_client)
+            # An informer for each namespace we watch (or one for all of them)
+            self._informers = [
+                Informer(
+                    "PodEvents",
+                    list_function,
+                    _POD_LABEL,
+                    request_timeout,
+                    on_list=functools.partial(self._receive_list, namespace),
+                    on_event=self._receive_event,
+                )
+                for namespace, list_function in kube.scoped(
+                    core_api.list_pod_for_all_namespaces, core_api.list_namespaced_pod
+                ).items()
+            ]
+
+    def start(self) -> None:
+        """Starts reporting. The Pod state already in each notebook's status
+        is read first (so an unchanged state is not written again).
+        """
+        self._patcher = asyncio.create_task(self._start())
+        for informer in self._informers:
+            informer.start()
+
+    def stop(self) -> None:
+        """Stops reporting (and watching Pods)."""
+        for informer in self._informers:
+            informer.stop()
+        if self._patcher:
+            self._patcher.cancel()
+        for patch in self._patches:
+            patch.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns a summary of the reporter (for the operator's probes)."""
+        return {
+            "synced": all(informer.synced for informer in self._informers),
+            "notebooks": len(self._notebooks),
+            "events": self._events,
+            "coalesced": self._coalesced,
+            "due": self._due.qsize(),
+            "problems": sum(
+                1
+                for notebook in self._notebooks.values()
+                if notebook.state and notebook.state["problems"]
+            ),
+        }
+
+    def observe_all(self, namespace: str, pods: List[Dict[str, Any]]) -> None:
+        """Handles the (re-)listing of the notebook Pods of a namespace
+        (or all namespaces if it's ''), in the event loop.
+        Pods deleted since they were last seen are removed.
+        """
+        listed = {pod["metadata"].get("uid") for pod in pods}
+        for notebook in list(self._notebooks.values()):
+            if (
+                notebook.pod_uid
+                and notebook.pod_uid not in listed
+                and (not namespace or notebook.namespace == namespace)
+            ):
+                self._update(notebook, None, None)
+        for pod in pods:
+            self.observe("ADDED", pod)
+
+    def observe(self, event_type: str, pod: Dict[str, Any]) -> None:
+        """Handles a notebook Pod event (in the event loop)."""
+        self._events += 1
+        metadata = pod["metadata"]
+        key = (metadata["namespace"], metadata["labels"][_POD_LABEL])
+        notebook = self._notebooks.get(key)
+        if notebook is None:
+            notebook = _Notebook(*key)
+            self._notebooks[key] = notebook
+        if event_type == "DELETED":
+            # Only the deletion of the notebook's current Pod matters
+            # (its replacement may already have been seen).
+            if metadata.get("uid") == notebook.pod_uid:
+                self._update(notebook, None, None)
+        else:
+            self._update(
+                notebook,
+                metadata.get("uid"),
+                pod_state(pod, notebook.state or notebook.patched),
+            )
+
+    def _update(
+        self,
+        notebook: _Notebook,
+        pod_uid: Optional[str],
+        state: Optional[Dict[str, Any]],
+    ) -> None:
+        """Records a notebook's (new) Pod and its state
+        (None if it no longer has one), scheduling a patch if it has changed.
+        """
+        notebook.pod_uid = pod_uid
+        if state == notebook.state:
+            return
+        for problem in (state or {}).get("problems", []):
+            if problem["reason"] not in {
+                known["reason"] for known in (notebook.state or {}).get("problems", [])
+            }:
+                logging.info(
+                    "Notebook %s (namespace=%s) has a problem (%s)",
+                    notebook.name,
+                    notebook.namespace,
+                    problem["reason"],
+                )
+                metrics.POD_PROBLEMS.labels(problem["reason"]).inc()
+        notebook.state = state
+        self._schedule(notebook)
+
+    def _receive_list(self, namespace: str, pods: List[Dict[str, Any]]) -> None:
+        """Hands listed Pods (from the informer thread) to the event loop."""
+        self._loop.call_soon_threadsafe(self.observe_all, namespace, pods)
+
+    def _receive_event(self, event_type: str, pod: Dict[str, Any]) -> None:
+        """Hands a Pod event (from the informer thread) to the event loop."""
+        self._loop.call_soon_threadsafe(self.observe, event_type, pod)
+
+    def _schedule(self, notebook: _Notebook) -> None:
+        """Schedules a patch of the notebook's status (at the end of the window).
+        Changes made before then are coalesced into the same patch.
+        """
+        if notebook.pending:
+            self._coalesced += 1
+            metrics.POD_EVENTS_COALESCED.inc()
+            return
+        notebook.pending = True
+        self._loop.call_later(self._window, self._due.put_nowait, notebook)
+
+    async def _start(self) -> None:
+        """Reads the Pod state in the status of existing notebooks
+        and then patches the status of notebooks as they become due.
+        """
+        try:
+            for body in await kube.list_notebooks(self._api_client):
+                metadata = body["metadata"]
+                key = (metadata["namespace"], metadata["name"])
+                state = (body.get("status") or {}).get(_STATUS_KEY)
+                if state:
+                    notebook = self._notebooks.setdefault(key, _Notebook(*key))
+                    notebook.patched = state
+        except kubernetes.client.exceptions.ApiException as ex:
+            logging.warning(
+                "Got ApiException [%s/%s] listing notebooks", ex.status, ex.reason
+            )
+        next_patch = self._loop.time()
+        while True:
+            notebook = await self._due.get()
+            notebook.pending = False
+            if notebook.state == notebook.patched or (
+                self._owns and not self._owns(notebook.namespace, notebook.name)
+            ):
+                continue
+            # Limit the rate of patches (of all notebooks)
+            now = self._loop.time()
+            if next_patch > now:
+                await asyncio.sleep(next_patch - now)
+            next_patch = max(now, next_patch) + self._patch_interval
+            patch = asyncio.create_task(self._patch(notebook))
+            self._patches.add(patch)
+            patch.add_done_callback(self._patches.discard)
+
+    async def _patch(self, notebook: _Notebook) -> None:
+        """Writes a notebook's (latest) Pod state to its status."""
+        state = notebook.state
+        try:
+            await kube.patch_notebook_status(
+                self._api_client,
+                notebook.namespace,
+                notebook.name,
+                {_STATUS_KEY: state},
+            )
+        except kubernetes.client.exceptions.ApiException as ex:
+            if ex.status == 404:
+                # The notebook's gone
+                self._notebooks.pop((notebook.namespace, notebook.name), None)
+                return
+            notebook.attempts += 1
+            logging.warning(
+                "Got ApiException [%s/%s] patching %s status (attempt %s)",
+                ex.status,
+                ex.reason,
+                notebook.name,
+                notebook.attempts,
+            )
+            if notebook.attempts < _PATCH_ATTEMPTS:
+                self._schedule(notebook)
+            return
+        notebook.attempts = 0
+        notebook.patched = state
+        metrics.POD_STATUS_PATCHES.inc()
+        # A notebook without a Pod is forgotten (until it has one again)
+        if state is None and notebook.state is None and not notebook.pending:
+            self._notebooks.pop((notebook.namespace, notebook.name), None)
+
+
+@kopf.on.probe(id="podEvents")
+def pod_events_probe(memo: kopf.Memo, **_: Any) -> Dict[str, Any]:
+    """Exposes the Pod event reporter statistics (events, coalesced etc.)
+    through the operator's health endpoint (if enabled).
+    """
+    reporter: Optional[PodEventReporter] = memo.get("pod_events")
+    return reporter.stats() if reporter else {}
@@ -0,0 +1,292 @@
+"""Keeps the most popular notebook images pulled on the notebook nodes.
+
+The images of the notebooks are ranked by frequency and recency
+(each notebook adds one to its image's score, halving every 'half-life'
+since the notebook was created). The images are scored from the listed
+notebooks (shared state) rather than the launches a replica sees, so when
+sharding the leader ranks the launches of every replica, and a new leader
+starts where the old one left off.
+The top-ranked images are pulled by a (managed) DaemonSet, whose Pods run on
+the notebook nodes. Each image is an init container (that does nothing)
+followed by a 'pause' container that keeps the Pod (and its images) in place.
+
+Mutable tags ('latest' and 'stable') are pulled 'Always' and, to refresh them,
+the DaemonSet is rolled (its Pods replaced) every 'refresh interval'.
+"""
+
+import asyncio
+import datetime
+import hashlib
+import logging
+import os
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import kubernetes
+
+import kube
+import metrics
+import notebook_spec
+
+# Pre-pull notebook images?
+# Any value results in the most popular notebook images (at most 'max images',
+# ranked by notebooks, whose weight halves every 'half-life' seconds)
+# being pulled on the notebook nodes by a DaemonSet (in the given namespace).
+# The DaemonSet is checked every 'interval' and, to refresh mutable tags
+# (latest and stable), rolled every 'refresh interval' (seconds).
+PREPULL: Optional[str] = os.environ.get("JO_PREPULL")
+NAMESPACE: str = os.environ.get("JO_PREPULL_NAMESPACE", "jupyter")
+MAX_IMAGES: int = int(os.environ.get("JO_PREPULL_MAX_IMAGES", "5"))
+HALF_LIFE: int = int(os.environ.get("JO_PREPULL_HALF_LIFE", "86400"))
+INTERVAL: int = int(os.environ.get("JO_PREPULL_INTERVAL", "60"))
+REFRESH_INTERVAL: int = int(os.environ.get("JO_PREPULL_REFRESH_INTERVAL", "21600"))
+PAUSE_IMAGE: str = os.environ.get(
+    "JO_PREPULL_PAUSE_IMAGE", "registry.k8s.io/pause:3.10"
+)
+
+# The name of the DaemonSet (and its label)
+_DAEMON_SET_NAME: str = "jupyter-image-prepull"
+_PREPULL_LABEL: str = "squonk.it/jupyter-prepull"
+# The DaemonSet Pod template annotation used to roll the DaemonSet
+_REFRESH_ANNOTATION: str = "squonk.it/prepull-refresh"
+# Images scoring less than this (i.e. not used for several half-lives)
+# are no longer pre-pulled.
+_MIN_SCORE: float = 0.1
+# Image tags that are pulled 'Always'
+_MUTABLE_TAGS: Tuple[str, ...] = ("latest", "stable")
+
+
+def _is_mutable(image: str) -> bool:
+    image_parts = image.split(":")
+    image_tag = "latest" if len(image_parts) == 1 else image_parts[1]
+    return image_tag.lower() in _MUTABLE_TAGS
+
+
+def _timestamp(created: Optional[str]) -> float:
+    """The time (seconds since the epoch) of a Kubernetes (RFC 3339)
+    timestamp, now if there isn't one.
+    """
+    if not created:
+        return time.time()
+    return datetime.datetime.fromisoformat(created.replace("Z", "+00:00")).timestamp()
+
+
+class ImagePrePuller:
+    """Ranks the images of the notebooks and maintains
+    a DaemonSet that pulls the top-ranked ones.
+    """
+
+    def __init__(
+        self,
+        api_client: kubernetes.client.ApiClient,
+        namespace: str,
+        max_images: int,
+        half_life: int,
+        pod_template: Dict[str, Any],
+        pause_image: str,
+    ) -> None:
+        """Creates the pre-puller. The Pod template provides the spec
+        (node selector etc.) of the DaemonSet Pods.
+        """
+        self._api_client = api_client
+        self._apps_api = kubernetes.client.AppsV1Api(api_client)
+        self._namespace = namespace
+        self._max_images = max_images
+        self._half_life = half_life
+        self._pod_template = pod_template
+        self._pause_image = pause_image
+        # The score of each image (when the notebooks were last listed)
+        self._scores: Dict[str, float] = {}
+        # The images (and refresh period) of the current DaemonSet
+        self._pulling: Optional[Tuple[List[str], int]] = None
+        self._reconciler: Optional[asyncio.Task[None]] = None
+
+    def start(
+        self,
+        interval: float,
+        refresh_interval: int,
+        leader: Optional[Callable[[], bool]] = None,
+    ) -> None:
+        """Starts maintaining the DaemonSet. If there is a 'leader' function
+        the DaemonSet is only maintained while it returns True.
+        """
+        self._reconciler = asyncio.create_task(
+            self._reconcile(interval, refresh_interval, leader)
+        )
+
+    def stop(self) -> None:
+        """Stops maintaining the DaemonSet (which is left in place)."""
+        if self._reconciler:
+            self._reconciler.cancel()
+
+    def score(self, notebooks: List[Dict[str, Any]]) -> None:
+        """Scores the images of the (listed) notebooks."""
+        now = time.time()
+        scores: Dict[str, float] = {}
+        for notebook in notebooks:
+            metadata = notebook["metadata"]
+            try:
+                spec = notebook_spec.parse(metadata["name"], notebook.get("spec") or {})
+            except notebook_spec.SpecError:
+                continue
+            age = max(0.0, now - _timestamp(metadata.get("creationTimestamp")))
+            scores[spec.image] = scores.get(spec.image, 0.0) + 0.5 ** (
+                age / self._half_life
+            )
+        self._scores = scores
+
+    def ranked(self) -> List[str]:
+        """The images to pre-pull (the highest scoring first)."""
+        scored = sorted(
+            ((score, image) for image, score in self._scores.items()), reverse=True
+        )
+        return [image for score, image in scored if score >= _MIN_SCORE][
+            : self._max_images
+        ]
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns a summary of the pre-puller (for the operator's probes)."""
+        return {
+            "scores": {image: round(score, 2) for image, score in self._scores.items()},
+            "pulling": self._pulling[0] if self._pulling else [],
+        }
+
+    def _daemon_set_body(self, images: List[str], refresh: int) -> Dict[str, Any]:
+        pod_spec: Dict[str, Any] = dict(self._pod_template)
+        pod_spec.update(
+            {
+                "terminationGracePeriodSeconds": 0,
+                "automountServiceAccountToken": False,
+                "initContainers": [
+                    {
+                        "name": "pull-"
+                        + hashlib.sha256(image.encode()).hexdigest()[:12],
+                        "image": image,
+                        "imagePullPolicy": (
+                            "Always" if _is_mutable(image) else "IfNotPresent"
+                        ),
+                        "command": ["true"],
+                        "resources": {
+                            "requests": {"cpu": "1m", "memory": "8Mi"},
+                            "limits": {"cpu": "50m", "memory": "64Mi"},
+                        },
+                    }
+                    for image in images
+                ],
+                "containers": [
+                    {
+                        "name": "pause",
+                        "image": self._pause_image,
+                        "resources": {
+                            "requests": {"cpu": "1m", "memory": "8Mi"},
+                            "limits": {"cpu": "50m", "memory": "64Mi"},
+                        },
+                    }
+                ],
+            }
+        )
+        return {
+            "apiVersion": "apps/v1",
+            "kind": "DaemonSet",
+            "metadata": {
+                "name": _DAEMON_SET_NAME,
+                "labels": {_PREPULL_LABEL: "yes"},
+            },
+            "spec": {
+                "selector": {"matchLabels": {_PREPULL_LABEL: "yes"}},
+                "updateStrategy": {
+                    "type": "RollingUpdate",
+                    "rollingUpdate": {"maxUnavailable": "20%"},
+                },
+                "template": {
+                    "metadata": {
+                        "labels": {_PREPULL_LABEL: "yes"},
+                        "annotations": {_REFRESH_ANNOTATION: str(refresh)},
+                    },
+                    "spec": pod_spec,
+                },
+            },
+        }
+
+    async def _adopt_existing(self) -> None:
+        """Reads the images of an existing DaemonSet (one left by an earlier
+        operator, or leader), avoiding an unnecessary change.
+        """
+        try:
+            daemon_set = await kube.call(
+                "read",
+                "DaemonSet",
+                self._apps_api.read_namespaced_daemon_set,
+                _DAEMON_SET_NAME,
+                self._namespace,
+            )
+        except kubernetes.client.exceptions.ApiException as ex:
+            if ex.status != 404:
+                raise ex
+            return
+        pod_spec = daemon_set.spec.template.spec
+        images = [container.image for container in pod_spec.init_containers or []]
+        annotations = daemon_set.spec.template.metadata.annotations or {}
+        self._pulling = (images, int(annotations.get(_REFRESH_ANNOTATION, "0")))
+
+    async def _apply(self, images: List[str], refresh: int) -> None:
+        """Creates (or replaces) the DaemonSet."""
+        body = self._daemon_set_body(images, refresh)
+        try:
+            await kube.call(
+                "create",
+                "DaemonSet",
+                self._apps_api.create_namespaced_daemon_set,
+                self._namespace,
+                body,
+            )
+        except kubernetes.client.exceptions.ApiException as ex:
+            if ex.status != 409:
+                raise ex
+            await kube.call(
+                "replace",
+                "DaemonSet",
+                self._apps_api.replace_namespaced_daemon_set,
+                _DAEMON_SET_NAME,
+                self._namespace,
+                body,
+            )
+
+    async def _reconcile(
+        self,
+        interval: float,
+        refresh_interval: int,
+        leader: Optional[Callable[[], bool]],
+    ) -> None:
+        """A background task that (every 'interval' seconds) updates the
+        DaemonSet if the top-ranked images have changed, or if mutable images
+        need refreshing (every 'refresh_interval' seconds).
+        """
+        adopted = False
+        while True:
+            if leader and not leader():
+                # The leader may have changed the DaemonSet
+                adopted = False
+                await asyncio.sleep(interval)
+                continue
+            try:
+                if not adopted:
+                    await self._adopt_existing()
+                    adopted = True
+                self.score(await kube.list_notebooks(self._api_client))
+                images = sorted(self.ranked())
+                refresh = 0
+                if any(_is_mutable(image) for image in images):
+                    refresh = int(time.time() // refresh_interval)
+                if images and (images, refresh) != self._pulling:
+                    logging.info("Pre-pulling images %s (refresh=%s)", images, refresh)
+                    await self._apply(images, refresh)
+                    self._pulling = (images, refresh)
+                    metrics.PREPULL_IMAGES.set(len(images))
+            except kubernetes.client.exceptions.ApiException as ex:
+                logging.warning(
+                    "Got ApiException [%s/%s] maintaining the pre-pull DaemonSet",
+                    ex.status,
+                    ex.reason,
+                )
+            await asyncio.sleep(interval)
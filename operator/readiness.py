@@ -0,0 +1,474 @@
+"""Tracks the progress of each new notebook's Pod, from creation to readiness.
+
+A Pod informer (watching Pods with the operator's notebook label) feeds
+the tracker, which records a set of progressive 'conditions' for each notebook
+it is asked to track: -
+
+-   Scheduled           The Pod has been bound to a node
+-   ImagePulled         The notebook container's image is present on the node
+-   ContainerStarted    The notebook container is running
+-   JupyterResponding   The notebook's (Jupyter API) readiness probe succeeded
+
+As each condition is observed it is written to the notebook's 'status.conditions'
+(so clients can wait on them, e.g. 'kubectl wait --for=condition=JupyterResponding').
+When the notebook is ready the time from its creation is written to
+'status.timeToReadySeconds' and recorded as a metric (by image and node).
+
+Notebooks using the incremental startup script (see JO_INCREMENTAL_STARTUP)
+log the duration of each startup step. When such a notebook is ready
+the start of its container's log is read and the step durations
+are written to 'status.startupStepSeconds' and recorded as a metric (by step).
+"""
+
+import asyncio
+import datetime
+import functools
+import logging
+import os
+import re
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import kubernetes
+
+from informer import Informer
+import kube
+import metrics
+
+# Track the readiness of new notebooks?
+# Any value results in the operator watching notebook Pods
+# and recording progressive conditions (Scheduled, ImagePulled, ContainerStarted
+# and JupyterResponding) and the time-to-ready in the notebook's status.
+# A notebook not ready within the timeout (seconds) is no longer tracked.
+TRACK_READINESS: Optional[str] = os.environ.get("JO_TRACK_READINESS")
+TIMEOUT: int = int(os.environ.get("JO_READINESS_TIMEOUT", "3600"))
+
+# The notebook conditions, in the order we expect them to be satisfied.
+CONDITIONS: Tuple[str, ...] = (
+    "Scheduled",
+    "ImagePulled",
+    "ContainerStarted",
+    "JupyterResponding",
+)
+
+# The label (set on every notebook Pod) whose value is the notebook name.
+# It's the operator's own, so other Pods (with a 'deployment' label) are not seen.
+_POD_LABEL: str = kube.NOTEBOOK_LABEL
+# The name of the notebook container
+_CONTAINER_NAME: str = "notebook"
+
+# A startup step duration (written to the log by the incremental startup script)
+_STARTUP_STEP: re.Pattern[str] = re.compile(
+    r"^jupyter-startup step=(\w+) ms=(\d+)$", re.MULTILINE
+)
+# The number of bytes read from the start of a notebook container's log
+# (enough for the startup script's output)
+_STARTUP_LOG_BYTES: int = 16384
+
+# The number of attempts made to patch a notebook's status
+# and the delay (seconds) between them.
+_PATCH_ATTEMPTS: int = 3
+_PATCH_RETRY_DELAY: float = 5.0
+
+
+def _parse_time(timestamp: str) -> datetime.datetime:
+    """Parses a Kubernetes (RFC 3339) timestamp."""
+    return datetime.datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+
+
+def _format_time(when: datetime.datetime) -> str:
+    """Formats a time as a Kubernetes (RFC 3339) timestamp."""
+    return when.astimezone(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def parse_startup_steps(log: str) -> Dict[str, float]:
+    """Returns the startup step durations (seconds) written
+    to a notebook container's log, by step.
+    """
+    return {
+        step: int(milliseconds) / 1000
+        for step, milliseconds in _STARTUP_STEP.findall(log)
+    }
+
+
+def _pod_conditions(pod: Dict[str, Any]) -> Dict[str, Tuple[str, str]]:
+    """Returns the notebook conditions satisfied by a Pod,
+    as a map of condition to its time and a (descriptive) message.
+    """
+    satisfied: Dict[str, Tuple[str, str]] = {}
+    status = pod.get("status") or {}
+    pod_conditions = {
+        condition["type"]: condition for condition in status.get("conditions") or []
+    }
+    container_status: Dict[str, Any] = next(
+        (
+            container
+            for container in status.get("containerStatuses") or []
+            if container["name"] == _CONTAINER_NAME
+        ),
+        {},
+    )
+    now = _format_time(datetime.datetime.now(datetime.timezone.utc))
+
+    scheduled = pod_conditions.get("PodScheduled", {})
+    if scheduled.get("status") == "True":
+        node = pod["spec"].get("nodeName", "")
+        satisfied["Scheduled"] = (
+            scheduled.get("lastTransitionTime") or now,
+            f"Scheduled on node {node}",
+        )
+
+    # The kubelet does not record when an image was pulled.
+    # The container's image ID is only set once it has been,
+    # so we use the time we first see it (or the container start time).
+    started_at = (
+        (container_status.get("state") or {}).get("running", {}).get("startedAt")
+    )
+    if container_status.get("imageID"):
+        satisfied["ImagePulled"] = (
+            min(started_at, now) if started_at else now,
+            f"Pulled image {container_status.get('image', '')}",
+        )
+    if started_at:
+        satisfied["ContainerStarted"] = (started_at, "Notebook container started")
+
+    ready = pod_conditions.get("Ready", {})
+    if ready.get("status") == "True" and started_at:
+        satisfied["JupyterResponding"] = (
+            ready.get("lastTransitionTime") or now,
+            "Jupyter is responding",
+        )
+
+    return satisfied
+
+
+class _Notebook:
+    """The readiness state of a tracked notebook."""
+
+    def __init__(self, namespace: str, name: str, created: str) -> None:
+        self.namespace = namespace
+        self.name = name
+        self.created = created
+        # The satisfied conditions (the status 'conditions' list),
+        # in the order they were observed.
+        self.conditions: List[Dict[str, str]] = []
+        self.time_to_ready: Optional[int] = None
+        self.startup_steps: Dict[str, float] = {}
+        # Does the notebook's status need patching,
+        # and the task that's patching it (if any).
+        self.dirty: bool = False
+        self.patcher: Optional[asyncio.Task[None]] = None
+
+    def observe(self, pod: Dict[str, Any]) -> bool:
+        """Records any new conditions satisfied by a Pod,
+        returning True if there were any.
+        """
+        recorded = {condition["type"] for condition in self.conditions}
+        satisfied = _pod_conditions(pod)
+        # Conditions are only recorded once, and in order
+        # (a later condition implies the earlier ones).
+        new_conditions = False
+        for index, condition_type in enumerate(CONDITIONS):
+            if condition_type in recorded:
+                continue
+            later_conditions = [c for c in CONDITIONS[index:] if c in satisfied]
+            if not later_conditions:
+                break
+            when, message = satisfied.get(
+                condition_type, satisfied[later_conditions[0]]
+            )
+            self.conditions.append(
+                {
+                    "type": condition_type,
+                    "status": "True",
+                    "lastTransitionTime": when,
+                    "message": message,
+                }
+            )
+            new_conditions = True
+        if new_conditions and len(self.conditions) == len(CONDITIONS):
+            ready_time = _parse_time(self.conditions[-1]["lastTransitionTime"])
+            self.time_to_ready = max(
+                0, round((ready_time - _parse_time(self.created)).total_seconds())
+            )
+            metrics.TIME_TO_READY.labels(
+                (pod["spec"].get("containers") or [{}])[0].get("image", ""),
+                pod["spec"].get("nodeName", ""),
+            ).observe(self.time_to_ready)
+        return new_conditions
+
+    def status(self) -> Dict[str, Any]:
+        """The notebook's (readiness) status."""
+        status: Dict[str, Any] = {"conditions": list(self.conditions)}
+        if self.time_to_ready is not None:
+            status["timeToReadySeconds"] = self.time_to_ready
+        if self.startup_steps:
+            status["startupStepSeconds"] = self.startup_steps
+        return status
+
+
+class ReadinessTracker:
+    """Watches notebook Pods, writing the conditions (and time-to-ready)
+    of the notebooks being tracked to their status.
+
+    Pod events are received in the informer's thread and
+    handed to the event loop, where all tracking takes place.
+    """
+
+    def __init__(
+        self,
+        api_client: kubernetes.client.ApiClient,
+        request_timeout: Tuple[int, int],
+        tracking_timeout: int,
+        startup_steps: bool = False,
+    ) -> None:
+        """Notebooks are tracked for up to 'tracking_timeout' seconds.
+        If 'startup_steps' is set the startup step durations
+        of each ready notebook are read from its log.
+        """
+        self._api_client = api_client
+        self._tracking_timeout = tracking_timeout
+        self._startup_steps = startup_steps
+        self._loop = asyncio.get_running_loop()
+        # The latest Pod (of each notebook)
+        # and the notebooks we're tracking (indexed by namespace and name)
+        self._pods: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self._notebooks: Dict[Tuple[str, str], _Notebook] = {}
+        # Called (with the namespace and name) when a notebook is ready
+        self._ready_callbacks: List[Callable[[str, str], None]] = []
+        # Called with the listed Pods (and namespace) and each Pod event
+        self._pod_listeners: List[
+            Tuple[
+                Callable[[str, List[Dict[str, Any]]], None],
+                Callable[[str, Dict[str, Any]], None],
+            ]
+        ] = []
+        core_api = kubernetes.client.CoreV1Api(api_client)
+        # An informer for each namespace we watch (or one for all of them)
+        self._informers: List[Informer] = [
+            Informer(
+                "Pod",
+                list_function,
+                _POD_LABEL,
+                request_timeout,
+                on_list=functools.partial(self._receive_list, namespace),
+                on_event=self._receive_event,
+            )
+            for namespace, list_function in kube.scoped(
+                core_api.list_pod_for_all_namespaces, core_api.list_namespaced_pod
+            ).items()
+        ]
+
+    def start(self) -> None:
+        """Starts watching Pods."""
+        for informer in self._informers:
+            informer.start()
+
+    def stop(self) -> None:
+        """Stops watching Pods (and tracking notebooks)."""
+        for informer in self._informers:
+            informer.stop()
+        for notebook in self._notebooks.values():
+            if notebook.patcher:
+                notebook.patcher.cancel()
+
+    def track(
+        self,
+        namespace: str,
+        name: str,
+        created: str,
+        conditions: Optional[List[Dict[str, str]]] = None,
+    ) -> None:
+        """Starts tracking a notebook (created at the given time).
+        Any conditions already recorded (in its status) are retained.
+        Notebooks are tracked until they are ready or the tracking times out.
+        """
+        key = (namespace, name)
+        if key in self._notebooks:
+            return
+        notebook = _Notebook(namespace, name, created)
+        notebook.conditions = [
+            condition
+            for condition in conditions or []
+            if condition.get("type") in CONDITIONS
+        ]
+        self._notebooks[key] = notebook
+        self._loop.call_later(self._tracking_timeout, self._untrack, key)
+        # We may already have seen the notebook's Pod
+        if key in self._pods:
+            self._update(notebook, self._pods[key])
+
+    def on_ready(self, callback: Callable[[str, str], None]) -> None:
+        """Adds a function to be called (with the namespace and name)
+        when a tracked notebook is ready.
+        """
+        self._ready_callbacks.append(callback)
+
+    def add_pod_listener(
+        self,
+        on_list: Callable[[str, List[Dict[str, Any]]], None],
+        on_event: Callable[[str, Dict[str, Any]], None],
+    ) -> None:
+        """Shares our Pod watch, adding functions to be called (in the event loop)
+        with the namespace and listed Pods and with each Pod event.
+        """
+        self._pod_listeners.append((on_list, on_event))
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns a summary of the tracker (for the operator's probes)."""
+        return {
+            "synced": all(informer.synced for informer in self._informers),
+            "tracking": len(self._notebooks),
+            "pods": len(self._pods),
+            "watchRestarts": sum(informer.restarts for informer in self._informers),
+        }
+
+    def _receive_list(self, namespace: str, pods: List[Dict[str, Any]]) -> None:
+        """Hands listed Pods (from the informer thread) to the event loop."""
+        self._loop.call_soon_threadsafe(self._observe_all, namespace, pods)
+        for on_list, _ in self._pod_listeners:
+            self._loop.call_soon_threadsafe(on_list, namespace, pods)
+
+    def _receive_event(self, event_type: str, pod: Dict[str, Any]) -> None:
+        """Hands a Pod event (from the informer thread) to the event loop."""
+        self._loop.call_soon_threadsafe(self._observe, event_type, pod)
+        for _, on_event in self._pod_listeners:
+            self._loop.call_soon_threadsafe(on_event, event_type, pod)
+
+    def _untrack(self, key: Tuple[str, str]) -> None:
+        notebook = self._notebooks.pop(key, None)
+        if notebook and len(notebook.conditions) < len(CONDITIONS):
+            logging.warning(
+                "Stopped tracking %s (namespace=%s) before it was ready",
+                notebook.name,
+                notebook.namespace,
+            )
+
+    def _observe_all(self, namespace: str, pods: List[Dict[str, Any]]) -> None:
+        """Replaces the Pods of a namespace (or all namespaces if it's '')."""
+        self._pods = {
+            key: pod
+            for key, pod in self._pods.items()
+            if namespace and key[0] != namespace
+        }
+        for pod in pods:
+            self._observe("ADDED", pod)
+
+    def _observe(self, event_type: str, pod: Dict[str, Any]) -> None:
+        metadata = pod["metadata"]
+        key = (metadata["namespace"], metadata["labels"][_POD_LABEL])
+        if event_type == "DELETED":
+            if self._pods.get(key, {}).get("metadata", {}).get("uid") == metadata.get(
+                "uid"
+            ):
+                del self._pods[key]
+            return
+        self._pods[key] = pod
+        notebook = self._notebooks.get(key)
+        if notebook:
+            self._update(notebook, pod)
+
+    def _update(self, notebook: _Notebook, pod: Dict[str, Any]) -> None:
+        """Records any new conditions (satisfied by the Pod)
+        and, if there are any, patches the notebook's status.
+        """
+        if not notebook.observe(pod):
+            return
+        logging.info(
+            "Notebook %s (namespace=%s) is %s",
+            notebook.name,
+            notebook.namespace,
+            notebook.conditions[-1]["type"],
+        )
+        if notebook.time_to_ready is not None:
+            logging.info(
+                "Notebook %s (namespace=%s) was ready in %s seconds",
+                notebook.name,
+                notebook.namespace,
+                notebook.time_to_ready,
+            )
+            self._notebooks.pop((notebook.namespace, notebook.name), None)
+            for callback in self._ready_callbacks:
+                callback(notebook.namespace, notebook.name)
+            if self._startup_steps:
+                asyncio.create_task(
+                    self._read_startup_steps(notebook, pod["metadata"]["name"])
+                )
+        self._patch_soon(notebook)
+
+    def _patch_soon(self, notebook: _Notebook) -> None:
+        """Patches the notebook's status (if it's not already being patched).
+        One patch (task) at a time for each notebook.
+        A running patcher picks up any new conditions.
+        """
+        notebook.dirty = True
+        if notebook.patcher is None:
+            notebook.patcher = asyncio.create_task(self._patch(notebook))
+
+    async def _read_startup_steps(self, notebook: _Notebook, pod_name: str) -> None:
+        """Reads the startup step durations from (the start of)
+        a ready notebook's log, recording them in its status.
+        """
+        core_api = kubernetes.client.CoreV1Api(self._api_client)
+        try:
+            log = await kube.call(
+                "read",
+                "PodLog",
+                core_api.read_namespaced_pod_log,
+                pod_name,
+                notebook.namespace,
+                container=_CONTAINER_NAME,
+                limit_bytes=_STARTUP_LOG_BYTES,
+            )
+        except kubernetes.client.exceptions.ApiException as ex:
+            logging.warning(
+                "Got ApiException [%s/%s] reading %s log",
+                ex.status,
+                ex.reason,
+                pod_name,
+            )
+            return
+        notebook.startup_steps = parse_startup_steps(log)
+        if not notebook.startup_steps:
+            return
+        logging.info(
+            "Notebook %s (namespace=%s) startup steps took %s seconds",
+            notebook.name,
+            notebook.namespace,
+            notebook.startup_steps,
+        )
+        for step, seconds in notebook.startup_steps.items():
+            metrics.STARTUP_STEP_DURATION.labels(step).observe(seconds)
+        self._patch_soon(notebook)
+
+    async def _patch(self, notebook: _Notebook) -> None:
+        """Patches a notebook's status until it reflects all the conditions
+        we've recorded.
+        """
+        attempt = 0
+        while notebook.dirty:
+            notebook.dirty = False
+            try:
+                await kube.patch_notebook_status(
+                    self._api_client,
+                    notebook.namespace,
+                    notebook.name,
+                    notebook.status(),
+                )
+                attempt = 0
+            except kubernetes.client.exceptions.ApiException as ex:
+                if ex.status == 404:
+                    # The notebook's gone
+                    self._notebooks.pop((notebook.namespace, notebook.name), None)
+                    break
+                attempt += 1
+                logging.warning(
+                    "Got ApiException [%s/%s] patching %s status (attempt %s)",
+                    ex.status,
+                    ex.reason,
+                    notebook.name,
+                    attempt,
+                )
+                if attempt < _PATCH_ATTEMPTS:
+                    notebook.dirty = True
+                    await asyncio.sleep(_PATCH_RETRY_DELAY)
+        notebook.patcher = None
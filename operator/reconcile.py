@@ -0,0 +1,407 @@
+"""The reconciler, which repairs notebooks whose objects have gone missing.
+
+The create handler only applies a notebook's objects while the notebook
+is being created, so an object deleted later (by a user or an errant tool)
+is never replaced.
+Rather than reading each object of each notebook, every pass lists all
+the notebooks and all the objects of each kind (ConfigMaps, Deployments,
+Services and Ingresses, taken from the object cache if it is synced
+and holds them all), so a pass makes a handful of API calls however many notebooks there are.
+Only the missing objects are (re-)applied, a few at a time.
+
+A notebook is only repaired once it has been created (its status has
+the create handler's result) and, when sharding, by the replica holding
+its shard. The 'config' ConfigMap is restored with the notebook's token
+(from its status) so the notebook's URL remains valid.
+With shared Ingresses (see 'routing.py') the missing paths of notebooks
+are added to them and the paths of notebooks that have gone are removed.
+The probe here is registered by importing this module
+(as the operator's 'handlers' module does).
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+import kopf
+import kubernetes
+
+from cache import ObjectCache
+import kube
+import metrics
+import notebook_spec
+import resize
+from routing import IngressRouter
+import static_config
+
+# Reconcile (repair) notebooks?
+# The period (seconds) between passes (zero disables the reconciler).
+# The first pass is made when the operator starts.
+# At most 'concurrency' objects are applied at a time.
+INTERVAL: int = int(os.environ.get("JO_RECONCILE_INTERVAL", "0"))
+_CONCURRENCY: int = int(os.environ.get("JO_RECONCILE_CONCURRENCY", "8"))
+
+# The label (set on every object of a notebook) whose value is the notebook name
+# (the label the object cache watches), and the 'app' label (also set on every
+# object), which objects created before the notebook label was introduced
+# only have. Objects that seem to be missing are looked for by the latter.
+_LABEL_SELECTOR: str = kube.NOTEBOOK_LABEL
+_LEGACY_LABEL_SELECTOR: str = "app"
+# The key (in a notebook's status) of the create handler's result
+_CREATED_KEY: str = "jupyter"
+
+
+def _keys(objects: List[Dict[str, Any]]) -> Set[Tuple[str, str]]:
+    """The namespaces and names of a list of objects."""
+    return {(obj["metadata"]["namespace"], obj["metadata"]["name"]) for obj in objects}
+
+
+class Reconciler:
+    """Periodically finds (and applies) the missing objects of notebooks."""
+
+    def __init__(
+        self,
+        api_client: kubernetes.client.ApiClient,
+        object_cache: Optional[ObjectCache] = None,
+        owns: Optional[Callable[[str, str], bool]] = None,
+        router: Optional[IngressRouter] = None,
+    ) -> None:
+        self._api_client = api_client
+        self._object_cache = object_cache
+        self._owns = owns
+        self._router = router
+        core_api = kubernetes.client.CoreV1Api(api_client)
+        apps_api = kubernetes.client.AppsV1Api(api_client)
+        ext_api = kubernetes.client.NetworkingV1Api(api_client)
+        # The list functions of each kind (for each namespace we watch)
+        self._list_functions: Dict[str, Dict[str, Callable[..., Any]]] = {
+            "ConfigMap": kube.scoped(
+                core_api.list_config_map_for_all_namespaces,
+                core_api.list_namespaced_config_map,
+            ),
+            "Deployment": kube.scoped(
+                apps_api.list_deployment_for_all_namespaces,
+                apps_api.list_namespaced_deployment,
+            ),
+            "Service": kube.scoped(
+                core_api.list_service_for_all_namespaces,
+                core_api.list_namespaced_service,
+            ),
+            "Ingress": kube.scoped(
+                ext_api.list_ingress_for_all_namespaces,
+                ext_api.list_namespaced_ingress,
+            ),
+        }
+        self._reconciler: Optional[asyncio.Task[None]] = None
+        # The number of passes, and a summary of the last one
+        self._passes: int = 0
+        self._last_pass: Dict[str, Any] = {}
+
+    def start(self, interval: int) -> None:
+        """Starts reconciling notebooks (every 'interval' seconds)."""
+        self._reconciler = asyncio.create_task(self._reconcile(interval))
+
+    def stop(self) -> None:
+        """Stops reconciling notebooks."""
+        if self._reconciler:
+            self._reconciler.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns a summary of the reconciler (for the operator's probes)."""
+        return {"passes": self._passes, "lastPass": self._last_pass}
+
+    async def _reconcile(self, interval: int) -> None:
+        while True:
+            try:
+                await self.reconcile()
+            except kubernetes.client.exceptions.ApiException as ex:
+                logging.warning(
+                    "Got ApiException [%s/%s] reconciling notebooks",
+                    ex.status,
+                    ex.reason,
+                )
+            await asyncio.sleep(interval)
+
+    async def _existing(self, kind: str, label_selector: str) -> Set[Tuple[str, str]]:
+        """The namespaces and names of the existing objects of a kind
+        (with the given label), by listing them.
+        """
+        existing: Set[Tuple[str, str]] = set()
+        for list_function in self._list_functions[kind].values():
+            response = await kube.call(
+                "list",
+                kind,
+                list_function,
+                label_selector=label_selector,
+                _preload_content=False,
+            )
+            existing.update(_keys(json.loads(response.data)["items"]))
+        return existing
+
+    def _owned(self, namespace: str, name: str) -> bool:
+        """True for notebooks we reconcile (those of the shards we hold)."""
+        return self._owns is None or self._owns(namespace, name)
+
+    async def _reroute(
+        self,
+        router: IngressRouter,
+        unrouted: List[Tuple[str, Dict[str, Any]]],
+        stale: List[Tuple[str, Tuple[str, str]]],
+    ) -> int:
+        """Adds the missing (shared Ingress) paths of notebooks
+        and removes those of notebooks that have gone,
+        returning the number of paths added.
+        """
+
+        async def route(namespace: str, ingress: Dict[str, Any]) -> bool:
+            try:
+                await router.route(namespace, ingress)
+            except kubernetes.client.exceptions.ApiException as ex:
+                logging.warning(
+                    "Got ApiException [%s/%s] routing %s (namespace=%s)",
+                    ex.status,
+                    ex.reason,
+                    ingress["metadata"]["name"],
+                    namespace,
+                )
+                return False
+            logging.info(
+                "Repaired route of %s (namespace=%s)",
+                ingress["metadata"]["name"],
+                namespace,
+            )
+            metrics.RECONCILE_REPAIRS.labels("Ingress").inc()
+            return True
+
+        async def remove(namespace: str, ingress_name: str, path: str) -> bool:
+            try:
+                await router.remove(namespace, ingress_name, path)
+            except kubernetes.client.exceptions.ApiException as ex:
+                logging.warning(
+                    "Got ApiException [%s/%s] removing path %s from %s (namespace=%s)",
+                    ex.status,
+                    ex.reason,
+                    path,
+                    ingress_name,
+                    namespace,
+                )
+                return False
+            logging.info(
+                "Removed stale path %s from %s (namespace=%s)",
+                path,
+                ingress_name,
+                namespace,
+            )
+            return True
+
+        # The changes (to each shared Ingress) are made together,
+        # so they are written in a single batch.
+        changed = await asyncio.gather(
+            *[route(namespace, ingress) for namespace, ingress in unrouted],
+            *[
+                remove(namespace, ingress_name, path)
+                for namespace, (ingress_name, path) in stale
+            ],
+        )
+        return sum(changed[: len(unrouted)])
+
+    async def reconcile(self) -> Dict[str, int]:
+        """Makes one pass, applying the missing objects of notebooks
+        and returning the number applied (of each kind).
+        """
+        start = time.monotonic()
+        # The (shared Ingress) routes are listed before the notebooks,
+        # so a routed notebook that's not in the notebook list has gone.
+        routes = await self._router.routes() if self._router else {}
+        # Notebooks are listed before their objects, so the objects
+        # of any notebook we see created are (or will be) in the object lists.
+        all_notebooks = await kube.list_notebooks(self._api_client)
+        notebooks = [
+            notebook
+            for notebook in all_notebooks
+            if (notebook.get("status") or {}).get(_CREATED_KEY)
+            and not notebook["metadata"].get("deletionTimestamp")
+            and self._owned(
+                notebook["metadata"]["namespace"], notebook["metadata"]["name"]
+            )
+        ]
+        # The kinds taken from the object cache (if it's synced)
+        cached: Set[str] = {
+            kind
+            for kind in self._list_functions
+            if self._object_cache and self._object_cache.synced(kind)
+        }
+        existing: Dict[str, Set[Tuple[str, str]]] = {
+            kind: (
+                _keys(self._object_cache.items(kind))
+                if self._object_cache and kind in cached
+                else await self._existing(kind, _LABEL_SELECTOR)
+            )
+            for kind in self._list_functions
+        }
+        # The shared static ConfigMap is not one of a notebook's own objects
+        # (and has its own label).
+        if static_config.SHARED:
+            existing["ConfigMap"] |= await self._existing(
+                "ConfigMap", static_config.LABEL
+            )
+
+        # Each (valid) notebook, its token and its objects
+        rendered_notebooks: List[
+            Tuple[Dict[str, Any], Optional[str], List[Tuple[str, Dict[str, Any]]]]
+        ] = []
+        for notebook in notebooks:
+            metadata = notebook["metadata"]
+            token = notebook["status"][_CREATED_KEY].get("notebook", {}).get("token")
+            # Rendered as the resize handler renders them
+            # (preferring the node of any standby Pod claimed at launch
+            # and keeping a culled notebook culled)
+            try:
+                rendered = resize.render(
+                    (notebook.get("spec") or {}).get("imDataManager"),
+                    metadata["name"],
+                    notebook["status"],
+                )
+            except notebook_spec.SpecError as ex:
+                logging.warning("Cannot repair %s (%s)", metadata["name"], ex)
+                continue
+            # Resources applied at launch are kept
+            applied = notebook["status"].get("launch", {}).get("resources")
+            if applied:
+                rendered.set_resources(applied)
+            rendered_notebooks.append((notebook, token, rendered.objects(token or "")))
+
+        # An object without the operator's notebook label may simply be older
+        # (with just its 'app' label). The kinds that seem to be missing objects
+        # are listed by that label too (the Ingress of a routed notebook
+        # is not missing).
+        for kind in self._list_functions:
+            if any(
+                body_kind == kind
+                and (notebook["metadata"]["namespace"], body["metadata"]["name"])
+                not in existing[kind]
+                and not (
+                    kind == "Ingress"
+                    and (
+                        notebook["metadata"]["namespace"],
+                        notebook["metadata"]["name"],
+                    )
+                    in routes
+                )
+                for notebook, _, objects in rendered_notebooks
+                for body_kind, body in objects
+            ):
+                existing[kind] |= await self._existing(kind, _LEGACY_LABEL_SELECTOR)
+
+        missing: Dict[Tuple[str, str, str], Dict[str, Any]] = {}
+        # The notebooks (namespace and Ingress) missing from shared Ingresses
+        unrouted: List[Tuple[str, Dict[str, Any]]] = []
+        for notebook, token, objects in rendered_notebooks:
+            metadata = notebook["metadata"]
+            namespace = metadata["namespace"]
+            for kind, body in objects:
+                object_name = body["metadata"]["name"]
+                if (namespace, object_name) in existing[kind]:
+                    continue
+                # A notebook with its own Ingress (created before we used
+                # shared Ingresses) keeps it.
+                if kind == "Ingress" and self._router:
+                    if (namespace, metadata["name"]) not in routes:
+                        unrouted.append((namespace, body))
+                    continue
+                if not token and object_name == f"config-{metadata['name']}":
+                    logging.warning(
+                        "Cannot restore ConfigMap %s (namespace=%s) without a token",
+                        object_name,
+                        namespace,
+                    )
+                    continue
+                # The shared static ConfigMap is not adopted
+                # and is only applied once (per namespace).
+                if object_name != static_config.NAME:
+                    kopf.adopt(body, owner=kopf.Body(notebook))
+                missing.setdefault((kind, namespace, object_name), body)
+
+        semaphore = asyncio.Semaphore(_CONCURRENCY)
+
+        async def repair(kind: str, namespace: str, body: Dict[str, Any]) -> bool:
+            async with semaphore:
+                try:
+                    await kube.apply(self._api_client, kind, namespace, body)
+                except kubernetes.client.exceptions.ApiException as ex:
+                    # The notebook's gone (along with its namespace)?
+                    if ex.status == 404:
+                        return False
+                    logging.warning(
+                        "Got ApiException [%s/%s] applying %s %s (namespace=%s)",
+                        ex.status,
+                        ex.reason,
+                        kind,
+                        body["metadata"]["name"],
+                        namespace,
+                    )
+                    return False
+            logging.info(
+                "Repaired %s %s (namespace=%s)",
+                kind,
+                body["metadata"]["name"],
+                namespace,
+            )
+            metrics.RECONCILE_REPAIRS.labels(kind).inc()
+            return True
+
+        # Objects are applied in kind order (ConfigMaps first)
+        # so a repaired Deployment does not wait long for its ConfigMaps.
+        repairs: Dict[str, int] = {}
+        for kind in self._list_functions:
+            repaired = await asyncio.gather(
+                *[
+                    repair(kind, namespace, body)
+                    for (body_kind, namespace, _name), body in missing.items()
+                    if body_kind == kind
+                ]
+            )
+            repairs[kind] = sum(repaired)
+
+        present = {
+            (notebook["metadata"]["namespace"], notebook["metadata"]["name"])
+            for notebook in all_notebooks
+        }
+        stale = [
+            (namespace, route)
+            for (namespace, name), route in routes.items()
+            if (namespace, name) not in present and self._owned(namespace, name)
+        ]
+        if self._router:
+            repairs["Ingress"] += await self._reroute(self._router, unrouted, stale)
+
+        duration = time.monotonic() - start
+        metrics.RECONCILE_DURATION.observe(duration)
+        metrics.RECONCILE_LAST_PASS.set_to_current_time()
+        self._passes += 1
+        self._last_pass = {
+            "notebooks": len(notebooks),
+            "missing": len(missing),
+            "repairs": repairs,
+            "staleRoutes": len(stale),
+            "durationSeconds": round(duration, 3),
+        }
+        logging.info(
+            "Reconciled %s notebooks in %.3f seconds (repairs=%s)",
+            len(notebooks),
+            duration,
+            repairs,
+        )
+        return repairs
+
+
+@kopf.on.probe(id="reconciler")
+def reconciler_probe(memo: kopf.Memo, **_: Any) -> Dict[str, Any]:
+    """Exposes the reconciler statistics (the last pass's repairs etc.)
+    through the operator's health endpoint (if enabled).
+    """
+    reconciler: Optional[Reconciler] = memo.get("reconciler")
+    return reconciler.stats() if reconciler else {}
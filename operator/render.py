@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+"""Renders (offline) the objects of the notebooks in a file of specs.
+
+The input is a stream of JupyterNotebooks, one JSON object per line
+(JSONL), each with its 'metadata' (name) and 'spec', e.g. from: -
+
+    kubectl get jupyternotebooks -A -o json | jq -c '.items[]' > notebooks.jsonl
+
+Each spec is parsed (and validated) and its objects are rendered, exactly as
+the operator would, without using the Kubernetes API. Invalid specs are
+reported (with their line number) and the time taken to parse and render
+the specs is summarised, so thousands of specs can be checked (or the renderer
+benchmarked, with '--repeat') quickly: -
+
+    ./render.py notebooks.jsonl
+    ./render.py notebooks.jsonl --output objects.jsonl
+    ./render.py notebooks.jsonl --repeat 100
+
+Operator settings are taken from the environment (JO_SHARED_STATIC_CONFIG,
+JO_PACKAGE_CACHE etc.). The exit code is 1 if any spec is invalid.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from typing import Any, Dict, List, Optional, TextIO, Tuple
+
+
+def _render_all(
+    notebooks: List[Tuple[int, Dict[str, Any]]],
+    repeat: int,
+    readiness_probe: bool,
+    output: Optional[TextIO],
+) -> Dict[str, Any]:
+    """Parses and renders the notebooks (with their line numbers) 'repeat'
+    times, writing the objects of each (once) to the output, if there is one,
+    and returning a summary.
+    """
+    # pylint: disable=import-outside-toplevel
+    import manifests
+    import notebook_spec
+
+    invalid = 0
+    parse_seconds = 0.0
+    render_seconds = 0.0
+    for line_number, notebook in notebooks:
+        metadata = notebook.get("metadata") or {}
+        name = metadata.get("name", "")
+        try:
+            start = time.perf_counter()
+            for _ in range(repeat):
+                spec = notebook_spec.parse(name, notebook.get("spec") or {})
+            parse_seconds += time.perf_counter() - start
+        except notebook_spec.SpecError as ex:
+            invalid += 1
+            print(f"line {line_number} ({name}): {ex}", file=sys.stderr)
+            continue
+        start = time.perf_counter()
+        for _ in range(repeat):
+            rendered = manifests.render(spec, readiness_probe).objects("")
+        render_seconds += time.perf_counter() - start
+        if output:
+            output.write(
+                json.dumps(
+                    {
+                        "name": name,
+                        "namespace": metadata.get("namespace"),
+                        "objects": [body for _, body in rendered],
+                    }
+                )
+                + "\n"
+            )
+    valid = len(notebooks) - invalid
+    renders = valid * repeat
+    return {
+        "specs": len(notebooks),
+        "valid": valid,
+        "invalid": invalid,
+        "parseMicroseconds": round(parse_seconds / renders * 1e6, 1) if renders else 0,
+        "renderMicroseconds": (
+            round(render_seconds / renders * 1e6, 1) if renders else 0
+        ),
+        "rendersPerSecond": (
+            round(renders / (parse_seconds + render_seconds)) if renders else 0
+        ),
+    }
+
+
+def main() -> None:
+    """Renders the notebooks."""
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("specs", help="The file of notebooks (JSONL, '-' for stdin)")
+    parser.add_argument("--output", help="Where to write the objects (JSONL)")
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=1,
+        help="The number of times each spec is parsed and rendered",
+    )
+    parser.add_argument("--readiness-probe", action="store_true")
+    parser.add_argument(
+        "--ingress-domain",
+        default="example.com",
+        help="The default ingress domain (if INGRESS_DOMAIN is not set)",
+    )
+    parser.add_argument("--json", action="store_true", help="Print a JSON summary")
+    args = parser.parse_args()
+    # The (required) operator setting
+    os.environ.setdefault("INGRESS_DOMAIN", args.ingress_domain)
+
+    notebooks: List[Tuple[int, Dict[str, Any]]] = []
+    with (
+        sys.stdin if args.specs == "-" else open(args.specs, encoding="utf-8")
+    ) as specs:
+        for line_number, line in enumerate(specs, start=1):
+            if line.strip():
+                # A line that is not a JSON object has no spec
+                try:
+                    notebook = json.loads(line)
+                except json.JSONDecodeError:
+                    notebook = None
+                notebooks.append(
+                    (line_number, notebook if isinstance(notebook, dict) else {})
+                )
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            summary = _render_all(notebooks, args.repeat, args.readiness_probe, output)
+    else:
+        summary = _render_all(notebooks, args.repeat, args.readiness_probe, None)
+
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print(
+            f"{summary['specs']} specs ({summary['invalid']} invalid),"
+            f" parse {summary['parseMicroseconds']}us"
+            f" render {summary['renderMicroseconds']}us"
+            f" ({summary['rendersPerSecond']} specs/s)"
+        )
+    sys.exit(1 if summary["invalid"] else 0)
+
+
+if __name__ == "__main__":
+    main()
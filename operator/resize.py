@@ -0,0 +1,317 @@
+"""Resizing (and re-imaging) existing notebooks.
+
+A change to a notebook's resources (or image) is applied to its Deployment.
+Where the running Pod's template (its ReplicaSet's) differs from the
+notebook's only in its resources, the Pod is resized in place,
+without restarting its kernels.
+Its Deployment is paused while its ReplicaSet (and then the Deployment)
+are given the new resources, so the Deployment controller finds the
+ReplicaSet still matches and does not replace the Pod.
+If the cluster cannot resize the Pod in place (or the image, or anything
+else in the Pod template, has changed) the Deployment simply rolls out
+the change, restarting the notebook.
+
+Whether a resize was made in place ('InPlace'), needed a restart ('Restart')
+or takes effect when a culled notebook is resumed ('NotRunning') is
+recorded in the notebook's 'status.resize'.
+The handler here is registered by importing this module
+(as the operator's 'handlers' module does).
+"""
+
+import copy
+import datetime
+import json
+import logging
+from typing import Any, Callable, Dict, Mapping, Optional
+
+import kopf
+import kubernetes
+
+import kube
+import manifests
+import metrics
+import notebook_spec
+import readiness
+import sharding
+
+# The label (set on every notebook Pod) whose value is the notebook name
+_POD_LABEL: str = kube.NOTEBOOK_LABEL
+# The label (set by the Deployment controller) identifying the ReplicaSet
+# (the Pod template) of a Pod
+_TEMPLATE_HASH_LABEL: str = "pod-template-hash"
+# The name of the notebook container
+_CONTAINER_NAME: str = "notebook"
+
+
+def _now() -> str:
+    """The current time, as a Kubernetes (RFC 3339) timestamp."""
+    return datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def render(
+    material: Optional[Dict[str, Any]], name: str, status: Mapping[str, Any]
+) -> manifests.Manifests:
+    """Renders a notebook's objects (as the create handler did)
+    from its (old or new) Data Manager material and its status
+    (as the reconciler does, to repair them),
+    raising a SpecError if it is invalid.
+    """
+    notebook = manifests.render(
+        notebook_spec.parse(name, {"imDataManager": material or {}}),
+        readiness_probe=bool(readiness.TRACK_READINESS),
+    )
+    standby_node = status.get("launch", {}).get("standbyNode")
+    if standby_node:
+        notebook.prefer_node(standby_node)
+    # A culled notebook stays culled
+    if status.get("culling", {}).get("state") == "Culled":
+        notebook.deployment["spec"]["replicas"] = 0
+    return notebook
+
+
+def _matches(rendered: Any, live: Any) -> bool:
+    """True if every field of a rendered object has the same value
+    in the live object (which also has the fields the API server defaults).
+    Empty (or null) rendered fields match absent ones.
+    """
+    if isinstance(rendered, dict):
+        return isinstance(live, dict) and all(
+            _matches(value, live[key]) if key in live else value in (None, {}, [])
+            for key, value in rendered.items()
+        )
+    if isinstance(rendered, list):
+        return (
+            isinstance(live, list)
+            and len(rendered) == len(live)
+            and all(map(_matches, rendered, live))
+        )
+    return bool(rendered == live)
+
+
+async def _list(
+    function: Callable[..., Any], namespace: str, name: str, kind: str
+) -> Dict[str, Any]:
+    """Lists the Pods or ReplicaSets of a notebook."""
+    response = await kube.call(
+        "list",
+        kind,
+        function,
+        namespace,
+        label_selector=f"{_POD_LABEL}={name}",
+        _preload_content=False,
+    )
+    listing: Dict[str, Any] = json.loads(response.data)
+    return listing
+
+
+async def _resize_pod(
+    api_client: kubernetes.client.ApiClient,
+    namespace: str,
+    pod_name: str,
+    containers: Dict[str, Any],
+) -> bool:
+    """Resizes a running Pod (its containers) in place, returning False
+    if the cluster does not allow it. The Pod's 'resize' subresource is used
+    (Kubernetes 1.33 onwards) or, if there's no such subresource, the Pod itself
+    (earlier clusters with the InPlacePodVerticalScaling feature gate).
+    """
+    core_api = kubernetes.client.CoreV1Api(api_client)
+    try:
+        try:
+            await kube.call(
+                "resize",
+                "Pod",
+                api_client.call_api,
+                "/api/v1/namespaces/{namespace}/pods/{name}/resize",
+                "PATCH",
+                path_params={"namespace": namespace, "name": pod_name},
+                header_params={
+                    "Accept": "application/json",
+                    "Content-Type": "application/strategic-merge-patch+json",
+                },
+                body=containers,
+                auth_settings=["BearerToken"],
+            )
+        except kubernetes.client.exceptions.ApiException as ex:
+            if ex.status != 404:
+                raise ex
+            await kube.call(
+                "patch",
+                "Pod",
+                core_api.patch_namespaced_pod,
+                pod_name,
+                namespace,
+                containers,
+            )
+    except kubernetes.client.exceptions.ApiException as ex:
+        logging.info(
+            "Cannot resize Pod %s in place (namespace=%s) [%s/%s]",
+            pod_name,
+            namespace,
+            ex.status,
+            ex.reason,
+        )
+        return False
+    return True
+
+
+async def _apply_in_place(
+    api_client: kubernetes.client.ApiClient,
+    namespace: str,
+    name: str,
+    notebook: manifests.Manifests,
+) -> bool:
+    """Applies a notebook's (resized) Deployment, resizing its running Pod
+    (and the Pod template of its ReplicaSet) in place if we can.
+    Returns True if the Pod was resized in place, False if the Deployment
+    is rolling out the change (restarting the notebook).
+    The Pod can only be resized in place if its ReplicaSet's Pod template
+    matches the notebook's (rendered) template in all but its resources.
+    """
+    core_api = kubernetes.client.CoreV1Api(api_client)
+    apps_api = kubernetes.client.AppsV1Api(api_client)
+
+    pods = [
+        pod
+        for pod in (await _list(core_api.list_namespaced_pod, namespace, name, "Pod"))[
+            "items"
+        ]
+        if pod["status"].get("phase") == "Running"
+        and not pod["metadata"].get("deletionTimestamp")
+    ]
+    template_hash = (
+        pods[0]["metadata"].get("labels", {}).get(_TEMPLATE_HASH_LABEL)
+        if len(pods) == 1
+        else None
+    )
+    replica_sets = [
+        replica_set
+        for replica_set in (
+            await _list(
+                apps_api.list_namespaced_replica_set, namespace, name, "ReplicaSet"
+            )
+        )["items"]
+        if template_hash
+        and replica_set["metadata"].get("labels", {}).get(_TEMPLATE_HASH_LABEL)
+        == template_hash
+    ]
+    # The rendered Pod template (without the notebook's resources)
+    template = copy.deepcopy(notebook.deployment["spec"]["template"])
+    for container in template["spec"]["containers"]:
+        if container["name"] == _CONTAINER_NAME:
+            container.pop("resources", None)
+    if not replica_sets or not _matches(template, replica_sets[0]["spec"]["template"]):
+        await kube.apply(api_client, "Deployment", namespace, notebook.deployment)
+        return False
+
+    containers = {
+        "spec": {
+            "containers": [{"name": _CONTAINER_NAME, "resources": notebook.resources()}]
+        }
+    }
+    # While the Deployment's paused it does not roll out changes,
+    # so we can change its Pod template (and its ReplicaSet's) together.
+    await kube.call(
+        "patch",
+        "Deployment",
+        apps_api.patch_namespaced_deployment,
+        name,
+        namespace,
+        {"spec": {"paused": True}},
+    )
+    try:
+        in_place = await _resize_pod(
+            api_client, namespace, pods[0]["metadata"]["name"], containers
+        )
+        if in_place:
+            response = await kube.call(
+                "patch",
+                "ReplicaSet",
+                apps_api.patch_namespaced_replica_set,
+                replica_sets[0]["metadata"]["name"],
+                namespace,
+                {"spec": {"template": containers}},
+                _preload_content=False,
+            )
+            kube.release(response)
+        await kube.apply(api_client, "Deployment", namespace, notebook.deployment)
+    finally:
+        await kube.call(
+            "patch",
+            "Deployment",
+            apps_api.patch_namespaced_deployment,
+            name,
+            namespace,
+            {"spec": {"paused": False}},
+        )
+    return in_place
+
+
+@kopf.on.update(
+    "squonk.it",
+    "v2",
+    "jupyternotebooks",
+    id="resize",
+    field="spec.imDataManager",
+    backoff=20,
+    retries=6,
+    when=sharding.owned,
+)
+async def resize(
+    name: str,
+    namespace: str,
+    old: Optional[Dict[str, Any]],
+    new: Optional[Dict[str, Any]],
+    status: kopf.Status,
+    memo: kopf.Memo,
+    patch: kopf.Patch,
+    **_: Any,
+) -> None:
+    """Handler for changes to a notebook's Data Manager material.
+    Here we apply changes to its resources (or image) to its Deployment,
+    resizing it in place if we can.
+    """
+    try:
+        old_notebook = render(old, name, status)
+        notebook = render(new, name, status)
+    except notebook_spec.SpecError as ex:
+        metrics.PERMANENT_ERRORS.labels("v2").inc()
+        raise kopf.PermanentError(f"Invalid spec: {ex}") from ex
+    # Resources recommended (and applied) at launch are kept
+    # until the notebook's own resources are changed.
+    applied = status.get("launch", {}).get("resources")
+    if applied:
+        if notebook.resources() == old_notebook.resources():
+            notebook.set_resources(applied)
+        else:
+            patch.status["launch"] = {"resources": None}
+        old_notebook.set_resources(applied)
+    if notebook.image == old_notebook.image and notebook.resources() == (
+        old_notebook.resources()
+    ):
+        return
+
+    logging.info(
+        "Resizing %s (namespace=%s image=%s resources=%s)",
+        name,
+        namespace,
+        notebook.image,
+        notebook.resources(),
+    )
+    kopf.adopt(notebook.deployment)
+    if notebook.deployment["spec"]["replicas"] == 0:
+        await kube.apply(memo.api_client, "Deployment", namespace, notebook.deployment)
+        mode = "NotRunning"
+    else:
+        in_place = await _apply_in_place(memo.api_client, namespace, name, notebook)
+        mode = "InPlace" if in_place else "Restart"
+
+    logging.info("Resized %s (namespace=%s mode=%s)", name, namespace, mode)
+    patch.status["jupyter"] = notebook.summary
+    patch.status["resize"] = {
+        "mode": mode,
+        "resizedAt": _now(),
+        "image": notebook.image,
+        "resources": notebook.resources(),
+    }
+    metrics.NOTEBOOKS_RESIZED.labels(mode).inc()
@@ -0,0 +1,307 @@
+"""Recommends notebook resources (requests and limits) from observed usage.
+
+The default requests and limits (and those chosen by users) are guesses,
+leading to OOM-killed kernels on one hand and badly packed nodes on the other.
+The recommender samples the CPU and memory usage of every running notebook
+(from the metrics API, 'metrics.k8s.io') every 'interval' and keeps the last
+'window' samples of each image and owner (and of each image, for owners
+with too few samples of their own). From these it recommends: -
+
+-   Requests    the 90th percentile of usage, plus 20%
+-   Limits      the 99th percentile of usage, plus 20%
+
+Recommendations are written to each notebook's 'status.recommendation'.
+Optionally (see JO_RIGHTSIZING_APPLY) they are also applied to new notebooks
+(of the same image and owner): their requests are replaced, improving
+the packing of notebooks on nodes, while their limits are only ever raised
+(so a recommendation cannot cause a notebook to be OOM-killed).
+The probe here is registered by importing this module
+(as the operator's 'handlers' module does).
+"""
+
+import asyncio
+import collections
+import functools
+import logging
+import math
+import os
+import time
+from typing import Any, Callable, Deque, Dict, List, Optional, Sequence, Tuple
+
+import kopf
+import kubernetes
+from kubernetes.utils import parse_quantity
+
+import kube
+import metrics
+import notebook_spec
+from notebook_spec import NotebookSpec
+
+# Recommend notebook resources?
+# Any value results in the operator sampling the usage of notebooks
+# (every 'interval' seconds) and recommending their resources
+# from the last 'window' samples of each image and owner
+# (once there are at least 'min samples').
+# If 'apply' is set (to any value) recommendations are applied to new notebooks.
+RIGHTSIZING: Optional[str] = os.environ.get("JO_RIGHTSIZING")
+INTERVAL: int = int(os.environ.get("JO_RIGHTSIZING_INTERVAL", "60"))
+WINDOW: int = int(os.environ.get("JO_RIGHTSIZING_WINDOW", "1440"))
+MIN_SAMPLES: int = int(os.environ.get("JO_RIGHTSIZING_MIN_SAMPLES", "30"))
+APPLY: Optional[str] = os.environ.get("JO_RIGHTSIZING_APPLY")
+
+# The usage percentiles of the recommended requests and limits,
+# and the headroom given to them.
+_REQUEST_PERCENTILE: float = 90.0
+_LIMIT_PERCENTILE: float = 99.0
+_HEADROOM: float = 1.2
+# The smallest CPU (cores) and memory (bytes) recommended.
+# Recommendations are rounded up (to 10m of CPU and 32Mi of memory)
+# so small changes in usage do not change them.
+_MIN_CPU: float = 0.01
+_MIN_MEMORY: float = 64 * 2**20
+
+# The label (set on every notebook Pod) whose value is the notebook name
+_POD_LABEL: str = "deployment"
+# The name of the notebook container
+_CONTAINER_NAME: str = "notebook"
+# The key (in a notebook's status) of its recommendation
+_STATUS_KEY: str = "recommendation"
+
+
+def percentile(values: Sequence[float], percent: float) -> float:
+    """The (nearest-rank) percentile of a (non-empty) sequence of values."""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)]
+
+
+def _cpu(cores: float) -> str:
+    return f"{math.ceil(max(cores, _MIN_CPU) * 100) * 10}m"
+
+
+def _memory(memory: float) -> str:
+    return f"{math.ceil(max(memory, _MIN_MEMORY) / 2**25) * 32}Mi"
+
+
+def apply(resources: Dict[str, Any], recommendation: Dict[str, Any]) -> Dict[str, Any]:
+    """Applies a recommendation to a notebook's resources, returning the
+    new resources. Requests are replaced, limits are only raised.
+    """
+    limits = dict(resources.get("limits") or {})
+    for resource, limit in recommendation["limits"].items():
+        if resource not in limits or parse_quantity(limit) > parse_quantity(
+            limits[resource]
+        ):
+            limits[resource] = limit
+    return {"requests": dict(recommendation["requests"]), "limits": limits}
+
+
+class Recommender:
+    """Periodically samples the usage of notebooks, recommending
+    (and publishing) their resources.
+    """
+
+    def __init__(
+        self,
+        api_client: kubernetes.client.ApiClient,
+        window: int,
+        min_samples: int,
+        owns: Optional[Callable[[str, str], bool]] = None,
+    ) -> None:
+        """Recommendations are made from (at most) the last 'window' samples,
+        once there are at least 'min_samples'. If there's an 'owns' function
+        only the notebooks it returns True for have their status patched.
+        """
+        self._api_client = api_client
+        self._window = window
+        self._min_samples = min_samples
+        self._owns = owns
+        custom_api = kubernetes.client.CustomObjectsApi(api_client)
+        # The pod metrics list functions (for each namespace we watch)
+        self._list_functions = kube.scoped(
+            functools.partial(
+                custom_api.list_cluster_custom_object, "metrics.k8s.io", "v1beta1"
+            ),
+            functools.partial(
+                custom_api.list_namespaced_custom_object, "metrics.k8s.io", "v1beta1"
+            ),
+        )
+        # The CPU (cores) and memory (bytes) samples, indexed by image
+        # and owner (an owner of '' holding the samples of all owners).
+        self._samples: Dict[Tuple[str, str], Deque[Tuple[float, float]]] = {}
+        self._sampler: Optional[asyncio.Task[None]] = None
+        self._passes: int = 0
+        self._last_pass: Dict[str, Any] = {}
+
+    def start(self, interval: int) -> None:
+        """Starts sampling notebooks (every 'interval' seconds)."""
+        self._sampler = asyncio.create_task(self._sample(interval))
+
+    def stop(self) -> None:
+        """Stops sampling notebooks."""
+        if self._sampler:
+            self._sampler.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns a summary of the recommender (for the operator's probes)."""
+        return {
+            "passes": self._passes,
+            "lastPass": self._last_pass,
+            "samples": {
+                f"{image} ({owner or 'all owners'})": len(samples)
+                for (image, owner), samples in self._samples.items()
+            },
+        }
+
+    def recommendation(self, image: str, owner: str) -> Optional[Dict[str, Any]]:
+        """The recommended resources for a notebook of the given image
+        and owner (or, if the owner has too few samples, of the image),
+        None if there are too few samples.
+        """
+        for key in ((image, owner), (image, "")):
+            samples = self._samples.get(key)
+            if samples and len(samples) >= self._min_samples:
+                cpu = [sample[0] for sample in samples]
+                memory = [sample[1] for sample in samples]
+                return {
+                    "requests": {
+                        "cpu": _cpu(percentile(cpu, _REQUEST_PERCENTILE) * _HEADROOM),
+                        "memory": _memory(
+                            percentile(memory, _REQUEST_PERCENTILE) * _HEADROOM
+                        ),
+                    },
+                    "limits": {
+                        "cpu": _cpu(percentile(cpu, _LIMIT_PERCENTILE) * _HEADROOM),
+                        "memory": _memory(
+                            percentile(memory, _LIMIT_PERCENTILE) * _HEADROOM
+                        ),
+                    },
+                    "basis": "owner" if key[1] else "image",
+                }
+        return None
+
+    async def _sample(self, interval: int) -> None:
+        while True:
+            try:
+                await self.sample()
+            except kubernetes.client.exceptions.ApiException as ex:
+                logging.warning(
+                    "Got ApiException [%s/%s] sampling notebook usage",
+                    ex.status,
+                    ex.reason,
+                )
+            await asyncio.sleep(interval)
+
+    def _record(self, key: Tuple[str, str], cpu: float, memory: float) -> None:
+        samples = self._samples.get(key)
+        if samples is None:
+            samples = collections.deque(maxlen=self._window)
+            self._samples[key] = samples
+        samples.append((cpu, memory))
+
+    async def sample(self) -> int:
+        """Makes one pass, sampling the usage of the running notebooks
+        and publishing any changed recommendations. Returns the number
+        of notebooks sampled.
+        """
+        start = time.monotonic()
+        # Each (valid) notebook and its spec (for its image and owner)
+        notebooks: Dict[Tuple[str, str], Tuple[Dict[str, Any], NotebookSpec]] = {}
+        for notebook in await kube.list_notebooks(self._api_client):
+            metadata = notebook["metadata"]
+            try:
+                spec = notebook_spec.parse(metadata["name"], notebook.get("spec") or {})
+            except notebook_spec.SpecError:
+                continue
+            notebooks[(metadata["namespace"], metadata["name"])] = (notebook, spec)
+        sampled: List[Tuple[str, str]] = []
+        for list_function in self._list_functions.values():
+            response = await kube.call(
+                "list",
+                "PodMetrics",
+                list_function,
+                plural="pods",
+                label_selector=_POD_LABEL,
+            )
+            for pod_metrics in response["items"]:
+                metadata = pod_metrics["metadata"]
+                key = (metadata["namespace"], metadata["labels"][_POD_LABEL])
+                entry = notebooks.get(key)
+                usage = next(
+                    (
+                        container["usage"]
+                        for container in pod_metrics.get("containers") or []
+                        if container["name"] == _CONTAINER_NAME
+                    ),
+                    None,
+                )
+                if not entry or not usage:
+                    continue
+                spec = entry[1]
+                cpu = float(parse_quantity(usage.get("cpu", "0")))
+                memory = float(parse_quantity(usage.get("memory", "0")))
+                self._record((spec.image, spec.owner), cpu, memory)
+                self._record((spec.image, ""), cpu, memory)
+                sampled.append(key)
+        metrics.RIGHTSIZING_SAMPLES.inc(len(sampled))
+
+        # Publish the recommendations (of the notebooks we own) that have changed
+        published = await asyncio.gather(
+            *[
+                self._publish(notebook, spec)
+                for key, (notebook, spec) in notebooks.items()
+                if self._owns is None or self._owns(*key)
+            ]
+        )
+
+        duration = time.monotonic() - start
+        self._passes += 1
+        self._last_pass = {
+            "notebooks": len(notebooks),
+            "sampled": len(sampled),
+            "published": sum(published),
+            "durationSeconds": round(duration, 3),
+        }
+        logging.info(
+            "Sampled %s notebooks in %.3f seconds (published=%s)",
+            len(sampled),
+            duration,
+            sum(published),
+        )
+        return len(sampled)
+
+    async def _publish(self, notebook: Dict[str, Any], spec: NotebookSpec) -> bool:
+        """Writes a notebook's recommendation to its status (if it has changed),
+        returning True if it was written.
+        """
+        recommendation = self.recommendation(spec.image, spec.owner)
+        status = notebook.get("status") or {}
+        if not recommendation or recommendation == status.get(_STATUS_KEY):
+            return False
+        metadata = notebook["metadata"]
+        try:
+            await kube.patch_notebook_status(
+                self._api_client,
+                metadata["namespace"],
+                metadata["name"],
+                {_STATUS_KEY: recommendation},
+            )
+        except kubernetes.client.exceptions.ApiException as ex:
+            # The notebook's gone?
+            if ex.status != 404:
+                logging.warning(
+                    "Got ApiException [%s/%s] patching %s recommendation",
+                    ex.status,
+                    ex.reason,
+                    metadata["name"],
+                )
+            return False
+        return True
+
+
+@kopf.on.probe(id="rightsizing")
+def recommender_probe(memo: kopf.Memo, **_: Any) -> Dict[str, Any]:
+    """Exposes the recommender statistics (samples of each image etc.)
+    through the operator's health endpoint (if enabled).
+    """
+    recommender: Optional[Recommender] = memo.get("recommender")
+    return recommender.stats() if recommender else {}
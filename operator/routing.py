@@ -0,0 +1,395 @@
+"""Shared (path-sharded) notebook Ingresses.
+
+By default every notebook has its own Ingress (with the same host, TLS
+and annotations as the others on its domain). Each new Ingress makes the
+ingress controller reload its configuration and cert-manager see another
+certificate request, so a burst of launches causes a storm of reloads.
+
+With shared Ingresses (see JO_SHARED_INGRESS) the notebooks of a namespace
+(an Ingress can only route to Services in its own namespace) whose Ingresses
+would only differ in their path are routed by a small number of shared
+Ingresses, each holding the paths ('/<name>') of the notebooks hashed to it.
+Paths are added and removed in batches: changes to a shared Ingress made
+within 'batch delay' seconds of the first are written together.
+Each batch reads, modifies and replaces the Ingress (retrying if it has
+changed) so the Ingresses can be shared by several operator replicas.
+
+A notebook's path is removed when the notebook is deleted. The reconciler
+(if enabled) adds missing paths and removes those of notebooks that have
+gone (while no operator was running). The event handler and probe here are
+registered by importing this module (as the operator's 'handlers' module does).
+"""
+
+import asyncio
+import copy
+import hashlib
+import json
+import logging
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+import kopf
+import kubernetes
+
+import kube
+import manifests
+import metrics
+import notebook_spec
+import sharding
+
+# Share notebook Ingresses?
+# Any value results in notebooks being routed by shared Ingresses,
+# 'shards' of them for each namespace, domain and class, whose paths
+# are updated in batches (of the changes made within 'batch delay' seconds).
+SHARED_INGRESS: Optional[str] = os.environ.get("JO_SHARED_INGRESS")
+SHARDS: int = int(os.environ.get("JO_SHARED_INGRESS_SHARDS", "4"))
+BATCH_DELAY: float = float(os.environ.get("JO_SHARED_INGRESS_BATCH_DELAY", "1.0"))
+
+# The label of the shared Ingresses
+LABEL: str = "squonk.it/jupyter-shared-ingress"
+# The number of attempts made to write a batch
+# (each attempt re-reads an Ingress that has changed).
+_WRITE_ATTEMPTS: int = 5
+
+
+def _digest(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def _path(ingress: Dict[str, Any]) -> Dict[str, Any]:
+    """The (only) path of a notebook's (rendered) Ingress."""
+    path: Dict[str, Any] = ingress["spec"]["rules"][0]["http"]["paths"][0]
+    return path
+
+
+def shared_ingress(ingress: Dict[str, Any], shards: int) -> Dict[str, Any]:
+    """Returns the shared Ingress (without any paths) that routes
+    the path of a notebook's (rendered) Ingress. The Ingress is named using
+    a hash of everything but its paths and the shard of the notebook's path.
+    """
+    annotations: Dict[str, str] = ingress["metadata"].get("annotations", {})
+    tls: List[Dict[str, Any]] = ingress["spec"]["tls"]
+    host: str = ingress["spec"]["rules"][0]["host"]
+    group = _digest(json.dumps([annotations, tls, host], sort_keys=True))[:8]
+    shard = int(_digest(_path(ingress)["path"])[:8], 16) % shards
+    return {
+        "kind": "Ingress",
+        "apiVersion": "networking.k8s.io/v1",
+        "metadata": {
+            "name": f"jupyter-notebooks-{group}-{shard}",
+            "labels": {LABEL: "yes"},
+            "annotations": annotations,
+        },
+        "spec": {"tls": tls, "rules": [{"host": host, "http": {"paths": []}}]},
+    }
+
+
+class _Batch:
+    """The changes (waiting to be written) to a shared Ingress."""
+
+    def __init__(self, namespace: str, ingress: Dict[str, Any]) -> None:
+        self.namespace = namespace
+        # The shared Ingress (created, with the added paths, if it's missing)
+        self.ingress = ingress
+        # The paths to add (or, if None, remove) by path,
+        # the number of changes made and those waiting for them to be written.
+        self.paths: Dict[str, Optional[Dict[str, Any]]] = {}
+        self.changes: int = 0
+        self.waiters: List[asyncio.Future[None]] = []
+
+
+class IngressRouter:
+    """Adds (and removes) notebook paths to (and from) shared Ingresses,
+    in batches.
+    """
+
+    def __init__(
+        self,
+        api_client: kubernetes.client.ApiClient,
+        shards: int,
+        batch_delay: float,
+    ) -> None:
+        self._shards = shards
+        self._batch_delay = batch_delay
+        self._ext_api = kubernetes.client.NetworkingV1Api(api_client)
+        # The list functions (for each namespace we watch)
+        self._list_functions = kube.scoped(
+            self._ext_api.list_ingress_for_all_namespaces,
+            self._ext_api.list_namespaced_ingress,
+        )
+        # The batches (indexed by namespace and Ingress name)
+        # and the tasks that write them.
+        self._batches: Dict[Tuple[str, str], _Batch] = {}
+        self._writers: Dict[Tuple[str, str], asyncio.Task[None]] = {}
+        # The number of updates (batches written) and changes (paths added
+        # or removed) - the difference being the number of changes coalesced.
+        self._updates: int = 0
+        self._changes: int = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns a summary of the router (for the operator's probes)."""
+        return {
+            "updates": self._updates,
+            "changes": self._changes,
+            "coalesced": self._changes - self._updates,
+            "pending": sum(batch.changes for batch in self._batches.values()),
+        }
+
+    def stop(self) -> None:
+        """Stops writing batches (any waiting changes are lost)."""
+        for writer in self._writers.values():
+            writer.cancel()
+
+    async def route(self, namespace: str, ingress: Dict[str, Any]) -> None:
+        """Adds the path of a notebook's (rendered) Ingress
+        to its shared Ingress, returning once it's been written.
+        """
+        path = _path(ingress)
+        await self._change(
+            namespace, shared_ingress(ingress, self._shards), path["path"], path
+        )
+
+    async def unroute(self, namespace: str, ingress: Dict[str, Any]) -> None:
+        """Removes the path of a notebook's (rendered) Ingress
+        from its shared Ingress, returning once it's been written.
+        """
+        await self.remove(
+            namespace,
+            shared_ingress(ingress, self._shards)["metadata"]["name"],
+            _path(ingress)["path"],
+        )
+
+    async def remove(self, namespace: str, ingress_name: str, path: str) -> None:
+        """Removes a path from a shared Ingress,
+        returning once it's been written.
+        """
+        await self._change(namespace, {"metadata": {"name": ingress_name}}, path, None)
+
+    async def routes(self) -> Dict[Tuple[str, str], Tuple[str, str]]:
+        """Returns the routed notebooks (from a listing of the shared Ingresses),
+        the shared Ingress name and path of each, indexed by namespace
+        and notebook (Service) name.
+        """
+        routes: Dict[Tuple[str, str], Tuple[str, str]] = {}
+        for list_function in self._list_functions.values():
+            response = await kube.call(
+                "list",
+                "Ingress",
+                list_function,
+                label_selector=LABEL,
+                _preload_content=False,
+            )
+            for ingress in json.loads(response.data)["items"]:
+                metadata = ingress["metadata"]
+                for rule in ingress["spec"].get("rules") or []:
+                    for path in (rule.get("http") or {}).get("paths") or []:
+                        service = path["backend"]["service"]["name"]
+                        routes[(metadata["namespace"], service)] = (
+                            metadata["name"],
+                            path["path"],
+                        )
+        return routes
+
+    async def _change(
+        self,
+        namespace: str,
+        ingress: Dict[str, Any],
+        path: str,
+        path_body: Optional[Dict[str, Any]],
+    ) -> None:
+        """Adds a change (a path to add, or remove if 'path_body' is None)
+        to the batch of a shared Ingress, waiting for the batch to be written.
+        """
+        key = (namespace, ingress["metadata"]["name"])
+        batch = self._batches.get(key)
+        if batch is None:
+            batch = _Batch(namespace, ingress)
+            self._batches[key] = batch
+            self._writers[key] = asyncio.create_task(self._write_later(key))
+        elif "spec" not in batch.ingress:
+            # A batch of removals does not know the whole Ingress
+            batch.ingress = ingress
+        batch.paths[path] = path_body
+        batch.changes += 1
+        waiter: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+        batch.waiters.append(waiter)
+        await waiter
+
+    async def _write_later(self, key: Tuple[str, str]) -> None:
+        """Writes a batch once the batch delay has passed,
+        passing the outcome to those waiting for it.
+        """
+        await asyncio.sleep(self._batch_delay)
+        batch = self._batches.pop(key)
+        self._writers.pop(key, None)
+        try:
+            await self._write(batch)
+        except Exception as ex:  # pylint: disable=broad-exception-caught
+            # Every waiter gets the failure (whatever it is),
+            # rather than waiting forever.
+            for waiter in batch.waiters:
+                waiter.set_exception(ex)
+            return
+        self._updates += 1
+        self._changes += batch.changes
+        metrics.SHARED_INGRESS_UPDATES.inc()
+        metrics.SHARED_INGRESS_COALESCED.inc(batch.changes - 1)
+        for waiter in batch.waiters:
+            waiter.set_result(None)
+
+    async def _write(self, batch: _Batch) -> None:
+        """Writes a batch, creating, replacing or (if it no longer has
+        any paths) deleting the shared Ingress.
+        """
+        name = batch.ingress["metadata"]["name"]
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                response = await kube.call(
+                    "read",
+                    "Ingress",
+                    self._ext_api.read_namespaced_ingress,
+                    name,
+                    batch.namespace,
+                    _preload_content=False,
+                )
+                ingress: Optional[Dict[str, Any]] = json.loads(response.data)
+            except kubernetes.client.exceptions.ApiException as ex:
+                if ex.status != 404:
+                    raise ex
+                ingress = None
+            try:
+                await self._replace(batch, ingress)
+                return
+            except kubernetes.client.exceptions.ApiException as ex:
+                # The Ingress has changed (or been created) since we read it?
+                if attempt >= _WRITE_ATTEMPTS or ex.status not in (404, 409):
+                    raise ex
+
+    async def _replace(self, batch: _Batch, ingress: Optional[Dict[str, Any]]) -> None:
+        """Applies a batch to a shared Ingress (as read, None if it's missing)."""
+        name = batch.ingress["metadata"]["name"]
+        if ingress is None:
+            added = {path: body for path, body in batch.paths.items() if body}
+            if not added:
+                return
+            ingress = copy.deepcopy(batch.ingress)
+            ingress["spec"]["rules"][0]["http"]["paths"] = [
+                added[path] for path in sorted(added)
+            ]
+            response = await kube.call(
+                "create",
+                "Ingress",
+                self._ext_api.create_namespaced_ingress,
+                batch.namespace,
+                ingress,
+                _preload_content=False,
+            )
+            kube.release(response)
+            logging.info(
+                "Created shared Ingress %s (namespace=%s changes=%s)",
+                name,
+                batch.namespace,
+                batch.changes,
+            )
+            return
+
+        rule = ingress["spec"]["rules"][0]
+        existing: Dict[str, Dict[str, Any]] = {
+            path["path"]: path for path in rule["http"]["paths"]
+        }
+        paths = {
+            path: body
+            for path, body in {**existing, **batch.paths}.items()
+            if body is not None
+        }
+        if paths == existing:
+            return
+        if not paths:
+            response = await kube.call(
+                "delete",
+                "Ingress",
+                self._ext_api.delete_namespaced_ingress,
+                name,
+                batch.namespace,
+                body=kubernetes.client.V1DeleteOptions(
+                    preconditions=kubernetes.client.V1Preconditions(
+                        resource_version=ingress["metadata"]["resourceVersion"]
+                    )
+                ),
+                _preload_content=False,
+            )
+            kube.release(response)
+            logging.info(
+                "Deleted shared Ingress %s (namespace=%s)", name, batch.namespace
+            )
+            return
+        rule["http"]["paths"] = [paths[path] for path in sorted(paths)]
+        response = await kube.call(
+            "replace",
+            "Ingress",
+            self._ext_api.replace_namespaced_ingress,
+            name,
+            batch.namespace,
+            ingress,
+            _preload_content=False,
+        )
+        kube.release(response)
+        logging.info(
+            "Updated shared Ingress %s (namespace=%s changes=%s paths=%s)",
+            name,
+            batch.namespace,
+            batch.changes,
+            len(paths),
+        )
+
+
+def _routing_enabled(**_: Any) -> bool:
+    return bool(SHARED_INGRESS)
+
+
+@kopf.on.event(
+    "squonk.it",
+    "v2",
+    "jupyternotebooks",
+    id="routing",
+    when=kopf.all_([_routing_enabled, sharding.owned]),
+)
+async def unroute(
+    event: kopf.RawEvent,
+    spec: Dict[str, Any],
+    name: str,
+    namespace: str,
+    memo: kopf.Memo,
+    **_: Any,
+) -> None:
+    """Handler for notebook (watch) events.
+    Here we remove the path of a deleted notebook from its shared Ingress.
+    """
+    router: Optional[IngressRouter] = memo.get("router")
+    if not router or event["type"] != "DELETED":
+        return
+    try:
+        notebook = manifests.render(notebook_spec.parse(name, spec))
+    except notebook_spec.SpecError:
+        # An invalid notebook (which was never routed)
+        return
+    try:
+        await router.unroute(namespace, notebook.ingress)
+    except kubernetes.client.exceptions.ApiException as ex:
+        logging.warning(
+            "Got ApiException [%s/%s] removing %s from its shared Ingress",
+            ex.status,
+            ex.reason,
+            name,
+        )
+
+
+@kopf.on.probe(id="sharedIngress")
+def router_probe(memo: kopf.Memo, **_: Any) -> Dict[str, Any]:
+    """Exposes the shared Ingress statistics (updates and coalesced changes)
+    through the operator's health endpoint (if enabled).
+    """
+    router: Optional[IngressRouter] = memo.get("router")
+    return router.stats() if router else {}
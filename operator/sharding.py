@@ -0,0 +1,427 @@
+"""Sharding of notebooks between (multiple) operator replicas.
+
+Notebooks are divided into a fixed number of shards, by a hash of their
+namespace and name (or just their namespace). Each shard has a Lease
+(in the operator's namespace) and a notebook is only handled by the replica
+that holds its shard's Lease. Each replica also renews a Lease of its own,
+so that every replica knows how many are running and can take an even share
+of the shards, acquiring free shards and those of replicas that have stopped
+renewing their Leases (failover) and releasing any excess (for new replicas).
+
+Our notebook handlers use the 'owned()' filter, so kopf does not handle
+the notebooks of shards held by other replicas. kopf does store its
+'last-handled-configuration' annotation (a PATCH) on any notebook change
+it processes, even where every handler is skipped, which (if a handler
+without the filter matched) would have every replica write to every
+notebook. So each replica's kopf uses our 'OwnedDiffBaseStorage',
+which only stores it on the notebooks we own.
+When a replica acquires a shard it sets 'status.shard' on each of the
+shard's notebooks, so kopf sees them again, creating, resuming
+(or continuing to create) them.
+
+The holder of the first shard is the 'leader', the replica that maintains
+the operator-wide objects (the warm pool, pre-pull DaemonSet etc.).
+The probe here is registered by importing this module
+(as the operator's 'handlers' module does).
+"""
+
+import asyncio
+import datetime
+import hashlib
+import logging
+import os
+import random
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Set
+
+import kopf
+import kubernetes
+
+import kube
+import metrics
+
+# Shard notebooks between operator replicas?
+# The number of shards (zero for no sharding), which should be a few times
+# the (maximum) number of replicas, and what notebooks are sharded by
+# ('name', a hash of the namespace and name, or 'namespace').
+# Leases are held in the given namespace for the 'lease duration' (seconds)
+# and renewed every third of that. A replica is identified by its Pod name.
+SHARDS: int = int(os.environ.get("JO_SHARDS", "0"))
+_SHARD_BY: str = os.environ.get("JO_SHARD_BY", "name")
+_LEASE_NAMESPACE: str = os.environ.get(
+    "JO_SHARD_LEASE_NAMESPACE", "data-manager-jupyter-operator"
+)
+_LEASE_DURATION: int = int(os.environ.get("JO_SHARD_LEASE_DURATION", "15"))
+_IDENTITY: str = os.environ.get("JO_SHARD_IDENTITY") or socket.gethostname()
+
+# The label (and its values) of our Leases, and their name prefixes
+_LEASE_LABEL: str = "squonk.it/jupyter-operator"
+_SHARD_LEASE: str = "jupyter-operator-shard-"
+_REPLICA_LEASE: str = "jupyter-operator-replica-"
+# The number of concurrent notebook status patches made
+# when acquiring shards
+_TOUCH_CONCURRENCY: int = 8
+
+
+def shard(namespace: str, name: str) -> int:
+    """The shard of a notebook."""
+    key = namespace if _SHARD_BY == "namespace" else f"{namespace}/{name}"
+    digest = hashlib.sha256(key.encode()).digest()
+    return int.from_bytes(digest[:8], "big") % SHARDS
+
+
+def owned(name: str, namespace: str, memo: kopf.Memo, **_: Any) -> bool:
+    """A handler filter, True for notebooks of the shards we hold
+    (or all notebooks if we're not sharding).
+    """
+    shards: Optional[ShardLeases] = memo.get("shards")
+    return shards is None or shards.owns(namespace, name)
+
+
+class OwnedDiffBaseStorage(kopf.AnnotationsDiffBaseStorage):
+    """kopf's (default) diff-base storage, only storing the last-handled
+    configuration of the notebooks we own. The notebooks of other replicas
+    are left to them, so we don't PATCH every notebook we skip.
+    """
+
+    def __init__(self, owns: Callable[[str, str], bool]) -> None:
+        super().__init__()
+        self._owns = owns
+
+    def store(
+        self,
+        *,
+        body: kopf.Body,
+        patch: kopf.Patch,
+        essence: kopf.BodyEssence,
+    ) -> None:
+        if self._owns(body.metadata.namespace or "", body.metadata.name or ""):
+            super().store(body=body, patch=patch, essence=essence)
+
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def _micro_time(when: datetime.datetime) -> str:
+    """Formats a time as a Kubernetes 'MicroTime'."""
+    return when.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def _live_holder(lease: Any, now: datetime.datetime) -> Optional[str]:
+    """The holder of a Lease, if it has not expired."""
+    spec = lease.spec
+    if not spec or not spec.holder_identity or not spec.renew_time:
+        return None
+    duration = datetime.timedelta(
+        seconds=spec.lease_duration_seconds or _LEASE_DURATION
+    )
+    return spec.holder_identity if spec.renew_time + duration > now else None
+
+
+class ShardLeases:
+    """Acquires, renews and releases this replica's share of the shard Leases."""
+
+    def __init__(self, api_client: kubernetes.client.ApiClient) -> None:
+        self._api_client = api_client
+        self._coordination_api = kubernetes.client.CoordinationV1Api(api_client)
+        # The shards we hold, and when (monotonic time) our hold expires
+        self._expiry: Dict[int, float] = {}
+        # The number of live replicas (including us)
+        self._replicas: int = 1
+        # Our Lease calls have their own thread
+        # (so they are not held up by a burst of notebook calls)
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._maintainer: Optional[asyncio.Task[None]] = None
+        self._touchers: Set[asyncio.Task[None]] = set()
+
+    def start(self) -> None:
+        """Starts maintaining our Leases."""
+        logging.info(
+            "Sharding notebooks (shards=%s by=%s identity=%s)",
+            SHARDS,
+            _SHARD_BY,
+            _IDENTITY,
+        )
+        self._maintainer = asyncio.create_task(self._maintain())
+
+    async def stop(self) -> None:
+        """Stops maintaining our Leases, releasing them
+        (so other replicas can take over our shards without waiting).
+        """
+        if self._maintainer:
+            self._maintainer.cancel()
+        for toucher in self._touchers:
+            toucher.cancel()
+        held = sorted(self._expiry)
+        self._expiry.clear()
+        try:
+            for index in held:
+                await self._release(f"{_SHARD_LEASE}{index}")
+            await self._release(f"{_REPLICA_LEASE}{_IDENTITY}")
+        except kubernetes.client.exceptions.ApiException as ex:
+            logging.warning(
+                "Got ApiException [%s/%s] releasing shard Leases", ex.status, ex.reason
+            )
+        self._executor.shutdown(wait=False)
+
+    def owns(self, namespace: str, name: str) -> bool:
+        """True if we hold the shard of a notebook."""
+        return self._expiry.get(shard(namespace, name), 0.0) > time.monotonic()
+
+    def leader(self) -> bool:
+        """True if we are the leader (we hold the first shard)."""
+        return self._expiry.get(0, 0.0) > time.monotonic()
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns a summary of our shards (for the operator's probes)."""
+        now = time.monotonic()
+        return {
+            "identity": _IDENTITY,
+            "shards": SHARDS,
+            "replicas": self._replicas,
+            "owned": sorted(index for index, end in self._expiry.items() if end > now),
+        }
+
+    async def _maintain(self) -> None:
+        """A background task that maintains our Leases
+        (every third of the Lease duration).
+        """
+        while True:
+            try:
+                await self._balance()
+            except kubernetes.client.exceptions.ApiException as ex:
+                logging.warning(
+                    "Got ApiException [%s/%s] maintaining shard Leases",
+                    ex.status,
+                    ex.reason,
+                )
+            metrics.SHARDS_OWNED.set(len(self.stats()["owned"]))
+            metrics.SHARD_REPLICAS.set(self._replicas)
+            await asyncio.sleep(_LEASE_DURATION / 3)
+
+    async def _balance(self) -> None:
+        """Renews our Leases, releasing shards above our share
+        and acquiring shards (if we have fewer than our share).
+        """
+        leases = await kube.call(
+            "list",
+            "Lease",
+            self._coordination_api.list_namespaced_lease,
+            _LEASE_NAMESPACE,
+            label_selector=_LEASE_LABEL,
+            executor=self._executor,
+        )
+        now = _now()
+        by_name = {lease.metadata.name: lease for lease in leases.items}
+
+        # Our replica Lease (which tells the others we're here)
+        # and the live replicas. Expired replica Leases are deleted.
+        own_lease = f"{_REPLICA_LEASE}{_IDENTITY}"
+        await self._renew(by_name.get(own_lease), "replica")
+        replicas = {_IDENTITY}
+        for name, lease in by_name.items():
+            if not name.startswith(_REPLICA_LEASE) or name == own_lease:
+                continue
+            holder = _live_holder(lease, now)
+            if holder:
+                replicas.add(holder)
+            else:
+                await self._release(name, delete=True)
+        self._replicas = len(replicas)
+        # Our share of the shards. The remainder goes to the first replicas
+        # (every replica sorts them in the same way).
+        share = SHARDS // len(replicas)
+        if sorted(replicas).index(_IDENTITY) < SHARDS % len(replicas):
+            share += 1
+
+        holders: Dict[int, Optional[str]] = {
+            index: (
+                _live_holder(by_name[f"{_SHARD_LEASE}{index}"], now)
+                if f"{_SHARD_LEASE}{index}" in by_name
+                else None
+            )
+            for index in range(SHARDS)
+        }
+        held = [index for index, holder in holders.items() if holder == _IDENTITY]
+        for index in set(self._expiry) - set(held):
+            logging.warning("Lost shard %s", index)
+            del self._expiry[index]
+
+        # Release our excess shards (the last ones, keeping the first,
+        # the leader's, for as long as we can), then renew the others
+        for index in held[share:]:
+            logging.info("Releasing shard %s", index)
+            self._expiry.pop(index, None)
+            await self._release(f"{_SHARD_LEASE}{index}")
+        # Shards whose hold lapsed before we renewed them
+        # (when kopf will have ignored their notebooks) are treated
+        # as if they'd just been acquired.
+        acquired: List[int] = []
+        for index in held[:share]:
+            start = time.monotonic()
+            lapsed = self._expiry.get(index, 0.0) <= start
+            if await self._renew(by_name[f"{_SHARD_LEASE}{index}"], "shard"):
+                self._expiry[index] = start + _LEASE_DURATION
+                if lapsed:
+                    logging.warning("Renewed lapsed shard %s", index)
+                    acquired.append(index)
+            else:
+                self._expiry.pop(index, None)
+
+        # Acquire free (or expired) shards, in a random order
+        # (to avoid contention with other replicas)
+        free = [index for index, holder in holders.items() if holder is None]
+        random.shuffle(free)
+        for index in free[: max(0, share - len(held))]:
+            lease = by_name.get(f"{_SHARD_LEASE}{index}")
+            start = time.monotonic()
+            if await self._renew(lease, "shard", f"{_SHARD_LEASE}{index}"):
+                self._expiry[index] = start + _LEASE_DURATION
+                acquired.append(index)
+                previous = lease.spec.holder_identity if lease else None
+                metrics.SHARD_ACQUISITIONS.labels(
+                    "takeover" if previous else "free"
+                ).inc()
+                logging.info(
+                    "Acquired shard %s%s",
+                    index,
+                    f" (from {previous})" if previous else "",
+                )
+        if acquired:
+            toucher = asyncio.create_task(self._touch(acquired))
+            self._touchers.add(toucher)
+            toucher.add_done_callback(self._touchers.discard)
+
+    async def _renew(self, lease: Any, kind: str, name: Optional[str] = None) -> bool:
+        """Renews (or acquires) a Lease (creating it if it does not exist),
+        returning False if another replica got there first.
+        """
+        now = _micro_time(_now())
+        body: Dict[str, Any] = {
+            "apiVersion": "coordination.k8s.io/v1",
+            "kind": "Lease",
+            "metadata": {
+                "name": name or f"{_REPLICA_LEASE}{_IDENTITY}",
+                "labels": {_LEASE_LABEL: kind},
+            },
+            "spec": {
+                "holderIdentity": _IDENTITY,
+                "leaseDurationSeconds": _LEASE_DURATION,
+                "acquireTime": now,
+                "renewTime": now,
+                "leaseTransitions": 0,
+            },
+        }
+        try:
+            if lease is None:
+                await kube.call(
+                    "create",
+                    "Lease",
+                    self._coordination_api.create_namespaced_lease,
+                    _LEASE_NAMESPACE,
+                    body,
+                    executor=self._executor,
+                )
+                return True
+            # A renewal keeps the acquisition time,
+            # otherwise this is a transition (to us)
+            body["metadata"]["name"] = lease.metadata.name
+            body["metadata"]["resourceVersion"] = lease.metadata.resource_version
+            transitions = lease.spec.lease_transitions or 0
+            if lease.spec.holder_identity == _IDENTITY and lease.spec.acquire_time:
+                body["spec"]["acquireTime"] = _micro_time(lease.spec.acquire_time)
+                body["spec"]["leaseTransitions"] = transitions
+            else:
+                body["spec"]["leaseTransitions"] = transitions + 1
+            await kube.call(
+                "replace",
+                "Lease",
+                self._coordination_api.replace_namespaced_lease,
+                lease.metadata.name,
+                _LEASE_NAMESPACE,
+                body,
+                executor=self._executor,
+            )
+            return True
+        except kubernetes.client.exceptions.ApiException as ex:
+            if ex.status != 409:
+                raise ex
+            return False
+
+    async def _release(self, name: str, delete: bool = False) -> None:
+        """Releases (clears the holder of) or deletes a Lease."""
+        try:
+            if delete:
+                await kube.call(
+                    "delete",
+                    "Lease",
+                    self._coordination_api.delete_namespaced_lease,
+                    name,
+                    _LEASE_NAMESPACE,
+                    executor=self._executor,
+                )
+            else:
+                await kube.call(
+                    "patch",
+                    "Lease",
+                    self._coordination_api.patch_namespaced_lease,
+                    name,
+                    _LEASE_NAMESPACE,
+                    {"spec": {"holderIdentity": None}},
+                    executor=self._executor,
+                )
+        except kubernetes.client.exceptions.ApiException as ex:
+            if ex.status != 404:
+                raise ex
+
+    async def _touch(self, acquired: List[int]) -> None:
+        """Sets 'status.shard' on the notebooks of newly acquired shards,
+        so that kopf handles (creates or resumes) them.
+        """
+        notebooks = [
+            notebook
+            for notebook in await kube.list_notebooks(self._api_client)
+            if shard(notebook["metadata"]["namespace"], notebook["metadata"]["name"])
+            in acquired
+        ]
+        logging.info("Setting the shard of %s notebooks", len(notebooks))
+        semaphore = asyncio.Semaphore(_TOUCH_CONCURRENCY)
+
+        async def touch(notebook: Dict[str, Any]) -> None:
+            metadata = notebook["metadata"]
+            async with semaphore:
+                try:
+                    await kube.patch_notebook_status(
+                        self._api_client,
+                        metadata["namespace"],
+                        metadata["name"],
+                        {
+                            "shard": {
+                                "index": shard(metadata["namespace"], metadata["name"]),
+                                "owner": _IDENTITY,
+                                "acquiredAt": _micro_time(_now()),
+                            }
+                        },
+                    )
+                except kubernetes.client.exceptions.ApiException as ex:
+                    if ex.status != 404:
+                        logging.warning(
+                            "Got ApiException [%s/%s] setting %s shard",
+                            ex.status,
+                            ex.reason,
+                            metadata["name"],
+                        )
+
+        await asyncio.gather(*(touch(notebook) for notebook in notebooks))
+
+
+@kopf.on.probe(id="sharding")
+def sharding_probe(memo: kopf.Memo, **_: Any) -> Dict[str, Any]:
+    """Exposes the shards we hold
+    through the operator's health endpoint (if enabled).
+    """
+    shards: Optional[ShardLeases] = memo.get("shards")
+    return shards.stats() if shards else {}
@@ -0,0 +1,239 @@
+"""The static notebook configuration (the startup script and bash profile)
+and the collection (deletion) of unused shared static ConfigMaps.
+
+Shared static ConfigMaps (see JO_SHARED_STATIC_CONFIG) are named using a hash
+of their content, so an operator with a new startup script or bash profile
+creates new ones. The old ones are deleted once no notebook uses them.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from typing import Callable, Dict, List, Optional
+
+import kubernetes
+
+import kube
+
+# Share the static startup script and bash profile?
+# Any value results in the notebooks of each namespace using one
+# (immutable) ConfigMap, named using a hash of its content,
+# rather than each notebook having its own 'startup' and 'bp' ConfigMaps.
+SHARED: Optional[str] = os.environ.get("JO_SHARED_STATIC_CONFIG")
+# The period (seconds) between deletions of unreferenced shared ConfigMaps
+# (those created by earlier versions of the operator)
+GC_INTERVAL: int = int(os.environ.get("JO_STATIC_CONFIG_GC_INTERVAL", "3600"))
+
+# A custom startup script, executed as the container "command".
+#
+# It writes a new a .bashrc, copies the .bash_profile and jupyter_notebook_config.json
+# files into place and then copies the file tree from /home/code/copy-to-home
+# to the user's home directory before running 'jupyter lab'.
+#
+# Working directory is the Project directory,
+# and HOME is the project instance directory
+# (where the bash and bash_profile files are written)
+#
+# As part of the startup we erase the existing '~/.bashrc' and,
+# as a minimum, set a more suitable PS1 (see ch2385).
+# 'conda init' then puts its stuff into the same file.
+_STARTUP: str = r"""#!/bin/bash
+echo "PS1='\$(pwd) \$UID$ '" > ~/.bashrc
+echo "umask 0002" >> ~/.bashrc
+conda init
+source ~/.bashrc
+
+if [ ! -f ~/.bash_profile ]; then
+    echo "Copying bash_profile into place"
+    cp /etc/.bash_profile ~
+fi
+
+if [ ! -f ~/jupyter_notebook_config.json ]; then
+    echo "Copying config into place"
+    cp /etc/jupyter_notebook_config.json ~
+fi
+
+if [ -d /home/code/copy-to-startup ]; then
+    echo "Copying copy-to-startup content"
+    cp -r -u /home/code/copy-to-startup/* ~/..
+fi
+
+jupyter lab --config=~/jupyter_notebook_config.json
+"""
+
+# An incremental startup script (see JO_INCREMENTAL_STARTUP).
+#
+# It does what the startup script (above) does, but: -
+#
+# -   Rather than running 'conda init' (and the conda shell hook it adds
+#     to '~/.bashrc') on every start, the output of the hook is cached
+#     (in the home directory) for each conda installation (image).
+# -   The copy-to-startup content is only copied when it differs from
+#     the content last copied (a stamp of the image's files is recorded).
+# -   The duration of each step is written to the log, as lines of the form
+#     'jupyter-startup step=<step> ms=<milliseconds>' (parsed by the operator).
+_INCREMENTAL_STARTUP: str = r"""#!/bin/bash
+state=~/.jupyter-startup
+mkdir -p $state
+now() { local t=${EPOCHREALTIME:-$(date +%s.%6N)}; echo "${t/./}"; }
+last=$(now)
+timed() {
+    local t; t=$(now)
+    echo "jupyter-startup step=$1 ms=$(( (t - last) / 1000 ))"
+    last=$t
+}
+
+echo "PS1='\$(pwd) \$UID$ '" > ~/.bashrc
+echo "umask 0002" >> ~/.bashrc
+if command -v conda > /dev/null; then
+    conda_key=$(stat -c '%n %s %Y' "$(command -v conda)" \
+        "${CONDA_DIR:-/opt/conda}/conda-meta/history" 2> /dev/null \
+        | md5sum | cut -c1-12)
+    conda_hook=$state/conda-hook-$conda_key.sh
+    if [ ! -f $conda_hook ]; then
+        echo "Caching conda shell hook"
+        conda shell.bash hook > $conda_hook.tmp && mv $conda_hook.tmp $conda_hook
+    fi
+    echo "source $conda_hook" >> ~/.bashrc
+fi
+timed condaInit
+source ~/.bashrc
+timed bashrc
+
+if [ ! -f ~/.bash_profile ]; then
+    echo "Copying bash_profile into place"
+    cp /etc/.bash_profile ~
+fi
+
+if [ ! -f ~/jupyter_notebook_config.json ]; then
+    echo "Copying config into place"
+    cp /etc/jupyter_notebook_config.json ~
+fi
+timed config
+
+if [ -d /home/code/copy-to-startup ]; then
+    stamp=$(find /home/code/copy-to-startup -printf '%P %s %T@\n' | sort | md5sum)
+    if [ "$stamp" != "$(cat $state/copy-to-startup.stamp 2> /dev/null)" ]; then
+        echo "Copying copy-to-startup content"
+        cp -r -u /home/code/copy-to-startup/* ~/.. \
+            && echo "$stamp" > $state/copy-to-startup.stamp
+    fi
+fi
+timed copyToStartup
+
+jupyter lab --config=~/jupyter_notebook_config.json
+"""
+
+# Use the incremental startup script?
+# Any value results in notebooks using the incremental startup script
+# (which also logs the duration of each of its steps).
+INCREMENTAL_STARTUP: Optional[str] = os.environ.get("JO_INCREMENTAL_STARTUP")
+NOTEBOOK_STARTUP: str = _INCREMENTAL_STARTUP if INCREMENTAL_STARTUP else _STARTUP
+
+# The bash-profile
+# which simply launches the .bashrc
+BASH_PROFILE: str = """if [ -f ~/.bashrc ]; then
+    source ~/.bashrc
+fi
+"""
+
+# The content of the shared (static) ConfigMap (see JO_SHARED_STATIC_CONFIG).
+# Its name is derived from its content, so a change to the startup script
+# or bash profile results in a new ConfigMap.
+DATA: Dict[str, str] = {
+    "start.sh": NOTEBOOK_STARTUP,
+    ".bash_profile": BASH_PROFILE,
+}
+NAME: str = (
+    "jupyter-static-"
+    + hashlib.sha256(json.dumps(DATA, sort_keys=True).encode()).hexdigest()[:12]
+)
+# The label identifying shared static ConfigMaps
+LABEL: str = "squonk.it/jupyter-static-config"
+
+
+async def _delete_unreferenced(
+    api_client: kubernetes.client.ApiClient, current_name: str, label: str
+) -> None:
+    """Deletes shared static ConfigMaps (those with the given label,
+    in the namespaces we watch) that are not the one used by this operator
+    and are no longer mounted by any notebook Deployment.
+    """
+    core_api = kubernetes.client.CoreV1Api(api_client)
+    apps_api = kubernetes.client.AppsV1Api(api_client)
+
+    candidates: Dict[str, List[str]] = {}
+    for list_function in kube.scoped(
+        core_api.list_config_map_for_all_namespaces,
+        core_api.list_namespaced_config_map,
+    ).values():
+        config_maps = await kube.call(
+            "list", "ConfigMap", list_function, label_selector=label
+        )
+        for config_map in config_maps.items:
+            if config_map.metadata.name != current_name:
+                candidates.setdefault(config_map.metadata.namespace, []).append(
+                    config_map.metadata.name
+                )
+
+    for namespace, cm_names in candidates.items():
+        deployments = await kube.call(
+            "list",
+            "Deployment",
+            apps_api.list_namespaced_deployment,
+            namespace,
+            label_selector="app",
+        )
+        referenced = {
+            volume.config_map.name
+            for deployment in deployments.items
+            for volume in deployment.spec.template.spec.volumes or []
+            if volume.config_map
+        }
+        for cm_name in cm_names:
+            if cm_name in referenced:
+                continue
+            logging.info(
+                "Deleting unreferenced static ConfigMap %s (namespace=%s)",
+                cm_name,
+                namespace,
+            )
+            try:
+                await kube.call(
+                    "delete",
+                    "ConfigMap",
+                    core_api.delete_namespaced_config_map,
+                    cm_name,
+                    namespace,
+                )
+            except kubernetes.client.exceptions.ApiException as ex:
+                if ex.status != 404:
+                    raise ex
+
+
+async def collect(
+    api_client: kubernetes.client.ApiClient,
+    current_name: str,
+    label: str,
+    interval: int,
+    leader: Optional[Callable[[], bool]] = None,
+) -> None:
+    """A background task that periodically (every 'interval' seconds)
+    deletes unreferenced shared static ConfigMaps
+    (if there's a 'leader' function, only while it returns True).
+    """
+    while True:
+        if leader and not leader():
+            await asyncio.sleep(interval)
+            continue
+        try:
+            await _delete_unreferenced(api_client, current_name, label)
+        except kubernetes.client.exceptions.ApiException as ex:
+            logging.warning(
+                "Got ApiException [%s/%s] collecting static ConfigMaps",
+                ex.status,
+                ex.reason,
+            )
+        await asyncio.sleep(interval)
@@ -0,0 +1,17 @@
+"""Test configuration.
+
+The operator's modules are imported from the operator directory
+(as the operator runs them), with the environment of a default operator
+(its required ingress domain and none of its optional settings),
+which the modules read when they're imported.
+"""
+
+import os
+import sys
+
+for _variable in list(os.environ):
+    if _variable.startswith("JO_") or _variable.startswith("INGRESS_"):
+        del os.environ[_variable]
+os.environ["INGRESS_DOMAIN"] = "example.com"
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
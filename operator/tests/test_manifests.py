@@ -0,0 +1,59 @@
+"""Tests of the rendering of notebook objects.
+
+The expected objects (in 'data/objects.jsonl') are those 'render.py'
+writes for the notebooks in 'data/notebooks.jsonl'. A deliberate change
+to the objects is recorded by re-rendering them (in the operator directory,
+with no operator settings in the environment but its ingress domain): -
+
+    INGRESS_DOMAIN=example.com ./render.py tests/data/notebooks.jsonl \\
+        --output tests/data/objects.jsonl
+"""
+
+import json
+import os
+from typing import Any, Dict, List
+
+import manifests
+import notebook_spec
+
+_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+
+def _read(file_name: str) -> List[Dict[str, Any]]:
+    with open(os.path.join(_DATA, file_name), encoding="utf-8") as lines:
+        return [json.loads(line) for line in lines if line.strip()]
+
+
+def test_render_is_stable() -> None:
+    """The objects rendered for each notebook are those expected."""
+    notebooks = _read("notebooks.jsonl")
+    expected = _read("objects.jsonl")
+
+    assert len(notebooks) == len(expected)
+    for notebook, expected_notebook in zip(notebooks, expected):
+        name = notebook["metadata"]["name"]
+        spec = notebook_spec.parse(name, notebook["spec"])
+        objects = [body for _, body in manifests.render(spec).objects("")]
+        assert objects == expected_notebook["objects"], name
+
+
+def test_renders_are_independent() -> None:
+    """Changing a notebook's objects does not change those of others
+    (which share the parts that only depend on the operator's settings).
+    """
+    notebook = _read("notebooks.jsonl")[0]
+    spec = notebook_spec.parse(notebook["metadata"]["name"], notebook["spec"])
+
+    first = manifests.render(spec)
+    expected = manifests.render(spec).objects("")
+    # Changes made to one notebook's objects (as the handlers make them)
+    first.prefer_node("node-1")
+    first.set_resources(
+        {
+            "requests": {"cpu": "1", "memory": "1Gi"},
+            "limits": {"cpu": "2", "memory": "2Gi"},
+        }
+    )
+    first.deployment["spec"]["replicas"] = 0
+
+    assert manifests.render(spec).objects("") == expected
@@ -0,0 +1,93 @@
+"""Tests of the parsing (and validation) of notebook specs."""
+
+import copy
+from typing import Any, Dict
+
+import pytest
+
+import notebook_spec
+
+_SPEC: Dict[str, Any] = {
+    "imDataManager": {
+        "image": "jupyter/minimal-notebook:2023.1",
+        "labels": [
+            "data-manager.informaticsmatters.com/owner=user-1",
+            "data-manager.informaticsmatters.com/instance-id=i-1",
+        ],
+        "project": {"id": "project-1", "claimName": "project-pvc"},
+    }
+}
+
+
+def _spec(**material: Any) -> Dict[str, Any]:
+    """A valid spec, with some of its Data Manager material replaced."""
+    spec = copy.deepcopy(_SPEC)
+    spec["imDataManager"].update(material)
+    return spec
+
+
+def test_parse_applies_defaults() -> None:
+    """A valid spec is given the defaults of what it omits."""
+    spec = notebook_spec.parse("nb-1", _SPEC)
+
+    assert spec.image == "jupyter/minimal-notebook:2023.1"
+    assert spec.owner == "user-1"
+    assert spec.instance_id == "i-1"
+    assert spec.cpu_request == notebook_spec.DEFAULT_CPU_REQUEST
+    assert spec.memory_limit == notebook_spec.DEFAULT_MEM_LIMIT
+    assert spec.ingress_domain == "example.com"
+
+
+@pytest.mark.parametrize(
+    "label",
+    [
+        "no-equals",
+        "too=many=equals",
+        "bad key=value",
+        "key=bad value",
+        "-key=value",
+        f"key={'x' * 64}",
+        1,
+    ],
+)
+def test_invalid_label(label: Any) -> None:
+    """A label that is not a valid Kubernetes 'key=value' is rejected."""
+    with pytest.raises(notebook_spec.SpecError):
+        notebook_spec.parse("nb-1", _spec(labels=[label]))
+
+
+@pytest.mark.parametrize(
+    "resources",
+    [
+        {"requests": {"cpu": "lots"}},
+        {"requests": {"memory": "1Gb"}},
+        {"limits": {"cpu": ["1"]}},
+        {"requests": {"cpu": "2"}, "limits": {"cpu": "1"}},
+        {"requests": {"memory": "2Gi"}, "limits": {"memory": "1Gi"}},
+    ],
+)
+def test_invalid_quantity(resources: Dict[str, Any]) -> None:
+    """A malformed quantity (or a request above its limit) is rejected."""
+    with pytest.raises(notebook_spec.SpecError):
+        notebook_spec.parse("nb-1", _spec(resources=resources))
+
+
+@pytest.mark.parametrize(
+    "project",
+    [
+        {},
+        {"id": "project-1"},
+        {"claimName": "project-pvc"},
+        {"id": "project-1", "claimName": ""},
+    ],
+)
+def test_missing_project_or_claim(project: Dict[str, Any]) -> None:
+    """A spec without its project (ID and claim) is rejected."""
+    with pytest.raises(notebook_spec.SpecError):
+        notebook_spec.parse("nb-1", _spec(project=project))
+
+
+def test_invalid_name() -> None:
+    """A name that is not a valid Service name is rejected."""
+    with pytest.raises(notebook_spec.SpecError):
+        notebook_spec.parse("Notebook_1", _SPEC)
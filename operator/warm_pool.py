@@ -0,0 +1,338 @@
+"""A pool of standby (placeholder) Pods, kept running for each configured
+notebook image and resource class.
+
+A running Pod's volumes cannot be changed, so a standby Pod cannot become
+the notebook (which needs the user's project volume). Instead each standby Pod
+runs the notebook image (so it is pulled) with the notebook's resource requests
+(reserving capacity) on a notebook node. When a notebook is created we 'claim'
+a standby Pod of the same class: we delete it (releasing its capacity)
+and the notebook's Pod is steered to the standby Pod's node,
+avoiding a wait for node capacity and an image pull.
+
+The pool is refilled at a limited rate and, if there's no demand for a class
+(within an 'idle expiry' period), its standby Pods are deleted
+(until there's demand again).
+"""
+
+import asyncio
+import functools
+import hashlib
+import json
+import logging
+import time
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+import kubernetes
+
+from informer import Informer
+import kube
+import metrics
+
+# The label identifying standby Pods, whose value identifies the pool class
+_STANDBY_LABEL: str = "squonk.it/jupyter-standby"
+
+
+def node_affinity(node_name: str) -> Dict[str, Any]:
+    """Returns a Pod affinity that prefers the named node
+    (that of a claimed standby Pod).
+    """
+    return {
+        "nodeAffinity": {
+            "preferredDuringSchedulingIgnoredDuringExecution": [
+                {
+                    "weight": 100,
+                    "preference": {
+                        "matchFields": [
+                            {
+                                "key": "metadata.name",
+                                "operator": "In",
+                                "values": [node_name],
+                            }
+                        ]
+                    },
+                }
+            ]
+        }
+    }
+
+
+class _PoolClass:
+    """A notebook image and resource class, and its standby Pods."""
+
+    def __init__(self, image: str, cpu: str, memory: str, size: int) -> None:
+        self.image = image
+        self.cpu = cpu
+        self.memory = memory
+        self.size = size
+        self.id = hashlib.sha256(f"{image}/{cpu}/{memory}".encode()).hexdigest()[:12]
+        # The standby Pods (by name), the last time there was demand for one
+        # and the last time one was claimed.
+        self.pods: Dict[str, Dict[str, Any]] = {}
+        self.last_demand: float = time.monotonic()
+        self.last_claim: float = 0.0
+
+    def available(self) -> List[Dict[str, Any]]:
+        """The standby Pods that are running (on a node) and can be claimed."""
+        return [
+            pod
+            for pod in self.pods.values()
+            if (pod.get("status") or {}).get("phase") == "Running"
+            and not pod["metadata"].get("deletionTimestamp")
+        ]
+
+
+class WarmPool:
+    """Maintains the standby Pods (in one namespace), handing out
+    their nodes to new notebooks.
+
+    Pod events are received in the informer's thread and
+    handed to the event loop, where all pool management takes place.
+    """
+
+    def __init__(
+        self,
+        api_client: kubernetes.client.ApiClient,
+        request_timeout: Tuple[int, int],
+        namespace: str,
+        pool_classes: List[Dict[str, Any]],
+        pod_template: Dict[str, Any],
+    ) -> None:
+        """Creates the pool. Each pool class is a dictionary containing an
+        'image', the 'cpu' and 'memory' requests and the pool 'size'.
+        The Pod template provides the spec (node selector etc.) of standby Pods.
+        """
+        self._core_api = kubernetes.client.CoreV1Api(api_client)
+        self._namespace = namespace
+        self._pod_template = pod_template
+        self._loop = asyncio.get_running_loop()
+        self._classes: Dict[str, _PoolClass] = {}
+        for pool_class in pool_classes:
+            new_class = _PoolClass(
+                pool_class["image"],
+                pool_class["cpu"],
+                pool_class["memory"],
+                pool_class["size"],
+            )
+            self._classes[new_class.id] = new_class
+        # Standby Pods that are no longer needed
+        # (of a class that's no longer configured, or that have failed)
+        self._unwanted: Set[str] = set()
+        self._informer = Informer(
+            "StandbyPod",
+            functools.partial(self._core_api.list_namespaced_pod, namespace),
+            _STANDBY_LABEL,
+            request_timeout,
+            on_list=self._receive_list,
+            on_event=self._receive_event,
+        )
+        self._refiller: Optional[asyncio.Task[None]] = None
+
+    def start(
+        self,
+        refill_interval: float,
+        refill_rate: int,
+        idle_expiry: int,
+        leader: Optional[Callable[[], bool]] = None,
+    ) -> None:
+        """Starts watching (and refilling) the pool. If there is a 'leader'
+        function the pool is only refilled while it returns True.
+        """
+        self._informer.start()
+        self._refiller = asyncio.create_task(
+            self._refill(refill_interval, refill_rate, idle_expiry, leader)
+        )
+
+    def stop(self) -> None:
+        """Stops watching (and refilling) the pool.
+        The standby Pods are left running, for the next operator.
+        """
+        self._informer.stop()
+        if self._refiller:
+            self._refiller.cancel()
+
+    async def claim(self, image: str, cpu: str, memory: str) -> Optional[str]:
+        """Claims a standby Pod for a notebook with the given image and
+        resource requests, returning the name of the node it was running on
+        (or None if there are none). The standby Pod is deleted.
+        """
+        pool_class = next(
+            (
+                c
+                for c in self._classes.values()
+                if (c.image, c.cpu, c.memory) == (image, cpu, memory)
+            ),
+            None,
+        )
+        if pool_class is None:
+            return None
+        pool_class.last_demand = time.monotonic()
+        while available := pool_class.available():
+            pod = available[0]
+            pod_name = pod["metadata"]["name"]
+            del pool_class.pods[pod_name]
+            try:
+                await kube.call(
+                    "delete",
+                    "Pod",
+                    self._core_api.delete_namespaced_pod,
+                    pod_name,
+                    self._namespace,
+                    grace_period_seconds=0,
+                )
+            except kubernetes.client.exceptions.ApiException as ex:
+                if ex.status != 404:
+                    raise ex
+                # Someone else has it
+                continue
+            pool_class.last_claim = time.monotonic()
+            metrics.WARM_POOL_CLAIMS.labels(image, "hit").inc()
+            node_name: str = pod["spec"]["nodeName"]
+            logging.info("Claimed standby Pod %s (node=%s)", pod_name, node_name)
+            return node_name
+        metrics.WARM_POOL_CLAIMS.labels(image, "miss").inc()
+        return None
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns a summary of the pool (for the operator's probes)."""
+        return {
+            pool_class.image: {
+                "size": pool_class.size,
+                "standby": len(pool_class.pods),
+                "available": len(pool_class.available()),
+            }
+            for pool_class in self._classes.values()
+        }
+
+    def _receive_list(self, pods: List[Dict[str, Any]]) -> None:
+        """Hands listed Pods (from the informer thread) to the event loop."""
+        self._loop.call_soon_threadsafe(self._observe_all, pods)
+
+    def _receive_event(self, event_type: str, pod: Dict[str, Any]) -> None:
+        """Hands a Pod event (from the informer thread) to the event loop."""
+        self._loop.call_soon_threadsafe(self._observe, event_type, pod)
+
+    def _observe_all(self, pods: List[Dict[str, Any]]) -> None:
+        for pool_class in self._classes.values():
+            pool_class.pods = {}
+        self._unwanted = set()
+        for pod in pods:
+            self._observe("ADDED", pod)
+
+    def _observe(self, event_type: str, pod: Dict[str, Any]) -> None:
+        metadata = pod["metadata"]
+        pod_name = metadata["name"]
+        pool_class = self._classes.get(metadata["labels"][_STANDBY_LABEL])
+        if event_type == "DELETED":
+            self._unwanted.discard(pod_name)
+            if pool_class:
+                pool_class.pods.pop(pod_name, None)
+            return
+        phase = (pod.get("status") or {}).get("phase")
+        if pool_class is None or phase in ("Succeeded", "Failed"):
+            self._unwanted.add(pod_name)
+            if pool_class:
+                pool_class.pods.pop(pod_name, None)
+        else:
+            pool_class.pods[pod_name] = pod
+
+    def _standby_pod_body(self, pool_class: _PoolClass) -> Dict[str, Any]:
+        spec: Dict[str, Any] = json.loads(json.dumps(self._pod_template))
+        spec.update(
+            {
+                "terminationGracePeriodSeconds": 0,
+                "automountServiceAccountToken": False,
+                "containers": [
+                    {
+                        "name": "standby",
+                        "image": pool_class.image,
+                        "command": ["sleep", "infinity"],
+                        "resources": {
+                            "requests": {
+                                "cpu": pool_class.cpu,
+                                "memory": pool_class.memory,
+                            }
+                        },
+                    }
+                ],
+            }
+        )
+        return {
+            "apiVersion": "v1",
+            "kind": "Pod",
+            "metadata": {
+                "generateName": "jupyter-standby-",
+                "labels": {_STANDBY_LABEL: pool_class.id},
+            },
+            "spec": spec,
+        }
+
+    async def _refill(
+        self,
+        refill_interval: float,
+        refill_rate: int,
+        idle_expiry: int,
+        leader: Optional[Callable[[], bool]],
+    ) -> None:
+        """A background task that creates missing standby Pods
+        (at most 'refill_rate' of each class every 'refill_interval' seconds).
+        Classes without demand for 'idle_expiry' seconds (if not zero)
+        are emptied, and those claimed since the last refill are not refilled
+        (giving the notebook the capacity released by the standby Pod).
+        """
+        while True:
+            await asyncio.sleep(refill_interval)
+            if not self._informer.synced or (leader and not leader()):
+                continue
+            for pool_class in self._classes.values():
+                metrics.WARM_POOL_STANDBY.labels(pool_class.image).set(
+                    len(pool_class.available())
+                )
+                now = time.monotonic()
+                if idle_expiry and now - pool_class.last_demand > idle_expiry:
+                    # Release the capacity of idle classes
+                    self._unwanted.update(pool_class.pods)
+                    continue
+                if now - pool_class.last_claim < refill_interval:
+                    continue
+                missing = min(pool_class.size - len(pool_class.pods), refill_rate)
+                for _ in range(missing):
+                    try:
+                        pod = await kube.call(
+                            "create",
+                            "Pod",
+                            self._core_api.create_namespaced_pod,
+                            self._namespace,
+                            self._standby_pod_body(pool_class),
+                        )
+                    except kubernetes.client.exceptions.ApiException as ex:
+                        logging.warning(
+                            "Got ApiException [%s/%s] creating standby Pod",
+                            ex.status,
+                            ex.reason,
+                        )
+                        break
+                    # Count it now (the watch event may not have arrived)
+                    pool_class.pods[pod.metadata.name] = {
+                        "metadata": {"name": pod.metadata.name},
+                        "spec": {},
+                    }
+            for pod_name in list(self._unwanted):
+                logging.info("Deleting unwanted standby Pod %s", pod_name)
+                try:
+                    await kube.call(
+                        "delete",
+                        "Pod",
+                        self._core_api.delete_namespaced_pod,
+                        pod_name,
+                        self._namespace,
+                        grace_period_seconds=0,
+                    )
+                except kubernetes.client.exceptions.ApiException as ex:
+                    if ex.status != 404:
+                        logging.warning(
+                            "Got ApiException [%s/%s] deleting standby Pod %s",
+                            ex.status,
+                            ex.reason,
+                            pod_name,
+                        )
+                self._unwanted.discard(pod_name)